@@ -1,19 +1,17 @@
 #!/bin/bash
 set -e
 
-# Initialize database if needed
-python -c "from wtf_app_simple import app, db, create_initial_data; 
-with app.app_context():
-    db.create_all()
-    # Try to init data if tables are empty (basic check)
-    try:
-        from wtf_app_simple import Subject
-        if not Subject.query.first():
-            print('Initializing data...')
-            create_initial_data()
-    except Exception as e:
-        print(f'Init check failed: {e}')
-"
+# Create tables, apply pending schema migrations and seed default data (once, before any worker starts)
+python scripts/migrate_schema.py
+
+# Start background job workers (batch PDF / email / AI comment jobs), restarted if they exit
+JOB_WORKERS=${JOB_WORKERS:-2}
+for i in $(seq 1 "$JOB_WORKERS"); do
+    (while true; do python scripts/job_worker.py; sleep 2; done) &
+done
+
+# Start the email outbox sender (rate-limited delivery of queued report-card mail)
+(while true; do python scripts/email_sender.py; sleep 2; done) &
 
 # Start Gunicorn
 exec gunicorn -w 4 -b 0.0.0.0:5000 wtf_app_simple:app
@@ -0,0 +1,35 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import argparse
+import time
+
+from wtf_app_simple import app, db, ExamRegistration, create_tables, refresh_registration_totals
+
+# 回填报名汇总列 (总分 / 已录题数 / 满分题数 / 状态 / 最近录入时间)
+# 升级时迁移 exam_registrations_totals (scripts/migrate_schema.py) 会自动执行一次; 直接写入 scores 表 (脚本导入等) 后可手动重跑
+# 用法: python scripts/backfill_registration_totals.py [--template-id 3 ...]
+
+def main():
+    parser = argparse.ArgumentParser(description='Backfill exam registration score totals')
+    parser.add_argument('--template-id', type=int, action='append', help='only refresh these templates (repeatable)')
+    args = parser.parse_args()
+
+    with app.app_context():
+        create_tables()
+        start = time.perf_counter()
+        refresh_registration_totals(template_ids=args.template_id)
+        db.session.commit()
+        elapsed = time.perf_counter() - start
+
+        query = ExamRegistration.query
+        if args.template_id:
+            query = query.filter(ExamRegistration.exam_template_id.in_(args.template_id))
+        counts = dict(db.session.query(ExamRegistration.status, db.func.count(ExamRegistration.id))
+                      .filter(ExamRegistration.id.in_(query.with_entities(ExamRegistration.id)))
+                      .group_by(ExamRegistration.status).all())
+        print(f"Refreshed {sum(counts.values())} registrations in {elapsed:.2f}s: "
+              + ", ".join(f"{status}={count}" for status, count in sorted(counts.items(), key=lambda item: str(item[0]))))
+
+if __name__ == '__main__':
+    main()
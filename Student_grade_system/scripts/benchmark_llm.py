@@ -0,0 +1,70 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tests'))
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from wtf_app_simple import app, request_llm_completion, close_llm_clients
+from mock_llm import MockLLMServer
+
+# LLM 调用延迟基准: 每次调用裸 requests.post (旧实现) vs keep-alive 连接池客户端
+# 本地 OpenAI 兼容替身, --handshake-ms 模拟每条新连接的 DNS/TCP/TLS 开销
+# 用法: python scripts/benchmark_llm.py --calls 40 --handshake-ms 80 --threads 4
+
+MESSAGES = [{'role': 'user', 'content': '请生成评语'}]
+
+def post_without_session(llm, messages):
+    """旧实现: 每次调用新建连接"""
+    response = requests.post(
+        f"{llm['base_url']}/chat/completions",
+        headers={'Authorization': f"Bearer {llm['api_key']}", 'Content-Type': 'application/json'},
+        json={'model': llm['model'], 'messages': messages, 'temperature': 0.7},
+        timeout=30
+    )
+    response.raise_for_status()
+    return response.json()['choices'][0]['message']['content']
+
+def run(label, call, llm, calls, threads):
+    latencies = []
+
+    def one(_):
+        start = time.perf_counter()
+        call(llm, MESSAGES)
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(one, range(calls)))
+    elapsed = time.perf_counter() - start
+    mean_ms = sum(latencies) / len(latencies) * 1000
+    print(f"{label:<28} {elapsed:7.2f}s total  {mean_ms:7.1f} ms/call")
+    return mean_ms
+
+def main():
+    parser = argparse.ArgumentParser(description='LLM client latency benchmark')
+    parser.add_argument('--calls', type=int, default=40)
+    parser.add_argument('--handshake-ms', type=float, default=80.0, help='simulated DNS + TCP + TLS cost per new connection')
+    parser.add_argument('--response-ms', type=float, default=20.0, help='simulated model latency per call')
+    parser.add_argument('--threads', type=int, default=4)
+    args = parser.parse_args()
+
+    server = MockLLMServer(delay=args.response_ms / 1000.0, handshake_delay=args.handshake_ms / 1000.0).start()
+    llm = {'provider': 'mock', 'api_key': 'benchmark', 'base_url': server.base_url, 'model': 'mock'}
+    app.config['LLM_POOL_SIZE'] = args.threads
+
+    print(f"{args.calls} calls, {args.threads} threads, handshake {args.handshake_ms} ms, response {args.response_ms} ms")
+    baseline = run('requests.post per call', post_without_session, llm, args.calls, args.threads)
+    connections_before = server.connections
+    with app.app_context():
+        pooled = run('pooled keep-alive session', request_llm_completion, llm, args.calls, args.threads)
+        close_llm_clients()
+    print(f"connections opened: {connections_before} -> {server.connections - connections_before}")
+    print(f"per-call latency: {baseline:.1f} ms -> {pooled:.1f} ms ({baseline / pooled:.1f}x)")
+    server.stop()
+
+if __name__ == '__main__':
+    main()
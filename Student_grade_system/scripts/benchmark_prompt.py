@@ -0,0 +1,72 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tests'))
+import argparse
+import random
+import time
+from types import SimpleNamespace
+
+from wtf_app_simple import app, build_ai_comment_prompt, estimate_tokens, request_llm_completion, close_llm_clients, \
+    AI_COMMENT_SYSTEM_PROMPT, AI_COMMENT_NAME_PLACEHOLDER
+from mock_llm import MockLLMServer
+
+# 评语提示词对比: 逐题列出 (旧实现) vs 按模块/知识点汇总并限制 token 预算
+# 本地 OpenAI 兼容替身按提示词长度增加响应时间 (--prefill-ms-per-100-chars), 模拟模型预填充开销
+# 用法: python scripts/benchmark_prompt.py --questions 80 --calls 10
+
+def legacy_prompt(template_name, grade_level, total, questions, score_by_question):
+    """旧实现: 每道题一条 "题目N(知识点): x/y" """
+    score_details = [f"题目{q.question_number}({q.knowledge_point}): {score_by_question[q.id]}/{q.score}"
+                     for q in questions if q.id in score_by_question]
+    return f"""
+    请根据以下学生考试数据生成一段简短的评语（200字以内），包含优点和改进建议。
+    
+    学生姓名：{AI_COMMENT_NAME_PLACEHOLDER}
+    考试名称：{template_name}
+    年级：{grade_level}
+    总分：{total}
+    
+    题目得分详情：
+    {"; ".join(score_details)}
+    """
+
+def run(label, prompt, llm, calls):
+    messages = [{'role': 'system', 'content': AI_COMMENT_SYSTEM_PROMPT}, {'role': 'user', 'content': prompt}]
+    start = time.perf_counter()
+    for _ in range(calls):
+        request_llm_completion(llm, messages)
+    mean_ms = (time.perf_counter() - start) / calls * 1000
+    tokens = estimate_tokens(AI_COMMENT_SYSTEM_PROMPT) + estimate_tokens(prompt)
+    print(f"{label:<28} {len(prompt):6d} chars  ~{tokens:5d} tokens  {mean_ms:7.1f} ms/call")
+    return tokens, mean_ms
+
+def main():
+    parser = argparse.ArgumentParser(description='AI comment prompt size / latency benchmark')
+    parser.add_argument('--questions', type=int, default=80)
+    parser.add_argument('--modules', type=int, default=8)
+    parser.add_argument('--knowledge-points', type=int, default=30)
+    parser.add_argument('--calls', type=int, default=10)
+    parser.add_argument('--prefill-ms-per-100-chars', type=float, default=5.0)
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    questions = [SimpleNamespace(id=i, question_number=str(i + 1), module=f"模块{i % args.modules}",
+                                 knowledge_point=f"知识点{i % args.knowledge_points}", score=2.5)
+                 for i in range(args.questions)]
+    score_by_question = {q.id: rng.choice([0, 0.5, 1, 1.5, 2, 2.5]) for q in questions}
+
+    server = MockLLMServer(prefill_delay=args.prefill_ms_per_100_chars / 100000.0).start()
+    llm = {'provider': 'mock', 'api_key': 'benchmark', 'base_url': server.base_url, 'model': 'mock'}
+
+    print(f"{args.questions} questions, {args.modules} modules, {args.knowledge_points} knowledge points, {args.calls} calls each")
+    with app.app_context():
+        old_tokens, old_ms = run('per-question (old)', legacy_prompt('期中数学', 'G5', sum(score_by_question.values()), questions, score_by_question), llm, args.calls)
+        new_tokens, new_ms = run('aggregated, token-budgeted', build_ai_comment_prompt('期中数学', 'G5', questions, score_by_question), llm, args.calls)
+        close_llm_clients()
+    print(f"prompt tokens: {old_tokens} -> {new_tokens} ({old_tokens / new_tokens:.1f}x smaller), "
+          f"latency: {old_ms:.1f} -> {new_ms:.1f} ms/call")
+    server.stop()
+
+if __name__ == '__main__':
+    main()
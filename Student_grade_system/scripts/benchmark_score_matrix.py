@@ -0,0 +1,105 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import argparse
+import random
+import shutil
+import tempfile
+import time
+from datetime import datetime
+
+from wtf_app_simple import app, db, ExamTemplate, ExamSession, Student, ExamRegistration, Question, Score, User, School, Subject
+
+# 整卷成绩录入对比: 每名考生提交一次 /api/score-entry/save (表单逐个保存) vs 一次 /api/score-entry/matrix
+# 使用临时 SQLite 文件数据库, 两种方式写入同一份随机成绩
+# 用法: python scripts/benchmark_score_matrix.py --students 300 --questions 60
+
+def seed(students, questions):
+    db.session.add(Subject(id=1, name="Math", code="MATH", type="math"))
+    school = School(name="Benchmark School", code="BS001")
+    session_obj = ExamSession(name="Benchmark Session", exam_date=datetime(2025, 1, 1).date(), location="Hall",
+                              session_type="morning", start_time="09:00", end_time="11:00")
+    template = ExamTemplate(name="Benchmark Template", grade_level="G5", subject_id=1, total_questions=questions)
+    user = User(username="admin", role="admin")
+    user.set_password("password")
+    db.session.add_all([school, session_obj, template, user])
+    db.session.commit()
+
+    db.session.bulk_insert_mappings(Question, [
+        {'exam_template_id': template.id, 'question_number': str(i + 1), 'score': 5.0, 'module': f"模块{i % 6}"}
+        for i in range(questions)])
+    db.session.bulk_insert_mappings(Student, [
+        {'name': f"Student {i}", 'student_id': f"B{i:04d}", 'gender': 'M', 'school_id': school.id, 'grade_level': 'G5'}
+        for i in range(students)])
+    db.session.commit()
+    student_rows = db.session.query(Student.id, Student.student_id).order_by(Student.id).all()
+    db.session.bulk_insert_mappings(ExamRegistration, [
+        {'student_id': s_id, 'exam_session_id': session_obj.id, 'exam_template_id': template.id, 'score_revision': 0}
+        for s_id, _ in student_rows])
+    db.session.commit()
+    question_ids = [q_id for q_id, in db.session.query(Question.id).order_by(Question.id)]
+    return template.name, student_rows, question_ids
+
+def reset_scores():
+    Score.query.delete()
+    db.session.commit()
+
+def timed(label, send):
+    start = time.perf_counter()
+    requests = send()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<34} {requests:5d} requests  {elapsed:8.2f}s")
+    return elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description='Whole-template score entry benchmark')
+    parser.add_argument('--students', type=int, default=300)
+    parser.add_argument('--questions', type=int, default=60)
+    args = parser.parse_args()
+
+    temp_dir = tempfile.mkdtemp()
+    app.config.update(
+        TESTING=True, WTF_CSRF_ENABLED=False,
+        SQLALCHEMY_DATABASE_URI='sqlite:///' + os.path.join(temp_dir, 'benchmark.db'),
+        REPORT_CARD_CACHE_DIR=os.path.join(temp_dir, 'cache')
+    )
+    rng = random.Random(42)
+    with app.app_context():
+        db.create_all()
+        template_name, student_rows, question_ids = seed(args.students, args.questions)
+        matrix = [[rng.choice([0, 1, 2, 2.5, 3, 4, 5]) for _ in question_ids] for _ in student_rows]
+        client = app.test_client()
+        client.post('/login', data=dict(username='admin', password='password'))
+
+        def per_student():
+            for (s_id, _), values in zip(student_rows, matrix):
+                resp = client.post('/api/score-entry/save', json={
+                    'student_id': s_id, 'template_name': template_name,
+                    'scores': {str(q_id): v for q_id, v in zip(question_ids, values)}
+                })
+                assert resp.json['success'], resp.json
+            return len(student_rows)
+
+        def one_matrix():
+            resp = client.post('/api/score-entry/matrix', json={
+                'template_name': template_name,
+                'columns': [str(i + 1) for i in range(len(question_ids))],
+                'rows': [[code] + values for (_, code), values in zip(student_rows, matrix)]
+            })
+            assert resp.json['success'] and not resp.json['errors'], resp.json
+            assert resp.json['written'] == len(student_rows) * len(question_ids)
+            return 1
+
+        print(f"{args.students} students x {args.questions} questions = {args.students * args.questions} cells")
+        baseline = timed('one save per student (form)', per_student)
+        assert Score.query.count() == args.students * args.questions
+        reset_scores()
+        bulk = timed('one matrix request', one_matrix)
+        assert Score.query.count() == args.students * args.questions
+        print(f"speedup: {baseline / bulk:.1f}x")
+        db.session.remove()
+
+    shutil.rmtree(temp_dir, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import argparse
+import io
+import smtplib
+import socketserver
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from wtf_app_simple import app, send_email_with_attachment, get_mail_pool
+
+# SMTP 发送吞吐基准: 每封新建连接 (旧实现) vs 连接池
+# 本地 SMTP 替身 (不依赖 aiosmtpd), --handshake-ms 模拟 TCP/STARTTLS/AUTH 的握手开销
+# 用法: python scripts/benchmark_smtp.py --messages 200 --handshake-ms 50 --threads 4
+
+class SMTPSinkHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        time.sleep(self.server.handshake_delay)
+        self.reply('220 localhost benchmark sink')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode(errors='replace').strip().upper()
+            if command.startswith('EHLO'):
+                self.reply('250-localhost')
+                self.reply('250-PIPELINING')
+                self.reply('250 SIZE 33554432')
+            elif command.startswith('HELO') or command.startswith('MAIL') or command.startswith('RCPT') \
+                    or command.startswith('RSET') or command.startswith('NOOP'):
+                self.reply('250 OK')
+            elif command == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                while self.rfile.readline() not in (b'.\r\n', b''):
+                    pass
+                time.sleep(self.server.message_delay)
+                with self.server.lock:
+                    self.server.received += 1
+                self.reply('250 OK queued')
+            elif command == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('502 Command not implemented')
+
+class SMTPSink(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, handshake_delay=0.0, message_delay=0.0):
+        super().__init__(('127.0.0.1', 0), SMTPSinkHandler)
+        self.handshake_delay = handshake_delay
+        self.message_delay = message_delay
+        self.lock = threading.Lock()
+        self.received = 0
+
+def send_with_new_connection(to_email, subject, body, attachment, filename):
+    """旧实现: 每封邮件新建连接"""
+    from email.mime.application import MIMEApplication
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+    msg = MIMEMultipart()
+    msg['From'] = app.config['MAIL_DEFAULT_SENDER']
+    msg['To'] = to_email
+    msg['Subject'] = subject
+    msg.attach(MIMEText(body, 'plain'))
+    part = MIMEApplication(attachment.getvalue(), Name=filename)
+    part['Content-Disposition'] = f'attachment; filename="{filename}"'
+    msg.attach(part)
+    server = smtplib.SMTP(app.config['MAIL_SERVER'], app.config['MAIL_PORT'])
+    server.send_message(msg)
+    server.quit()
+    return True, 'ok'
+
+def run(label, send, messages, threads, attachment):
+    def one(i):
+        ok, msg = send(f"student{i}@example.com", f"Score Report {i}", "Please find attached your score report.",
+                       io.BytesIO(attachment), f"ReportCard_{i}.pdf")
+        if not ok:
+            raise RuntimeError(msg)
+
+    start = time.perf_counter()
+    if threads <= 1:
+        for i in range(messages):
+            one(i)
+    else:
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            list(executor.map(one, range(messages)))
+    elapsed = time.perf_counter() - start
+    print(f"{label:<34} {elapsed:8.2f}s  {messages / elapsed:8.1f} msg/s")
+    return elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description='SMTP throughput benchmark')
+    parser.add_argument('--messages', type=int, default=200)
+    parser.add_argument('--handshake-ms', type=float, default=50.0, help='simulated connect + STARTTLS + AUTH cost')
+    parser.add_argument('--message-ms', type=float, default=2.0, help='simulated per-message server time')
+    parser.add_argument('--attachment-kb', type=int, default=80)
+    parser.add_argument('--threads', type=int, default=4)
+    args = parser.parse_args()
+
+    sink = SMTPSink(args.handshake_ms / 1000.0, args.message_ms / 1000.0)
+    threading.Thread(target=sink.serve_forever, daemon=True).start()
+
+    app.config.update(
+        MAIL_SERVER='127.0.0.1', MAIL_PORT=sink.server_address[1], MAIL_USE_TLS=False,
+        MAIL_USERNAME='', MAIL_PASSWORD='', MAIL_POOL_SIZE=args.threads
+    )
+    attachment = b'%PDF-1.4\n' + os.urandom(args.attachment_kb * 1024)
+
+    print(f"{args.messages} messages, {args.attachment_kb} KB attachment, "
+          f"handshake {args.handshake_ms} ms, server {args.message_ms} ms/message")
+    baseline = run('new connection per message', send_with_new_connection, args.messages, 1, attachment)
+    with app.app_context():
+        app.config['MAIL_POOL_SIZE'] = 1
+        pooled = run('pooled, 1 connection', send_email_with_attachment, args.messages, 1, attachment)
+        app.config['MAIL_POOL_SIZE'] = args.threads
+        threaded = run(f'pooled, {args.threads} connections/threads', send_email_with_attachment, args.messages, args.threads, attachment)
+        print(f"pool stats: {get_mail_pool().stats}")
+
+    print(f"speedup: {baseline / pooled:.1f}x (1 connection), {baseline / threaded:.1f}x ({args.threads} connections)")
+    assert sink.received == args.messages * 3, sink.received
+    sink.shutdown()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,14 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from wtf_app_simple import app, run_email_sender
+
+# 发件箱投递进程: 按 EMAIL_RATE_PER_MINUTE 限速发送 email_outbox 中到期的邮件
+# 用法: python scripts/email_sender.py [--once]
+if __name__ == '__main__':
+    poll_interval = float(os.environ.get('EMAIL_POLL_INTERVAL', 2.0))
+    if '--once' in sys.argv:
+        run_email_sender(poll_interval, max_rounds=1)
+    else:
+        print(f"Email sender started (pid {os.getpid()})")
+        run_email_sender(poll_interval)
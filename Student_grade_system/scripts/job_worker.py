@@ -0,0 +1,15 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from wtf_app_simple import app, run_job_worker
+
+# 后台任务 worker: 轮询 background_jobs 表并执行批量PDF/邮件/AI评语任务
+# 用法: python scripts/job_worker.py [--once]
+if __name__ == '__main__':
+    poll_interval = float(os.environ.get('JOB_POLL_INTERVAL', 1.0))
+    if '--once' in sys.argv:
+        processed = run_job_worker(poll_interval, max_jobs=1)
+        print(f"Processed {processed} job(s)")
+    else:
+        print(f"Job worker started (pid {os.getpid()})")
+        run_job_worker(poll_interval)
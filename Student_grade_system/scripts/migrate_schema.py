@@ -1,51 +1,24 @@
 import sys
 import os
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-import sqlite3
-import os
-
-DB_PATH = 'wtf_exam_system.db'
 
-def migrate():
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
+from sqlalchemy import inspect
+from wtf_app_simple import app, db, SchemaMigration, SCHEMA_MIGRATIONS, create_tables
 
-    # 1. Create association table
-    print("Creating exam_template_sessions table...")
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS exam_template_sessions (
-        exam_template_id INTEGER NOT NULL,
-        exam_session_id INTEGER NOT NULL,
-        PRIMARY KEY (exam_template_id, exam_session_id),
-        FOREIGN KEY(exam_template_id) REFERENCES exam_templates(id),
-        FOREIGN KEY(exam_session_id) REFERENCES exam_sessions(id)
-    )
-    ''')
+# 执行数据库迁移 (建表 + SCHEMA_MIGRATIONS 中未执行的版本 + 默认账号/初始数据)
+# 容器启动时由 entrypoint.sh 在 gunicorn 之前运行一次; 升级后手动部署时同样先运行本脚本
+# 用法: python scripts/migrate_schema.py [--status]
 
-    # 2. Migrate existing data
-    print("Migrating data...")
-    # Check if exam_session_id column exists in exam_templates (it might not if this is re-run after model change, but we are accessing DB directly)
-    try:
-        cursor.execute('SELECT id, exam_session_id FROM exam_templates WHERE exam_session_id IS NOT NULL')
-        templates = cursor.fetchall()
-        
-        count = 0
-        for t_id, s_id in templates:
-            # Check if exists
-            cursor.execute('SELECT 1 FROM exam_template_sessions WHERE exam_template_id=? AND exam_session_id=?', (t_id, s_id))
-            if not cursor.fetchone():
-                cursor.execute('INSERT INTO exam_template_sessions (exam_template_id, exam_session_id) VALUES (?, ?)', (t_id, s_id))
-                count += 1
-        
-        print(f"Migrated {count} relationships.")
-    except Exception as e:
-        print(f"Migration warning: {e}")
-        
-    conn.commit()
-    conn.close()
+def print_status():
+    applied = {}
+    if inspect(db.engine).has_table(SchemaMigration.__tablename__):
+        applied = {m.version: m for m in SchemaMigration.query.all()}
+    for version, name, _ in SCHEMA_MIGRATIONS:
+        m = applied.get(version)
+        print(f"{version:>4}  {name:<45} {m.applied_at.strftime('%Y-%m-%d %H:%M:%S') if m else 'pending'}")
 
 if __name__ == '__main__':
-    if os.path.exists(DB_PATH):
-        migrate()
-    else:
-        print(f"Database {DB_PATH} not found.")
+    with app.app_context():
+        if '--status' not in sys.argv:
+            create_tables()
+        print_status()
@@ -22,6 +22,10 @@ pkill -f "port=8083" 2>/dev/null
 # 等待进程完全停止
 sleep 2
 
+# 执行数据库迁移
+echo "🗄️ 执行数据库迁移..."
+python3 scripts/migrate_schema.py || exit 1
+
 # 在8083端口启动应用
 echo "🌐 启动应用在8083端口..."
 nohup python3 -c "
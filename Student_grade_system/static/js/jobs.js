@@ -0,0 +1,65 @@
+/**
+ * 后台任务 (批量成绩单 / 全量导出等)
+ * 接口返回 202 + job_id 时轮询 /api/jobs/<id>, 完成后下载结果; 直接返回文件时按原方式下载
+ */
+
+function saveBlob(blob, filename) {
+    const url = window.URL.createObjectURL(blob);
+    const a = document.createElement('a');
+    a.href = url;
+    a.download = filename;
+    document.body.appendChild(a);
+    a.click();
+    window.URL.revokeObjectURL(url);
+    document.body.removeChild(a);
+}
+
+function waitForJob(jobId, onProgress) {
+    return new Promise((resolve, reject) => {
+        const poll = () => {
+            fetch(`/api/jobs/${jobId}`)
+                .then(response => response.json())
+                .then(data => {
+                    if (!data.success) throw new Error(data.message || '任务查询失败');
+                    const job = data.job;
+                    if (onProgress) onProgress(job);
+                    if (job.status === 'succeeded') {
+                        resolve(job);
+                    } else if (job.status === 'failed' || job.status === 'cancelled') {
+                        reject(new Error(job.error || job.message || '任务失败'));
+                    } else {
+                        setTimeout(poll, 1500);
+                    }
+                })
+                .catch(reject);
+        };
+        poll();
+    });
+}
+
+// request: fetch(...) 的 Promise; fallbackName: 接口直接返回文件时的下载文件名
+function runDownloadJob(request, fallbackName, onProgress) {
+    return request.then(response => {
+        if (response.status === 202) {
+            return response.json()
+                .then(data => waitForJob(data.job_id, onProgress))
+                .then(job => {
+                    if (job.has_download) window.location.href = `/api/jobs/${job.id}/download`;
+                    return job;
+                });
+        }
+        if (response.ok) {
+            return response.blob().then(blob => saveBlob(blob, fallbackName));
+        }
+        return response.json()
+            .catch(() => ({}))
+            .then(data => { throw new Error(data.message || '导出失败'); });
+    });
+}
+
+// 在 SweetAlert 加载框中显示任务进度
+function showJobProgress(job) {
+    const text = job.status === 'pending' ? '任务排队中...' :
+        `${job.message || '处理中'} (${job.progress.current}/${job.progress.total})`;
+    if (Swal.isVisible()) Swal.update({ text: text });
+}
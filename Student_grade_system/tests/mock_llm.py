@@ -0,0 +1,100 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class MockLLMHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        # New TCP connection: count it and charge the simulated TLS handshake
+        with self.server.lock:
+            self.server.connections += 1
+        time.sleep(self.server.handshake_delay)
+
+    def do_POST(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        request = json.loads(body or b'{}')
+        with server.lock:
+            server.requests.append(request)
+            server.active += 1
+            server.peak = max(server.peak, server.active)
+        try:
+            if request.get('stream') and server.status == 200:
+                self.send_stream(request)
+                return
+            prompt_chars = sum(len(m.get('content') or '') for m in request.get('messages', []))
+            time.sleep(server.delay + prompt_chars * server.prefill_delay)
+            if server.status != 200:
+                payload = json.dumps({'error': 'mock failure'}).encode()
+                self.send_response(server.status)
+            else:
+                reply = server.reply(request) if callable(server.reply) else server.reply
+                payload = json.dumps({
+                    'choices': [{'message': {'role': 'assistant', 'content': reply}}],
+                    # Characters stand in for tokens
+                    'usage': {'prompt_tokens': prompt_chars, 'completion_tokens': len(reply)}
+                }, ensure_ascii=False).encode()
+                self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    def send_stream(self, request):
+        """stream=true: reply split into SSE chunks, the total delay spread across them"""
+        server = self.server
+        reply = server.reply(request) if callable(server.reply) else server.reply
+        pieces = [reply[i:i + server.stream_chunk_size] for i in range(0, len(reply), server.stream_chunk_size)]
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        events = [{'choices': [{'delta': {'content': piece}}]} for piece in pieces]
+        for index, event in enumerate(events + [None]):
+            if index < len(pieces):
+                time.sleep(server.delay / len(pieces))
+            data = b'data: [DONE]\n\n' if event is None else f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode()
+            self.wfile.write(f"{len(data):x}\r\n".encode() + data + b'\r\n')
+            self.wfile.flush()
+        self.wfile.write(b'0\r\n\r\n')
+
+class MockLLMServer(ThreadingHTTPServer):
+    """OpenAI-compatible /chat/completions stand-in on 127.0.0.1 (random port)."""
+    daemon_threads = True
+
+    def __init__(self, reply='这是一段测试评语。', delay=0.0, status=200, handshake_delay=0.0, stream_chunk_size=4, prefill_delay=0.0):
+        super().__init__(('127.0.0.1', 0), MockLLMHandler)
+        self.reply = reply
+        self.delay = delay
+        self.status = status
+        self.handshake_delay = handshake_delay
+        self.stream_chunk_size = stream_chunk_size
+        # Seconds per prompt character: longer prompts answer later, like a real model's prefill
+        self.prefill_delay = prefill_delay
+        self.lock = threading.Lock()
+        self.requests = []
+        self.active = 0
+        self.peak = 0
+        self.connections = 0
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,117 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import unittest
+from datetime import datetime
+
+from wtf_app_simple import app, db, ExamTemplate, ExamSession, Student, ExamRegistration, Question, Score, User, School, Subject, \
+    SystemSetting, AICommentHistory, BackgroundJob, run_job_worker, MAX_GENERATIONS
+from mock_llm import MockLLMServer
+
+class TestAICommentBatch(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
+        app.config['WTF_CSRF_ENABLED'] = False
+        self.saved_config = {k: app.config[k] for k in ('LLM_BATCH_CONCURRENCY', 'LLM_RATE_PER_MINUTE')}
+        app.config.update(LLM_BATCH_CONCURRENCY=4, LLM_RATE_PER_MINUTE=0)
+        self.llm = MockLLMServer(delay=0.1).start()
+        self.app = app.test_client()
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+        db.session.add(Subject(id=1, name="Math", code="MATH", type="math"))
+        db.session.add(SystemSetting(llm_api_key='test-key', llm_api_base_url=self.llm.base_url, llm_model='mock'))
+        school = School(name="Test School", code="TS001")
+        session_obj = ExamSession(name="AI Session", exam_date=datetime(2025, 1, 1).date(), location="Test Loc", session_type="morning", start_time="09:00", end_time="11:00")
+        self.template = ExamTemplate(name="AI Template", grade_level="G1", subject_id=1, total_questions=2)
+        db.session.add_all([school, session_obj, self.template])
+        db.session.commit()
+
+        questions = [Question(exam_template_id=self.template.id, question_number=str(n), score=5.0, knowledge_point=f"KP{n}") for n in (1, 2)]
+        db.session.add_all(questions)
+        db.session.commit()
+
+        # 0-7: complete, 8: incomplete, 9: complete but quota used up
+        self.registrations = []
+        for i in range(10):
+            student = Student(name=f"Student {i}", student_id=f"AI{i:03d}", gender="M", school_id=school.id, grade_level="G1")
+            db.session.add(student)
+            db.session.flush()
+            reg = ExamRegistration(student_id=student.id, exam_session_id=session_obj.id, exam_template_id=self.template.id)
+            db.session.add(reg)
+            db.session.flush()
+            for q in (questions if i != 8 else questions[:1]):
+                # Distinct score vectors: every student needs its own LLM call
+                db.session.add(Score(student_id=student.id, question_id=q.id, score=i / 2, is_correct=False))
+            if i == 9:
+                for v in range(1, MAX_GENERATIONS + 1):
+                    db.session.add(AICommentHistory(registration_id=reg.id, version=v, content=f"v{v}"))
+            self.registrations.append(reg)
+
+        self.registration_ids = [reg.id for reg in self.registrations]
+
+        user = User(username="admin", role="admin")
+        user.set_password("password")
+        db.session.add(user)
+        db.session.commit()
+
+        self.app.post('/login', data=dict(username='admin', password='password'))
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        self.llm.stop()
+        app.config.update(self.saved_config)
+
+    def test_batch_generates_drafts_concurrently_within_quota(self):
+        resp = self.app.post('/api/ai-comment/batch-generate', json={'template_name': 'AI Template'})
+        self.assertEqual(resp.status_code, 202)
+        self.assertEqual(resp.json['counts']['eligible'], 8)
+        self.assertEqual(resp.json['counts']['skipped_incomplete'], 1)
+        self.assertEqual(resp.json['counts']['skipped_quota'], 1)
+
+        run_job_worker(poll_interval=0, max_jobs=1)
+
+        job = self.app.get(f"/api/jobs/{resp.json['job_id']}").json['job']
+        self.assertEqual(job['status'], 'succeeded')
+        self.assertEqual(job['result']['generated'], 8)
+        self.assertEqual(job['progress']['current'], 8)
+        # Keep-alive pool: one connection per concurrent call, not one per comment
+        self.assertLessEqual(self.llm.connections, 4)
+        self.assertEqual(self.llm.peak, 4)
+
+        drafts = AICommentHistory.query.filter_by(status='draft', content='这是一段测试评语。').all()
+        self.assertEqual(sorted(d.registration_id for d in drafts), sorted(self.registration_ids[:8]))
+        self.assertEqual(AICommentHistory.query.filter_by(registration_id=self.registration_ids[9]).count(), MAX_GENERATIONS)
+
+        # Re-running skips registrations that already have a draft
+        resp = self.app.post('/api/ai-comment/batch-generate', json={'template_name': 'AI Template'})
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(resp.json['counts']['skipped_existing'], 8)
+
+    def test_rate_limiter_spaces_provider_calls(self):
+        app.config.update(LLM_RATE_PER_MINUTE=600, LLM_BATCH_CONCURRENCY=1)
+        self.llm.delay = 0
+        resp = self.app.post('/api/ai-comment/batch-generate', json={'template_name': 'AI Template'})
+
+        start = datetime.utcnow()
+        run_job_worker(poll_interval=0, max_jobs=1)
+        elapsed = (datetime.utcnow() - start).total_seconds()
+
+        # 8 calls at 10/s with a burst of 1 take at least 0.7s
+        self.assertGreaterEqual(elapsed, 0.65)
+        self.assertEqual(BackgroundJob.query.get(resp.json['job_id']).status, 'succeeded')
+
+    def test_single_generate_route_unchanged(self):
+        resp = self.app.post('/api/ai-comment/generate', json={'registration_id': self.registration_ids[0]})
+        self.assertTrue(resp.json['success'])
+        self.assertEqual(resp.json['remaining_quota'], MAX_GENERATIONS - 1)
+
+        resp = self.app.post('/api/ai-comment/generate', json={'registration_id': self.registration_ids[9]})
+        self.assertEqual(resp.json['error'], 'quota_exceeded')
+
+if __name__ == '__main__':
+    unittest.main()
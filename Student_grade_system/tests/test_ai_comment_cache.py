@@ -0,0 +1,148 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import json
+import unittest
+from datetime import datetime
+
+from wtf_app_simple import app, db, ExamTemplate, ExamSession, Student, ExamRegistration, Question, Score, User, School, Subject, \
+    SystemSetting, AICommentHistory, AICommentCache, AI_COMMENT_NAME_PLACEHOLDER, run_job_worker, close_llm_clients
+from mock_llm import MockLLMServer
+
+REPLY = f"{AI_COMMENT_NAME_PLACEHOLDER}同学本次计算准确，建议加强应用题审题。"
+
+class TestAICommentCache(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
+        app.config['WTF_CSRF_ENABLED'] = False
+        self.saved_config = {k: app.config[k] for k in ('AI_COMMENT_CACHE_ENABLED', 'AI_COMMENT_CACHE_MAX_ENTRIES', 'LLM_RATE_PER_MINUTE')}
+        app.config.update(AI_COMMENT_CACHE_ENABLED=True, LLM_RATE_PER_MINUTE=0)
+        self.llm = MockLLMServer(reply=REPLY, stream_chunk_size=3).start()
+        self.app = app.test_client()
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+        db.session.add(Subject(id=1, name="Math", code="MATH", type="math"))
+        db.session.add(SystemSetting(llm_api_key='test-key', llm_api_base_url=self.llm.base_url, llm_model='mock'))
+        school = School(name="Test School", code="TS001")
+        session_obj = ExamSession(name="Cache Session", exam_date=datetime(2025, 1, 1).date(), location="Test Loc", session_type="morning", start_time="09:00", end_time="11:00")
+        self.template = ExamTemplate(name="Cache Template", grade_level="G1", subject_id=1, total_questions=2)
+        db.session.add_all([school, session_obj, self.template])
+        db.session.commit()
+
+        questions = [Question(exam_template_id=self.template.id, question_number=str(n), score=5.0, knowledge_point=f"KP{n}") for n in (1, 2)]
+        db.session.add_all(questions)
+        db.session.commit()
+
+        # Students 0-3 share one score vector, 4-5 share another
+        self.registration_ids = []
+        for i in range(6):
+            student = Student(name=f"学生{i}", student_id=f"CC{i:03d}", gender="M", school_id=school.id, grade_level="G1")
+            db.session.add(student)
+            db.session.flush()
+            reg = ExamRegistration(student_id=student.id, exam_session_id=session_obj.id, exam_template_id=self.template.id)
+            db.session.add(reg)
+            db.session.flush()
+            for q in questions:
+                # Same value stored with different float spelling still normalises to one key
+                db.session.add(Score(student_id=student.id, question_id=q.id, score=(4.0 if i % 2 else 4) if i < 4 else 2.5, is_correct=False))
+            self.registration_ids.append(reg.id)
+
+        user = User(username="admin", role="admin")
+        user.set_password("password")
+        db.session.add(user)
+        db.session.commit()
+
+        self.app.post('/login', data=dict(username='admin', password='password'))
+
+    def tearDown(self):
+        close_llm_clients()
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        self.llm.stop()
+        app.config.update(self.saved_config)
+
+    def generate(self, index, **extra):
+        return self.app.post('/api/ai-comment/generate', json=dict(registration_id=self.registration_ids[index], **extra)).json
+
+    def test_identical_scores_reuse_text_with_student_name(self):
+        first = self.generate(0)
+        second = self.generate(1)
+
+        self.assertFalse(first['cached'])
+        self.assertTrue(second['cached'])
+        self.assertEqual(len(self.llm.requests), 1)
+        self.assertNotIn('学生0', json.dumps(self.llm.requests[0], ensure_ascii=False))
+        self.assertEqual(first['comment']['content'], REPLY.replace(AI_COMMENT_NAME_PLACEHOLDER, '学生0'))
+        self.assertEqual(second['comment']['content'], REPLY.replace(AI_COMMENT_NAME_PLACEHOLDER, '学生1'))
+
+        # A different score vector is a miss
+        self.assertFalse(self.generate(4)['cached'])
+        self.assertEqual(len(self.llm.requests), 2)
+
+        stats = self.app.get('/api/ai-comment/cache').json
+        self.assertEqual(stats['entries'], 2)
+        self.assertEqual(stats['total_hits'], 1)
+
+    def test_fresh_and_regeneration_bypass_cache(self):
+        self.generate(0)
+        self.assertFalse(self.generate(1, fresh=True)['cached'])
+        # Second version for the same student is always a new completion
+        self.assertFalse(self.generate(0)['cached'])
+        self.assertEqual(len(self.llm.requests), 3)
+        self.assertTrue(self.generate(2)['cached'])
+
+    def test_stream_substitutes_name_across_chunk_boundaries(self):
+        resp = self.app.post('/api/ai-comment/generate', json={'registration_id': self.registration_ids[0], 'stream': True})
+        deltas = [json.loads(block.split('data: ', 1)[1])['text'] for block in resp.data.decode('utf-8').split('\n\n')
+                  if block.startswith('event: delta')]
+        self.assertEqual(''.join(deltas), REPLY.replace(AI_COMMENT_NAME_PLACEHOLDER, '学生0'))
+
+        resp = self.app.post('/api/ai-comment/generate', json={'registration_id': self.registration_ids[1], 'stream': True})
+        self.assertIn('"cached": true', resp.data.decode('utf-8'))
+        self.assertEqual(len(self.llm.requests), 1)
+
+    def test_batch_calls_llm_once_per_score_vector(self):
+        resp = self.app.post('/api/ai-comment/batch-generate', json={'template_name': 'Cache Template'})
+        run_job_worker(poll_interval=0, max_jobs=1)
+
+        result = self.app.get(f"/api/jobs/{resp.json['job_id']}").json['job']['result']
+        self.assertEqual(result['generated'], 6)
+        self.assertEqual(result['llm_calls'], 2)
+        self.assertEqual(len(self.llm.requests), 2)
+        names = {h.registration.student.name: h.content for h in AICommentHistory.query.all()}
+        self.assertEqual(names['学生5'], REPLY.replace(AI_COMMENT_NAME_PLACEHOLDER, '学生5'))
+
+    def test_fallback_answers_are_not_cached_under_primary_model(self):
+        fallback = MockLLMServer(reply=REPLY).start()
+        try:
+            setting = SystemSetting.query.first()
+            setting.llm_fallback_providers = json.dumps([{'base_url': fallback.base_url, 'model': 'mock-fallback'}])
+            db.session.commit()
+            self.llm.status = 503
+
+            self.assertFalse(self.generate(0)['cached'])
+            self.assertEqual(AICommentCache.query.count(), 0)
+            self.assertFalse(self.generate(1)['cached'])
+            self.assertEqual(len(fallback.requests), 2)
+
+            # Once the primary answers again its text is cached as usual
+            self.llm.status = 200
+            self.generate(2)
+            self.assertEqual(AICommentCache.query.one().model, 'mock')
+        finally:
+            fallback.stop()
+
+    def test_entries_bounded_least_recently_used_first(self):
+        app.config['AI_COMMENT_CACHE_MAX_ENTRIES'] = 1
+        self.generate(0)
+        first_key = AICommentCache.query.one().cache_key
+        self.generate(4)
+        self.assertEqual(AICommentCache.query.count(), 1)
+        self.assertNotEqual(AICommentCache.query.one().cache_key, first_key)
+
+if __name__ == '__main__':
+    unittest.main()
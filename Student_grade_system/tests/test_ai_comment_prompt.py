@@ -0,0 +1,54 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import unittest
+from types import SimpleNamespace
+
+from wtf_app_simple import app, build_ai_comment_prompt, estimate_tokens, AI_COMMENT_NAME_PLACEHOLDER
+
+def make_questions(count, modules=8, knowledge_points=25):
+    return [SimpleNamespace(id=i, question_number=str(i + 1), module=f"模块{i % modules}",
+                            knowledge_point=f"知识点{i % knowledge_points}", score=2.0) for i in range(count)]
+
+class TestAICommentPrompt(unittest.TestCase):
+    def setUp(self):
+        self.app_context = app.app_context()
+        self.app_context.push()
+
+    def tearDown(self):
+        self.app_context.pop()
+
+    def test_aggregates_instead_of_listing_questions(self):
+        questions = make_questions(4, modules=2, knowledge_points=4)
+        scores = {0: 2.0, 1: 0.0, 2: 2.0, 3: 1.0}
+        prompt = build_ai_comment_prompt("期中", "G5", questions, scores)
+
+        self.assertIn(AI_COMMENT_NAME_PLACEHOLDER, prompt)
+        self.assertIn("总分：5/8（62%）", prompt)
+        self.assertIn("模块得分率：模块1 25%（1/4）；模块0 100%（4/4）", prompt)
+        self.assertIn("薄弱知识点：知识点1 0%；知识点3 50%", prompt)
+        self.assertIn("优势知识点：知识点0 100%；知识点2 100%", prompt)
+        self.assertNotIn("题目", prompt)
+
+    def test_missing_scores_do_not_count_as_zero(self):
+        questions = make_questions(2, modules=1, knowledge_points=2)
+        prompt = build_ai_comment_prompt("期中", "G5", questions, {0: 2.0})
+        self.assertIn("未录入成绩：1题", prompt)
+        self.assertNotIn("知识点1", prompt)
+        self.assertIn("模块0 100%", prompt)
+
+    def test_long_templates_stay_within_budget(self):
+        for count in (80, 400):
+            questions = make_questions(count)
+            scores = {q.id: (q.id * 7) % 5 / 2 for q in questions}
+            prompt = build_ai_comment_prompt("期中", "G5", questions, scores, token_budget=250)
+            self.assertLessEqual(estimate_tokens(prompt), 250)
+            self.assertIn("薄弱知识点", prompt)
+
+        # A tight budget drops the lower-priority sections first
+        tight = build_ai_comment_prompt("期中", "G5", questions, scores, token_budget=90)
+        self.assertLessEqual(estimate_tokens(tight), 90)
+        self.assertNotIn("优势知识点", tight)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import json
+import time
+import unittest
+from datetime import datetime
+
+from wtf_app_simple import app, db, ExamTemplate, ExamSession, Student, ExamRegistration, Question, Score, User, School, Subject, \
+    SystemSetting, AICommentHistory, MAX_GENERATIONS, close_llm_clients
+from mock_llm import MockLLMServer
+
+REPLY = '该生基础扎实，计算准确，建议加强应用题的审题训练。'
+
+def parse_events(raw):
+    events = []
+    for block in raw.decode('utf-8').split('\n\n'):
+        if not block.strip():
+            continue
+        lines = dict(line.split(': ', 1) for line in block.split('\n'))
+        events.append((lines['event'], json.loads(lines['data'])))
+    return events
+
+class TestAICommentStream(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
+        app.config['WTF_CSRF_ENABLED'] = False
+        # 2s of "model time" spread over the streamed chunks
+        self.llm = MockLLMServer(reply=REPLY, delay=2.0, stream_chunk_size=2).start()
+        self.app = app.test_client()
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+        db.session.add(Subject(id=1, name="Math", code="MATH", type="math"))
+        db.session.add(SystemSetting(llm_api_key='test-key', llm_api_base_url=self.llm.base_url, llm_model='mock'))
+        school = School(name="Test School", code="TS001")
+        session_obj = ExamSession(name="Stream Session", exam_date=datetime(2025, 1, 1).date(), location="Test Loc", session_type="morning", start_time="09:00", end_time="11:00")
+        template = ExamTemplate(name="Stream Template", grade_level="G1", subject_id=1, total_questions=1)
+        db.session.add_all([school, session_obj, template])
+        db.session.commit()
+
+        question = Question(exam_template_id=template.id, question_number="1", score=10.0, knowledge_point="KP1")
+        student = Student(name="Student S", student_id="ST001", gender="M", school_id=school.id, grade_level="G1")
+        db.session.add_all([question, student])
+        db.session.flush()
+        registration = ExamRegistration(student_id=student.id, exam_session_id=session_obj.id, exam_template_id=template.id)
+        db.session.add_all([registration, Score(student_id=student.id, question_id=question.id, score=8.0, is_correct=False)])
+
+        user = User(username="admin", role="admin")
+        user.set_password("password")
+        db.session.add(user)
+        db.session.commit()
+        self.registration_id = registration.id
+
+        self.app.post('/login', data=dict(username='admin', password='password'))
+
+    def tearDown(self):
+        close_llm_clients()
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        self.llm.stop()
+
+    def test_stream_forwards_deltas_and_saves_draft(self):
+        start = time.perf_counter()
+        resp = self.app.post('/api/ai-comment/generate', json={'registration_id': self.registration_id, 'stream': True}, buffered=False)
+        self.assertEqual(resp.mimetype, 'text/event-stream')
+
+        chunks = iter(resp.response)
+        first = next(chunks)
+        first_text_at = time.perf_counter() - start
+        raw = first + b''.join(chunks)
+        resp.close()
+
+        self.assertLess(first_text_at, 0.5)
+        self.assertTrue(self.llm.requests[0]['stream'])
+
+        events = parse_events(raw)
+        deltas = [data['text'] for name, data in events if name == 'delta']
+        self.assertGreater(len(deltas), 1)
+        self.assertEqual(''.join(deltas), REPLY)
+
+        name, done = events[-1]
+        self.assertEqual(name, 'done')
+        self.assertEqual(done['comment']['content'], REPLY)
+        self.assertEqual(done['remaining_quota'], MAX_GENERATIONS - 1)
+        self.assertEqual(AICommentHistory.query.filter_by(registration_id=self.registration_id).one().content, REPLY)
+
+    def test_quota_exceeded_is_plain_json_error(self):
+        for v in range(1, MAX_GENERATIONS + 1):
+            db.session.add(AICommentHistory(registration_id=self.registration_id, version=v, content=f"v{v}"))
+        db.session.commit()
+
+        resp = self.app.post('/api/ai-comment/generate', json={'registration_id': self.registration_id, 'stream': True})
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(resp.json['error'], 'quota_exceeded')
+        self.assertEqual(len(self.llm.requests), 0)
+
+    def test_provider_error_reported_as_event_without_saving(self):
+        self.llm.status = 500
+        self.llm.delay = 0
+        resp = self.app.post('/api/ai-comment/generate', json={'registration_id': self.registration_id, 'stream': True})
+        events = parse_events(resp.data)
+        self.assertEqual(events[-1][0], 'error')
+        self.assertEqual(AICommentHistory.query.filter_by(registration_id=self.registration_id).count(), 0)
+
+if __name__ == '__main__':
+    unittest.main()
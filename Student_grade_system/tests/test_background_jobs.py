@@ -0,0 +1,127 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import io
+import shutil
+import pandas as pd
+import tempfile
+import zipfile
+import unittest
+from datetime import datetime
+
+from wtf_app_simple import app, db, ExamTemplate, ExamSession, Student, ExamRegistration, Question, Score, User, School, Subject, \
+    BackgroundJob, run_job_worker
+
+class TestBackgroundJobs(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
+        app.config['WTF_CSRF_ENABLED'] = False
+        self.temp_dir = tempfile.mkdtemp()
+        app.config['REPORT_CARD_CACHE_DIR'] = os.path.join(self.temp_dir, 'cache')
+        app.config['JOB_RESULT_DIR'] = os.path.join(self.temp_dir, 'jobs')
+        self.app = app.test_client()
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+        db.session.add(Subject(id=1, name="Math", code="MATH", type="math"))
+        school = School(name="Test School", code="TS001")
+        self.session_obj = ExamSession(name="Job Session", exam_date=datetime(2025, 1, 1).date(), location="Test Loc", session_type="morning", start_time="09:00", end_time="11:00")
+        self.template = ExamTemplate(name="Job Template", grade_level="G1", subject_id=1, total_questions=1)
+        db.session.add_all([school, self.session_obj, self.template])
+        db.session.commit()
+
+        question = Question(exam_template_id=self.template.id, question_number="1", score=10.0, module="Module A")
+        db.session.add(question)
+        db.session.commit()
+
+        self.student_ids = []
+        for i in range(3):
+            student = Student(name=f"Student {i}", student_id=f"JS{i:03d}", gender="M", school_id=school.id, grade_level="G1")
+            db.session.add(student)
+            db.session.flush()
+            db.session.add(ExamRegistration(student_id=student.id, exam_session_id=self.session_obj.id, exam_template_id=self.template.id))
+            db.session.add(Score(student_id=student.id, question_id=question.id, score=8.0, is_correct=False))
+            self.student_ids.append(student.id)
+
+        user = User(username="admin", role="admin")
+        user.set_password("password")
+        db.session.add(user)
+        db.session.commit()
+
+        self.app.post('/login', data=dict(username='admin', password='password'))
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def submit_zip_job(self):
+        items = [{'student_id': s_id, 'exam_session_id': self.session_obj.id, 'template_id': self.template.id} for s_id in self.student_ids]
+        # Batch endpoints queue a job by default
+        resp = self.app.post('/api/pdf/batch-selected', json={'items': items})
+        self.assertEqual(resp.status_code, 202)
+        return resp.json['job_id']
+
+    def test_batch_endpoint_returns_job_and_worker_builds_zip(self):
+        job_id = self.submit_zip_job()
+
+        status = self.app.get(f'/api/jobs/{job_id}').json['job']
+        self.assertEqual(status['status'], 'pending')
+
+        self.assertEqual(run_job_worker(poll_interval=0, max_jobs=1), 1)
+
+        status = self.app.get(f'/api/jobs/{job_id}').json['job']
+        self.assertEqual(status['status'], 'succeeded')
+        self.assertEqual(status['progress']['current'], len(self.student_ids))
+        self.assertEqual(status['progress']['percent'], 100.0)
+        self.assertTrue(status['has_download'])
+
+        resp = self.app.get(f'/api/jobs/{job_id}/download')
+        self.assertEqual(resp.status_code, 200)
+        with zipfile.ZipFile(io.BytesIO(resp.data)) as zf:
+            self.assertEqual(len(zf.namelist()), len(self.student_ids))
+        resp.close()
+
+    def test_cancel_pending_job(self):
+        job_id = self.submit_zip_job()
+
+        resp = self.app.post(f'/api/jobs/{job_id}/cancel')
+        self.assertEqual(resp.json['job']['status'], 'cancelled')
+
+        # A cancelled job is never picked up
+        self.assertEqual(run_job_worker(poll_interval=0, max_jobs=1), 0)
+        self.assertEqual(self.app.get(f'/api/jobs/{job_id}/download').status_code, 404)
+        self.assertEqual(self.app.post(f'/api/jobs/{job_id}/cancel').status_code, 400)
+
+    def test_running_job_stops_when_cancel_requested(self):
+        job_id = self.submit_zip_job()
+        db.session.query(BackgroundJob).filter_by(id=job_id).update({'cancel_requested': True})
+        db.session.commit()
+
+        run_job_worker(poll_interval=0, max_jobs=1)
+
+        job = BackgroundJob.query.get(job_id)
+        self.assertEqual(job.status, 'cancelled')
+        self.assertIsNone(job.result_path)
+        self.assertFalse(os.path.exists(os.path.join(app.config['JOB_RESULT_DIR'], f'job_{job_id}.zip')))
+
+    def test_full_data_export_runs_as_job(self):
+        resp = self.app.get('/data/export/all')
+        self.assertEqual(resp.status_code, 202)
+        self.assertEqual(run_job_worker(poll_interval=0, max_jobs=1), 1)
+
+        resp = self.app.get(f"/api/jobs/{resp.json['job_id']}/download")
+        self.assertEqual(resp.status_code, 200)
+        sheets = pd.read_excel(io.BytesIO(resp.data), sheet_name=None)
+        self.assertEqual(len(sheets['考生信息']), len(self.student_ids))
+        resp.close()
+
+    def test_jobs_cannot_be_submitted_directly(self):
+        # Jobs are only created by the endpoints that own them (and their permission checks)
+        self.assertEqual(self.app.post('/api/jobs', json={'type': 'report_card_zip', 'params': {}}).status_code, 405)
+
+if __name__ == '__main__':
+    unittest.main()
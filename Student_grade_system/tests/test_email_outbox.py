@@ -0,0 +1,154 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from datetime import datetime, timedelta
+from unittest.mock import patch
+
+from wtf_app_simple import app, db, ExamTemplate, ExamSession, Student, ExamRegistration, Question, Score, User, School, Subject, \
+    EmailOutbox, send_due_emails
+
+class TestEmailOutbox(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
+        app.config['WTF_CSRF_ENABLED'] = False
+        self.temp_dir = tempfile.mkdtemp()
+        app.config['REPORT_CARD_CACHE_DIR'] = self.temp_dir
+        self.saved_config = {k: app.config[k] for k in ('EMAIL_RATE_PER_MINUTE', 'EMAIL_MAX_ATTEMPTS', 'EMAIL_RETRY_BASE_SECONDS', 'EMAIL_SENDER_THREADS', 'MAIL_SERVER')}
+        app.config.update(EMAIL_RATE_PER_MINUTE=0, EMAIL_MAX_ATTEMPTS=3, EMAIL_RETRY_BASE_SECONDS=60, MAIL_SERVER='smtp.test.local')
+        self.app = app.test_client()
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+        db.session.add(Subject(id=1, name="Math", code="MATH", type="math"))
+        school = School(name="Test School", code="TS001")
+        self.session_obj = ExamSession(name="Mail Session", exam_date=datetime(2025, 1, 1).date(), location="Test Loc", session_type="morning", start_time="09:00", end_time="11:00")
+        self.template = ExamTemplate(name="Mail Template", grade_level="G1", subject_id=1, total_questions=1)
+        db.session.add_all([school, self.session_obj, self.template])
+        db.session.commit()
+
+        question = Question(exam_template_id=self.template.id, question_number="1", score=10.0, module="Module A")
+        db.session.add(question)
+        db.session.commit()
+
+        for i in range(3):
+            student = Student(name=f"Student {i}", student_id=f"MS{i:03d}", gender="M", school_id=school.id, grade_level="G1",
+                              email=f"s{i}@example.com" if i < 2 else None)
+            db.session.add(student)
+            db.session.flush()
+            db.session.add(ExamRegistration(student_id=student.id, exam_session_id=self.session_obj.id, exam_template_id=self.template.id))
+            db.session.add(Score(student_id=student.id, question_id=question.id, score=8.0, is_correct=False))
+
+        user = User(username="admin", role="admin")
+        user.set_password("password")
+        db.session.add(user)
+        db.session.commit()
+
+        self.app.post('/login', data=dict(username='admin', password='password'))
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        app.config.update(self.saved_config)
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def enqueue(self):
+        resp = self.app.post('/api/email/batch-send-report-card', json={'exam_session_id': self.session_obj.id})
+        self.assertEqual(resp.status_code, 202)
+        return resp.json
+
+    def status(self):
+        return self.app.get('/api/email/outbox/status', query_string={'exam_session_id': self.session_obj.id}).json['counts']
+
+    def test_batch_enqueues_and_rerun_is_idempotent(self):
+        result = self.enqueue()
+        self.assertEqual(result['counts']['queued'], 3)
+        self.assertEqual(EmailOutbox.query.count(), 3)
+
+        with patch('wtf_app_simple.send_email_with_attachment', return_value=(True, 'ok')) as send:
+            self.assertEqual(send_due_emails(), 3)
+        self.assertEqual(send.call_count, 2)
+        self.assertEqual(self.status(), {'pending': 0, 'sent': 2, 'failed': 1})
+
+        # Re-running the batch re-queues only the failure, never the delivered mail
+        result = self.enqueue()
+        self.assertEqual(result['counts'], {'queued': 1, 'already_sent': 2, 'already_queued': 0})
+        self.assertEqual(EmailOutbox.query.count(), 3)
+
+    def test_failed_send_backs_off_then_gives_up(self):
+        self.enqueue()
+        with patch('wtf_app_simple.send_email_with_attachment', return_value=(False, 'SMTP down')) as send:
+            send_due_emails()
+            row = EmailOutbox.query.filter(EmailOutbox.to_email == 's0@example.com').first()
+            self.assertEqual(row.status, 'pending')
+            self.assertGreater(row.next_attempt_at, datetime.utcnow() + timedelta(seconds=50))
+
+            # Not due yet
+            self.assertEqual(send_due_emails(), 0)
+
+            for attempt in range(2):
+                EmailOutbox.query.filter_by(status='pending').update({'next_attempt_at': datetime.utcnow()})
+                db.session.commit()
+                send_due_emails()
+
+        self.assertEqual(send.call_count, 6)
+        db.session.refresh(row)
+        self.assertEqual(row.status, 'failed')
+        self.assertEqual(row.attempts, 3)
+        self.assertIn('SMTP down', row.last_error)
+
+    def test_pipeline_sends_concurrently_with_one_pdf_per_mail(self):
+        app.config['EMAIL_SENDER_THREADS'] = 2
+        lock = threading.Lock()
+        active = []
+        peak = []
+        attachments = []
+
+        def slow_send(to_email, subject, body, attachment, filename):
+            with lock:
+                active.append(to_email)
+                peak.append(len(active))
+                attachments.append(attachment.getvalue())
+            time.sleep(0.05)
+            with lock:
+                active.remove(to_email)
+            return True, 'ok'
+
+        self.enqueue()
+        with patch('wtf_app_simple.send_email_with_attachment', side_effect=slow_send):
+            self.assertEqual(send_due_emails(), 3)
+
+        self.assertEqual(max(peak), 2)
+        self.assertEqual(len(attachments), 2)
+        self.assertTrue(all(a.startswith(b'%PDF') for a in attachments))
+        self.assertEqual(self.status(), {'pending': 0, 'sent': 2, 'failed': 1})
+
+    def test_unconfigured_mail_server_leaves_outbox_pending(self):
+        app.config['MAIL_SERVER'] = 'smtp.example.com'
+        self.enqueue()
+        self.assertEqual(send_due_emails(), 0)
+        self.assertEqual(self.status(), {'pending': 3, 'sent': 0, 'failed': 0})
+
+        # Once a real server is set the queued mail goes out without resend
+        app.config['MAIL_SERVER'] = 'smtp.test.local'
+        with patch('wtf_app_simple.send_email_with_attachment', return_value=(True, 'ok')):
+            self.assertEqual(send_due_emails(), 3)
+        self.assertEqual(self.status()['sent'], 2)
+
+    def test_rate_limit_caps_sends_per_minute(self):
+        app.config['EMAIL_RATE_PER_MINUTE'] = 1
+        self.enqueue()
+        with patch('wtf_app_simple.send_email_with_attachment', return_value=(True, 'ok')):
+            self.assertEqual(send_due_emails(), 1)
+            self.assertEqual(send_due_emails(), 0)
+        self.assertEqual(self.status()['pending'], 2)
+
+if __name__ == '__main__':
+    unittest.main()
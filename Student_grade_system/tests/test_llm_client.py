@@ -0,0 +1,79 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import socket
+import unittest
+
+import requests
+
+from wtf_app_simple import app, get_llm_client, close_llm_clients, request_llm_completion, llm_clients
+from mock_llm import MockLLMServer
+
+class TestLLMClient(unittest.TestCase):
+    def setUp(self):
+        self.saved_config = {k: app.config[k] for k in ('LLM_POOL_SIZE', 'LLM_CONNECT_TIMEOUT', 'LLM_READ_TIMEOUT', 'LLM_CONNECT_RETRIES')}
+        self.llm_server = MockLLMServer().start()
+        self.llm = {'provider': 'mock', 'api_key': 'key-1', 'base_url': self.llm_server.base_url, 'model': 'mock'}
+        self.app_context = app.app_context()
+        self.app_context.push()
+
+    def tearDown(self):
+        close_llm_clients()
+        self.app_context.pop()
+        self.llm_server.stop()
+        app.config.update(self.saved_config)
+
+    def test_sequential_calls_reuse_one_connection(self):
+        for _ in range(5):
+            self.assertEqual(request_llm_completion(self.llm, [{'role': 'user', 'content': 'hi'}]), '这是一段测试评语。')
+        self.assertEqual(self.llm_server.connections, 1)
+        self.assertEqual(len(self.llm_server.requests), 5)
+
+    def test_client_rebuilt_when_settings_change(self):
+        client = get_llm_client(self.llm)
+        self.assertIs(get_llm_client(dict(self.llm)), client)
+
+        # Same account, another model (e.g. a cheaper fallback): the model is in the request body, the client is shared
+        self.assertIs(get_llm_client(dict(self.llm, model='mock-mini')), client)
+
+        # Another key gets its own client; the first one stays cached and open
+        rotated = get_llm_client(dict(self.llm, api_key='key-2'))
+        self.assertIsNot(rotated, client)
+        self.assertEqual(rotated.session.headers['Authorization'], 'Bearer key-2')
+        self.assertIs(get_llm_client(self.llm), client)
+
+        app.config['LLM_READ_TIMEOUT'] = 3
+        self.assertEqual(get_llm_client(dict(self.llm, api_key='key-2')).timeout, (app.config['LLM_CONNECT_TIMEOUT'], 3))
+
+    def test_swapped_client_keeps_serving_in_flight_requests(self):
+        client = get_llm_client(self.llm)
+        app.config['LLM_READ_TIMEOUT'] = 7
+        self.assertIsNot(get_llm_client(self.llm), client)
+        # The replaced session is not closed under a request that may still be using it
+        resp = client.chat_completions({'model': 'mock', 'messages': [{'role': 'user', 'content': 'hi'}]})
+        self.assertEqual(resp.status_code, 200)
+
+    def test_connection_test_uses_a_throwaway_client(self):
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess['user_id'] = 1
+            sess['role'] = 'admin'
+        resp = client.post('/api/test-llm-connection', json={'provider': 'mock', 'api_key': 'trial-key',
+                                                             'base_url': self.llm_server.base_url, 'model': 'mock'})
+        self.assertTrue(resp.json['success'])
+        self.assertEqual(len(self.llm_server.requests), 1)
+        self.assertEqual(llm_clients, {})
+
+    def test_connect_errors_retried_then_raised(self):
+        # A port nobody listens on refuses every connection attempt
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            port = s.getsockname()[1]
+        app.config['LLM_CONNECT_RETRIES'] = 2
+        client = get_llm_client(dict(self.llm, base_url=f'http://127.0.0.1:{port}'))
+        self.assertEqual(client.session.get_adapter('http://').max_retries.connect, 2)
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            client.chat_completions({'model': 'mock', 'messages': []})
+
+if __name__ == '__main__':
+    unittest.main()
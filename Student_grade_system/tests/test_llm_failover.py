@@ -0,0 +1,123 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import time
+import unittest
+
+from wtf_app_simple import app, LLMError, SystemSetting, request_llm_completion, stream_llm_completion, llm_settings, \
+    parse_llm_fallbacks, llm_hedge_delay, get_llm_latency_tracker, llm_latency_trackers, close_llm_clients
+from mock_llm import MockLLMServer
+
+MESSAGES = [{'role': 'user', 'content': 'hi'}]
+
+class TestLLMFailover(unittest.TestCase):
+    def setUp(self):
+        self.saved_config = {k: app.config[k] for k in ('LLM_HEDGE_ENABLED', 'LLM_HEDGE_DEFAULT_DELAY', 'LLM_HEDGE_MIN_DELAY', 'LLM_HEDGE_MIN_SAMPLES')}
+        app.config.update(LLM_HEDGE_ENABLED=True, LLM_HEDGE_DEFAULT_DELAY=0.2, LLM_HEDGE_MIN_DELAY=0.05, LLM_HEDGE_MIN_SAMPLES=10)
+        # Two local providers with different latency profiles
+        self.primary = MockLLMServer(reply='primary', delay=1.0).start()
+        self.fallback = MockLLMServer(reply='fallback', delay=0.05).start()
+        self.llm = {
+            'provider': 'primary', 'api_key': 'k1', 'base_url': self.primary.base_url, 'model': 'slow-model',
+            'fallbacks': [{'provider': 'fallback', 'api_key': 'k2', 'base_url': self.fallback.base_url, 'model': 'fast-model'}]
+        }
+        llm_latency_trackers.clear()
+        self.app_context = app.app_context()
+        self.app_context.push()
+
+    def tearDown(self):
+        close_llm_clients()
+        llm_latency_trackers.clear()
+        self.app_context.pop()
+        self.primary.stop()
+        self.fallback.stop()
+        app.config.update(self.saved_config)
+
+    def test_slow_primary_is_hedged(self):
+        start = time.perf_counter()
+        self.assertEqual(request_llm_completion(self.llm, MESSAGES), 'fallback')
+        elapsed = time.perf_counter() - start
+
+        self.assertLess(elapsed, 0.6)
+        self.assertEqual(len(self.primary.requests), 1)
+        self.assertEqual(len(self.fallback.requests), 1)
+        self.assertEqual(self.fallback.requests[0]['model'], 'fast-model')
+
+    def test_answering_provider_reported(self):
+        answered_by = {}
+        request_llm_completion(self.llm, MESSAGES, answered_by=answered_by)
+        self.assertEqual(answered_by['llm']['model'], 'fast-model')
+
+        self.primary.delay = 0.01
+        request_llm_completion(self.llm, MESSAGES, answered_by=answered_by)
+        self.assertEqual(answered_by['llm']['model'], 'slow-model')
+
+    def test_fast_primary_never_hedged(self):
+        self.primary.delay = 0.01
+        for _ in range(5):
+            self.assertEqual(request_llm_completion(self.llm, MESSAGES), 'primary')
+        self.assertEqual(len(self.fallback.requests), 0)
+
+    def test_server_error_fails_over_without_hedging(self):
+        app.config['LLM_HEDGE_ENABLED'] = False
+        self.primary.status = 503
+        self.primary.delay = 0
+        self.assertEqual(request_llm_completion(self.llm, MESSAGES), 'fallback')
+        self.assertEqual(get_llm_latency_tracker(self.llm).failures, 1)
+
+    def test_client_error_is_not_failed_over(self):
+        self.primary.status = 400
+        self.primary.delay = 0
+        with self.assertRaises(LLMError):
+            request_llm_completion(self.llm, MESSAGES)
+        self.assertEqual(len(self.fallback.requests), 0)
+
+    def test_all_providers_failing_raises_last_error(self):
+        self.primary.status = self.fallback.status = 500
+        self.primary.delay = 0
+        with self.assertRaises(LLMError):
+            request_llm_completion(self.llm, MESSAGES)
+        self.assertEqual(len(self.fallback.requests), 1)
+
+    def test_hedge_delay_adapts_to_observed_p95(self):
+        self.assertEqual(llm_hedge_delay(self.llm), 0.2)
+        self.primary.delay = 0.06
+        for _ in range(10):
+            request_llm_completion(self.llm, MESSAGES)
+        delay = llm_hedge_delay(self.llm)
+        self.assertGreaterEqual(delay, 0.06)
+        self.assertLess(delay, 0.2)
+
+    def test_degraded_primary_tried_last(self):
+        tracker = get_llm_latency_tracker(self.llm)
+        for _ in range(3):
+            tracker.record(0, False)
+        self.assertEqual(request_llm_completion(self.llm, MESSAGES), 'fallback')
+        self.assertEqual(len(self.primary.requests), 0)
+
+    def test_stream_fails_over_before_first_token(self):
+        self.primary.status = 502
+        self.primary.delay = 0
+        self.assertEqual(''.join(stream_llm_completion(self.llm, MESSAGES)), 'fallback')
+
+    def test_stream_records_latency_and_outcome(self):
+        self.primary.status = 502
+        self.primary.delay = 0
+        self.fallback.delay = 0.1
+        ''.join(stream_llm_completion(self.llm, MESSAGES))
+
+        self.assertEqual(get_llm_latency_tracker(self.llm).failures, 1)
+        tracker = get_llm_latency_tracker(self.llm['fallbacks'][0])
+        self.assertEqual(tracker.successes, 1)
+        self.assertGreaterEqual(tracker.percentile(50), 0.09)
+
+    def test_fallback_settings_parsed_and_inherit_primary(self):
+        with self.assertRaises(ValueError):
+            parse_llm_fallbacks('{"model": "x"}')
+        setting = SystemSetting(llm_api_provider='deepseek', llm_api_key='key', llm_api_base_url='https://api.deepseek.com',
+                                llm_model='deepseek-chat', llm_fallback_providers='[{"model": "deepseek-reasoner"}]')
+        fallback = llm_settings(setting)['fallbacks'][0]
+        self.assertEqual(fallback, {'provider': 'deepseek', 'api_key': 'key', 'base_url': 'https://api.deepseek.com', 'model': 'deepseek-reasoner'})
+
+if __name__ == '__main__':
+    unittest.main()
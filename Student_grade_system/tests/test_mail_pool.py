@@ -0,0 +1,173 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import io
+import smtplib
+import unittest
+from unittest.mock import patch
+
+from wtf_app_simple import app, SMTPConnectionPool, send_email_with_attachment, get_mail_pool
+
+class FakeSMTP:
+    """Records connections; can be told to drop the connection on the next send."""
+    instances = []
+
+    def __init__(self, host, port, timeout=None):
+        self.sent = []
+        self.logged_in = False
+        self.closed = False
+        self.drop_next = False
+        FakeSMTP.instances.append(self)
+
+    def starttls(self):
+        pass
+
+    def ehlo_or_helo_if_needed(self):
+        pass
+
+    def has_extn(self, name):
+        return False
+
+    def login(self, username, password):
+        self.logged_in = True
+
+    def send_message(self, msg):
+        if self.drop_next:
+            self.closed = True
+            raise smtplib.SMTPServerDisconnected('Connection unexpectedly closed')
+        self.sent.append(msg['To'])
+
+    def noop(self):
+        return (250, b'OK')
+
+    def quit(self):
+        self.closed = True
+
+    def close(self):
+        self.closed = True
+
+class PipeliningSMTP(FakeSMTP):
+    """Advertises PIPELINING and answers the queued commands after they were written in one go."""
+    def __init__(self, host, port, timeout=None):
+        super().__init__(host, port, timeout)
+        self.writes = []
+        self.replies = []
+
+    def has_extn(self, name):
+        return name == 'pipelining'
+
+    def send(self, data):
+        data = data if isinstance(data, bytes) else data.encode('ascii')
+        self.writes.append(data)
+        if data.endswith(b'\r\n.\r\n'):
+            self.replies.append((250, b'queued'))
+            return
+        accepted = 0
+        for line in data.decode('ascii').splitlines():
+            if line == 'DATA':
+                self.replies.append((354, b'go ahead') if accepted else (554, b'no valid recipients'))
+            elif line.startswith('RCPT') and 'refused' in line:
+                self.replies.append((550, b'no such user'))
+            else:
+                accepted += line.startswith('RCPT')
+                self.replies.append((250, b'OK'))
+
+    def getreply(self):
+        return self.replies.pop(0)
+
+    def rset(self):
+        self.replies.clear()
+
+class TestMailPool(unittest.TestCase):
+    def setUp(self):
+        FakeSMTP.instances = []
+        self.patcher = patch('wtf_app_simple.smtplib.SMTP', FakeSMTP)
+        self.patcher.start()
+        self.saved_config = {k: app.config[k] for k in ('MAIL_SERVER', 'MAIL_PORT', 'MAIL_POOL_SIZE')}
+        app.config.update(MAIL_SERVER='smtp.test.local', MAIL_PORT=2525, MAIL_POOL_SIZE=2)
+
+    def tearDown(self):
+        get_mail_pool().close()
+        app.config.update(self.saved_config)
+        self.patcher.stop()
+
+    def test_batch_reuses_one_authenticated_connection(self):
+        for i in range(5):
+            ok, _ = send_email_with_attachment(f"s{i}@example.com", "Report", "Body", io.BytesIO(b'%PDF'), "r.pdf")
+            self.assertTrue(ok)
+
+        self.assertEqual(len(FakeSMTP.instances), 1)
+        self.assertTrue(FakeSMTP.instances[0].logged_in)
+        self.assertEqual(len(FakeSMTP.instances[0].sent), 5)
+
+    def test_reconnects_and_resends_after_disconnect(self):
+        send_email_with_attachment("a@example.com", "Report", "Body", None, "r.pdf")
+        FakeSMTP.instances[0].drop_next = True
+
+        ok, _ = send_email_with_attachment("b@example.com", "Report", "Body", None, "r.pdf")
+        self.assertTrue(ok)
+        self.assertEqual(len(FakeSMTP.instances), 2)
+        self.assertEqual(FakeSMTP.instances[1].sent, ["b@example.com"])
+        self.assertEqual(get_mail_pool().stats['reconnects'], 1)
+
+    def test_connection_rotated_after_max_messages(self):
+        pool = SMTPConnectionPool('smtp.test.local', 2525, size=1, max_messages=2)
+        from email.mime.text import MIMEText
+        for i in range(5):
+            msg = MIMEText('x')
+            msg['To'] = f"s{i}@example.com"
+            pool.send(msg)
+
+        self.assertEqual([len(c.sent) for c in FakeSMTP.instances], [2, 2, 1])
+        self.assertTrue(all(c.closed for c in FakeSMTP.instances[:2]))
+
+    def test_pool_rebuilt_when_settings_change(self):
+        pool = get_mail_pool()
+        self.assertIs(get_mail_pool(), pool)
+        app.config['MAIL_PORT'] = 2526
+        self.assertIsNot(get_mail_pool(), pool)
+
+    def test_envelope_is_pipelined_when_server_supports_it(self):
+        from email.mime.text import MIMEText
+        with patch('wtf_app_simple.smtplib.SMTP', PipeliningSMTP):
+            pool = SMTPConnectionPool('smtp.test.local', 2525, size=1)
+            msg = MIMEText('line\n.leading dot')
+            msg['From'] = 'school@example.com'
+            msg['To'] = 'a@example.com, refused@example.com'
+            pool.send(msg)
+            pool.close()
+
+        server = FakeSMTP.instances[-1]
+        # One write for MAIL/RCPT/DATA, one for the body
+        self.assertEqual(len(server.writes), 2)
+        self.assertEqual(server.writes[0], b'MAIL FROM:<school@example.com>\r\nRCPT TO:<a@example.com>\r\n'
+                                           b'RCPT TO:<refused@example.com>\r\nDATA\r\n')
+        self.assertIn(b'\r\n..leading dot', server.writes[1])
+        self.assertTrue(server.writes[1].endswith(b'\r\n.\r\n'))
+
+    def test_message_without_sender_falls_back_to_send_message(self):
+        from email.mime.text import MIMEText
+        with patch('wtf_app_simple.smtplib.SMTP', PipeliningSMTP):
+            pool = SMTPConnectionPool('smtp.test.local', 2525, size=1)
+            msg = MIMEText('x')
+            msg['To'] = 'a@example.com'
+            pool.send(msg)
+            pool.close()
+
+        server = FakeSMTP.instances[-1]
+        self.assertEqual(server.writes, [])
+        self.assertEqual(server.sent, ['a@example.com'])
+
+    def test_pipelined_send_raises_when_every_recipient_is_refused(self):
+        from email.mime.text import MIMEText
+        with patch('wtf_app_simple.smtplib.SMTP', PipeliningSMTP):
+            pool = SMTPConnectionPool('smtp.test.local', 2525, size=1)
+            msg = MIMEText('x')
+            msg['From'] = 'school@example.com'
+            msg['To'] = 'refused@example.com'
+            with self.assertRaises(smtplib.SMTPRecipientsRefused):
+                pool.send(msg)
+            pool.close()
+
+if __name__ == '__main__':
+    unittest.main()
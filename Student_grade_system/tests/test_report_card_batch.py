@@ -0,0 +1,189 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import io
+import shutil
+import tempfile
+import zipfile
+import unittest
+from datetime import datetime
+from sqlalchemy import event
+
+from wtf_app_simple import app, db, ExamTemplate, ExamSession, Student, ExamRegistration, Question, Score, User, School, Subject, ReportCard, \
+    generate_report_card_pdf, render_report_card_batch, \
+    get_report_card_render_context, invalidate_report_card_render_context, load_report_card_batch, stream_zip
+
+class TestReportCardBatch(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
+        app.config['WTF_CSRF_ENABLED'] = False
+        self.cache_dir = tempfile.mkdtemp()
+        app.config['REPORT_CARD_CACHE_DIR'] = self.cache_dir
+        self.app = app.test_client()
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+        db.session.add(Subject(id=1, name="Math", code="MATH", type="math"))
+        self.school_obj = School(name="Test School", code="TS001")
+        self.session_obj = ExamSession(name="Batch Session", exam_date=datetime(2025, 1, 1).date(), location="Test Loc", session_type="morning", start_time="09:00", end_time="11:00")
+        self.template = ExamTemplate(name="Batch Template", grade_level="G1", subject_id=1, total_questions=2)
+        db.session.add_all([self.school_obj, self.session_obj, self.template])
+        db.session.commit()
+
+        self.q1 = Question(exam_template_id=self.template.id, question_number="1", score=10.0, module="Module A")
+        self.q2 = Question(exam_template_id=self.template.id, question_number="2", score=5.0, module="Module B")
+        db.session.add_all([self.q1, self.q2])
+        db.session.commit()
+
+        self.students = []
+        for i in range(4):
+            student = Student(name=f"Student {i}", student_id=f"BS{i:03d}", gender="M", school_id=self.school_obj.id, grade_level="G1")
+            db.session.add(student)
+            db.session.flush()
+            db.session.add(ExamRegistration(student_id=student.id, exam_session_id=self.session_obj.id, exam_template_id=self.template.id))
+            db.session.add(Score(student_id=student.id, question_id=self.q1.id, score=10.0, is_correct=True))
+            self.students.append(student)
+        db.session.commit()
+
+        self.user = User(username="admin", role="admin")
+        self.user.set_password("password")
+        db.session.add(self.user)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def make_tasks(self):
+        tasks = [{
+            'student_id': s.id,
+            'session_id': self.session_obj.id,
+            'template_id': self.template.id,
+            'filename': f"{s.name}.pdf"
+        } for s in self.students]
+        # Unknown student -> reported as "No Data"
+        tasks.append({'student_id': 9999, 'session_id': self.session_obj.id, 'template_id': None, 'filename': 'missing.pdf'})
+        return tasks
+
+    def test_pool_matches_inline(self):
+        tasks = self.make_tasks()
+        pooled = list(render_report_card_batch(tasks, workers=2))
+        inline = list(render_report_card_batch(tasks, workers=1))
+
+        self.assertEqual([t['filename'] for t, _, _ in pooled], [t['filename'] for t in tasks])
+        for (task, pdf_bytes, error), (_, inline_bytes, _) in zip(pooled[:-1], inline[:-1]):
+            self.assertIsNone(error)
+            self.assertTrue(pdf_bytes.startswith(b'%PDF'))
+            self.assertTrue(inline_bytes.startswith(b'%PDF'))
+
+        self.assertEqual(pooled[-1][1:], (None, None))
+
+    def count_queries(self, fn):
+        statements = []
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            result = fn()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+        return result, len(statements)
+
+    def test_bulk_loader_query_count_is_constant(self):
+        keys = [(s.id, self.session_obj.id, None) for s in self.students]
+        small, small_count = self.count_queries(lambda: load_report_card_batch(keys[:1]))
+        full, full_count = self.count_queries(lambda: load_report_card_batch(keys))
+
+        self.assertEqual(small_count, full_count)
+        self.assertEqual(len(full), len(self.students))
+        first = full[0]['sections'][0]
+        self.assertEqual([q['number'] for q in first['questions']], ['1', '2'])
+        self.assertEqual(first['questions'][0]['score'], 10.0)
+        self.assertIsNone(first['questions'][1]['score'])
+
+    def test_single_pdf_route_still_works(self):
+        pdf_buffer = generate_report_card_pdf(self.students[0].id, self.session_obj.id)
+        self.assertIsNotNone(pdf_buffer)
+        self.assertTrue(pdf_buffer.getvalue().startswith(b'%PDF'))
+
+    def test_render_context_reused_until_invalidated(self):
+        context = get_report_card_render_context()
+        generate_report_card_pdf(self.students[0].id, self.session_obj.id)
+        self.assertIs(get_report_card_render_context(), context)
+
+        invalidate_report_card_render_context()
+        self.assertIsNot(get_report_card_render_context(), context)
+
+    def test_batch_endpoint_reports_failures_in_error_log(self):
+        self.app.post('/login', data=dict(username='admin', password='password'))
+        items = [{'student_id': s.id, 'exam_session_id': self.session_obj.id, 'template_id': self.template.id} for s in self.students]
+        items.append({'student_id': self.students[0].id, 'exam_session_id': 9999})
+
+        resp = self.app.post('/api/pdf/batch-selected', json={'items': items, 'async': False})
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.is_streamed)
+
+        with zipfile.ZipFile(io.BytesIO(resp.data)) as zf:
+            names = zf.namelist()
+            self.assertEqual(len([n for n in names if n.endswith('.pdf')]), len(self.students))
+            self.assertIn('error_log.txt', names)
+            self.assertIn('Failed to generate (No Data)', zf.read('error_log.txt').decode())
+
+    def test_zip_is_streamed_entry_by_entry(self):
+        consumed = []
+        def entries():
+            for i in range(3):
+                consumed.append(i)
+                yield f"{i}.pdf", b'%PDF' + bytes(1000)
+
+        chunks = []
+        for chunk in stream_zip(entries(), ['something failed']):
+            # Each entry is flushed before the next one is requested
+            chunks.append((len(consumed), chunk))
+        self.assertEqual([n for n, _ in chunks[:3]], [1, 2, 3])
+
+        with zipfile.ZipFile(io.BytesIO(b''.join(c for _, c in chunks))) as zf:
+            self.assertEqual(zf.namelist(), ['0.pdf', '1.pdf', '2.pdf', 'error_log.txt'])
+            self.assertEqual(zf.getinfo('0.pdf').compress_type, zipfile.ZIP_STORED)
+            self.assertEqual(zf.read('2.pdf'), b'%PDF' + bytes(1000))
+            self.assertEqual(zf.read('error_log.txt'), b'something failed')
+            self.assertIsNone(zf.testzip())
+
+    def test_report_card_cache_etag_and_invalidation(self):
+        self.app.post('/login', data=dict(username='admin', password='password'))
+        student = self.students[0]
+        url = f'/pdf/report-card/{student.id}/{self.session_obj.id}?template_id={self.template.id}'
+
+        resp = self.app.get(url)
+        self.assertEqual(resp.status_code, 200)
+        etag = resp.headers['ETag']
+        self.assertTrue(os.listdir(self.cache_dir))
+
+        # Previews never write to the database
+        reg = ExamRegistration.query.filter_by(student_id=student.id).first()
+        self.assertIsNone(ReportCard.query.filter_by(registration_id=reg.id).first())
+
+        resp = self.app.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 304)
+
+        # Batch rendering records the cached file so later edits can remove it
+        list(render_report_card_batch([{'student_id': student.id, 'session_id': self.session_obj.id,
+                                         'template_id': self.template.id, 'filename': 'a.pdf'}], workers=1))
+        self.assertTrue(ReportCard.query.filter_by(registration_id=reg.id).first().pdf_url.endswith('.pdf'))
+
+        # Editing a score clears pdf_url and yields a new ETag
+        resp = self.app.post('/api/score-entry/save', json={'student_id': student.id, 'scores': {str(self.q2.id): 5.0}})
+        self.assertTrue(resp.json['success'])
+        db.session.expire_all()
+        self.assertIsNone(ReportCard.query.filter_by(registration_id=reg.id).first().pdf_url)
+
+        resp = self.app.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+
+if __name__ == '__main__':
+    unittest.main()
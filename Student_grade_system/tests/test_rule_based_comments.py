@@ -0,0 +1,137 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import time
+import unittest
+from datetime import datetime
+
+from wtf_app_simple import app, db, ExamTemplate, ExamSession, Student, ExamRegistration, Question, Score, User, School, Subject, \
+    SystemSetting, AICommentHistory, run_job_worker, close_llm_clients
+from mock_llm import MockLLMServer
+
+class TestRuleBasedComments(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
+        app.config['WTF_CSRF_ENABLED'] = False
+        self.app = app.test_client()
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+        db.session.add(Subject(id=1, name="Math", code="MATH", type="math"))
+        school = School(name="Test School", code="TS001")
+        self.session_obj = ExamSession(name="Rule Session", exam_date=datetime(2025, 1, 1).date(), location="Test Loc", session_type="morning", start_time="09:00", end_time="11:00")
+        db.session.add_all([school, self.session_obj])
+        db.session.commit()
+        self.school_id = school.id
+
+        user = User(username="admin", role="admin")
+        user.set_password("password")
+        db.session.add(user)
+        db.session.commit()
+
+        self.app.post('/login', data=dict(username='admin', password='password'))
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def create_template(self, name, modules, student_scores):
+        """modules: list of (module, max_score); student_scores: list of per-question score lists (None = not entered)"""
+        template = ExamTemplate(name=name, grade_level="G1", subject_id=1, total_questions=len(modules))
+        db.session.add(template)
+        db.session.flush()
+        questions = [{'exam_template_id': template.id, 'question_number': str(n + 1), 'score': max_score, 'module': module}
+                     for n, (module, max_score) in enumerate(modules)]
+        db.session.bulk_insert_mappings(Question, questions)
+        question_ids = [q.id for q in Question.query.filter_by(exam_template_id=template.id).order_by(Question.id)]
+
+        db.session.bulk_insert_mappings(Student, [{'name': f"学生{i}", 'student_id': f"{name}-{i}", 'gender': 'M', 'school_id': self.school_id, 'grade_level': 'G1'}
+                                                  for i in range(len(student_scores))])
+        student_ids = [s.id for s in Student.query.filter(Student.student_id.like(f"{name}-%")).order_by(Student.id)]
+        db.session.bulk_insert_mappings(ExamRegistration, [{'student_id': s_id, 'exam_session_id': self.session_obj.id, 'exam_template_id': template.id}
+                                                           for s_id in student_ids])
+        # Bulk inserts skip the flush hook that fills exam_template_id, so set it here
+        db.session.bulk_insert_mappings(Score, [{'student_id': s_id, 'question_id': q_id, 'exam_template_id': template.id,
+                                                 'score': value, 'is_correct': False}
+                                               for s_id, scores in zip(student_ids, student_scores)
+                                               for q_id, value in zip(question_ids, scores) if value is not None])
+        db.session.commit()
+        return template
+
+    def test_module_mastery_drives_comment(self):
+        self.create_template("Rule T", [("计算", 10), ("计算", 10), ("几何", 10), ("应用", 10)],
+                             [[10, 9, 2, 10], [None, None, None, None]])
+        resp = self.app.post('/api/ai-comment/rule-based', json={'template_name': 'Rule T'})
+        comments = resp.json['comments']
+
+        self.assertEqual(resp.json['count'], 2)
+        self.assertEqual(comments[0]['total_score'], 31.0)
+        self.assertEqual(comments[0]['percentage'], 77.5)
+        self.assertIn("学生0同学在本次Rule T测评中顺利完成考试，总分为31.0分", comments[0]['comment'])
+        self.assertIn("在计算, 应用模块上掌握得非常好", comments[0]['comment'])
+        self.assertIn("建议后续重点复习几何相关知识点", comments[0]['comment'])
+        self.assertIn("建议后续重点复习计算, 几何, 应用相关知识点", comments[1]['comment'])
+
+    def test_whole_template_under_a_second(self):
+        modules = [(f"模块{n % 6}", 5.0) for n in range(30)]
+        self.create_template("Big T", modules, [[(i + n) % 6 for n in range(30)] for i in range(500)])
+
+        start = time.perf_counter()
+        resp = self.app.post('/api/ai-comment/rule-based', json={'template_name': 'Big T'})
+        elapsed = time.perf_counter() - start
+
+        self.assertEqual(resp.json['count'], 500)
+        self.assertLess(elapsed, 1.0)
+
+    def test_save_only_fills_registrations_without_comments(self):
+        self.create_template("Save T", [("计算", 10)], [[8], [3]])
+        first_reg = ExamRegistration.query.order_by(ExamRegistration.id).first()
+        db.session.add(AICommentHistory(registration_id=first_reg.id, version=1, content="existing"))
+        db.session.commit()
+
+        resp = self.app.post('/api/ai-comment/rule-based', json={'template_name': 'Save T', 'save': True})
+        self.assertEqual(resp.json['saved'], 1)
+        new_drafts = AICommentHistory.query.filter(AICommentHistory.registration_id != first_reg.id).all()
+        self.assertEqual(len(new_drafts), 1)
+        self.assertFalse(new_drafts[0].is_ai_generated)
+
+    def test_batch_job_falls_back_when_llm_unavailable(self):
+        llm = MockLLMServer(status=503).start()
+        try:
+            db.session.add(SystemSetting(llm_api_key='test-key', llm_api_base_url=llm.base_url, llm_model='mock'))
+            self.create_template("Fallback T", [("计算", 10), ("几何", 10)], [[9, 9], [2, 3]])
+
+            resp = self.app.post('/api/ai-comment/batch-generate', json={'template_name': 'Fallback T', 'rule_fallback': True})
+            run_job_worker(poll_interval=0, max_jobs=1)
+
+            result = self.app.get(f"/api/jobs/{resp.json['job_id']}").json['job']['result']
+            self.assertEqual(result['generated'], 2)
+            self.assertEqual(result['rule_based'], 2)
+            drafts = AICommentHistory.query.all()
+            self.assertTrue(all(not d.is_ai_generated for d in drafts))
+            self.assertTrue(any("表现卓越" in d.content for d in drafts))
+        finally:
+            close_llm_clients()
+            llm.stop()
+
+    def test_single_generate_falls_back_when_llm_unavailable(self):
+        llm = MockLLMServer(status=503).start()
+        try:
+            db.session.add(SystemSetting(llm_api_key='test-key', llm_api_base_url=llm.base_url, llm_model='mock'))
+            self.create_template("Single T", [("计算", 10), ("几何", 10)], [[9, 9]])
+            reg = ExamRegistration.query.one()
+
+            self.assertEqual(self.app.post('/api/ai-comment/generate', json={'registration_id': reg.id}).status_code, 500)
+            resp = self.app.post('/api/ai-comment/generate', json={'registration_id': reg.id, 'rule_fallback': True})
+            self.assertTrue(resp.json['rule_based'])
+            self.assertIn("表现卓越", resp.json['comment']['content'])
+            self.assertFalse(AICommentHistory.query.one().is_ai_generated)
+        finally:
+            close_llm_clients()
+            llm.stop()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import unittest
+from datetime import datetime
+
+from sqlalchemy import inspect
+from wtf_app_simple import app, db, ExamTemplate, ExamSession, Student, ExamRegistration, Question, Score, School, Subject, \
+    SchemaMigration, SCHEMA_MIGRATIONS, run_schema_migrations
+
+class TestSchemaMigrations(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.drop_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def applied_versions(self):
+        return sorted(m.version for m in SchemaMigration.query.all())
+
+    def test_fresh_database_records_every_version_without_running_it(self):
+        self.assertEqual(run_schema_migrations(), [])
+        self.assertEqual(self.applied_versions(), [version for version, _, _ in SCHEMA_MIGRATIONS])
+        self.assertIn('ix_score_template_student', [i['name'] for i in inspect(db.engine).get_indexes('scores')])
+        # Nothing left to do on the next start
+        self.assertEqual(run_schema_migrations(), [])
+
+    def test_existing_database_is_migrated_and_backfilled_once(self):
+        # A database created before the migration table: index missing, scores.exam_template_id and totals empty
+        db.create_all()
+        db.session.add(Subject(id=1, name="Math", code="MATH", type="math"))
+        template = ExamTemplate(name="Legacy Template", grade_level="G1", subject_id=1, total_questions=1)
+        school = School(name="Test School", code="TS001")
+        session_obj = ExamSession(name="Legacy Session", exam_date=datetime(2025, 1, 1).date(), location="Test Loc", session_type="morning", start_time="09:00", end_time="11:00")
+        db.session.add_all([template, school, session_obj])
+        db.session.commit()
+        student = Student(name="Student", student_id="L001", gender="M", school_id=school.id, grade_level="G1")
+        question = Question(exam_template_id=template.id, question_number="1", score=10.0)
+        db.session.add_all([student, question])
+        db.session.commit()
+        reg = ExamRegistration(student_id=student.id, exam_session_id=session_obj.id, exam_template_id=template.id)
+        db.session.add(reg)
+        db.session.add(Score(student_id=student.id, question_id=question.id, score=10.0, is_correct=True))
+        db.session.commit()
+        with db.engine.begin() as conn:
+            conn.execute('DROP INDEX ix_score_template_student')
+            conn.execute('UPDATE scores SET exam_template_id = NULL')
+            conn.execute('DROP TABLE schema_migrations')
+
+        self.assertEqual(run_schema_migrations(), [version for version, _, _ in SCHEMA_MIGRATIONS])
+        self.assertIn('ix_score_template_student', [i['name'] for i in inspect(db.engine).get_indexes('scores')])
+        db.session.expire_all()
+        self.assertEqual(Score.query.one().exam_template_id, template.id)
+        reg = ExamRegistration.query.get(reg.id)
+        self.assertEqual((reg.score, reg.scored_count, reg.correct_count, reg.status), (10.0, 1, 1, 'completed'))
+        self.assertEqual(run_schema_migrations(), [])
+
+if __name__ == '__main__':
+    unittest.main()
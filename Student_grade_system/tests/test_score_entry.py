@@ -4,13 +4,19 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 import unittest
 import sys
 import os
+import io
 from datetime import datetime
 
+import pandas as pd
+
 # Ensure we can import from the current directory
 sys.path.append(os.getcwd())
 
-from wtf_app_simple import app, db, ExamTemplate, ExamSession, Student, ExamRegistration, Question, Score, User, School
+from wtf_app_simple import app, db, ExamTemplate, ExamSession, Student, ExamRegistration, Question, Score, User, School, Subject, \
+    roster_indexes, refresh_registration_totals
 from werkzeug.security import generate_password_hash
+from sqlalchemy import event
+from unittest.mock import patch
 
 class TestScoreEntry(unittest.TestCase):
     def setUp(self):
@@ -23,6 +29,8 @@ class TestScoreEntry(unittest.TestCase):
         db.create_all()
 
         # Create Test Data
+        # Subject is created explicitly so the test does not depend on create_initial_data() running
+        db.session.add(Subject(id=1, name="Test Subject", code="TEST", type="test"))
         self.template = ExamTemplate(name="Test Template 2025", grade_level="1", subject_id=1, total_questions=2)
         db.session.add(self.template)
         db.session.commit()
@@ -141,5 +149,288 @@ class TestScoreEntry(unittest.TestCase):
         self.assertEqual(data[0]['scored_count'], 2)
         print("Test Passed!")
 
+    def count_queries(self, send):
+        statements = []
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            resp = send()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+        return len(statements), resp
+
+    def count_roster_queries(self):
+        count, resp = self.count_queries(
+            lambda: self.app.get(f'/api/score-entry/students?template_name={self.template.name}'))
+        self.assertEqual(resp.status_code, 200)
+        return count, resp.json
+
+    def test_roster_query_count_independent_of_student_count(self):
+        self.login()
+        single_count, data = self.count_roster_queries()
+        self.assertEqual(data[0]['status'], 'pending')
+
+        # 60 more students: a third scored fully, a third partially, a third not at all
+        for i in range(60):
+            student = Student(name=f"Student {i}", student_id=f"TS1{i:02d}", gender="M", school_id=self.school_obj.id, grade_level="1")
+            db.session.add(student)
+            db.session.flush()
+            db.session.add(ExamRegistration(student_id=student.id, exam_session_id=self.session_obj.id, exam_template_id=self.template.id))
+            for q in [self.q1, self.q2][:i % 3]:
+                db.session.add(Score(student_id=student.id, question_id=q.id, score=1.0, is_correct=False))
+        # Scores inserted directly bypass the save paths, so fill the registration totals like the backfill does
+        refresh_registration_totals()
+        db.session.commit()
+
+        many_count, data = self.count_roster_queries()
+        self.assertEqual(many_count, single_count)
+        self.assertEqual(len(data), 61)
+        statuses = {row['student_code']: (row['status'], row['scored_count']) for row in data}
+        self.assertEqual(statuses['TS100'], ('pending', 0))
+        self.assertEqual(statuses['TS101'], ('in_progress', 1))
+        self.assertEqual(statuses['TS102'], ('completed', 2))
+
+    def save_scores(self, scores):
+        return self.count_queries(lambda: self.app.post('/api/score-entry/save', json={
+            'student_id': self.student.id,
+            'scores': {str(q_id): value for q_id, value in scores.items()}
+        }))
+
+    def test_batch_save_query_count_independent_of_question_count(self):
+        self.login()
+        small_count, resp = self.save_scores({self.q1.id: 1.0, self.q2.id: 2.0})
+        self.assertEqual(resp.status_code, 200)
+
+        questions = [Question(exam_template_id=self.template.id, question_number=str(i), score=5.0, module="Module C")
+                     for i in range(3, 83)]
+        db.session.add_all(questions)
+        db.session.commit()
+
+        # 80 new scores plus 2 updated ones in the same request
+        scores = {q.id: 3.0 for q in questions}
+        scores.update({self.q1.id: 10.0, self.q2.id: 0.0})
+        large_count, resp = self.save_scores(scores)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(large_count, small_count)
+
+        # Saving again updates in place instead of adding duplicate rows
+        self.save_scores({self.q1.id: 7.0})
+        saved = Score.query.filter_by(student_id=self.student.id).all()
+        self.assertEqual(len(saved), 82)
+        score_map = {s.question_id: (s.score, s.is_correct) for s in saved}
+        self.assertEqual(score_map[self.q1.id], (7.0, False))
+        self.assertEqual(score_map[self.q2.id], (0.0, False))
+        self.assertEqual(score_map[questions[0].id], (3.0, False))
+
+    def test_batch_save_rejects_whole_batch_on_invalid_score(self):
+        self.login()
+        _, resp = self.save_scores({self.q1.id: 9.0, self.q2.id: 6.0})
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(Score.query.filter_by(student_id=self.student.id).count(), 0)
+
+    def save_delta(self, revision, changes):
+        return self.app.post('/api/score-entry/save-delta', json={
+            'registration_id': self.reg.id,
+            'revision': revision,
+            'changes': {str(q_id): value for q_id, value in changes.items()}
+        })
+
+    def test_delta_save_advances_revision_and_writes_only_changed_cells(self):
+        self.login()
+        detail = self.app.get(f'/api/score-entry/student-detail/{self.student.id}?template_name={self.template.name}').json
+        self.assertEqual(detail['registration'], {'id': self.reg.id, 'revision': 0})
+
+        resp = self.save_delta(0, {self.q1.id: 8.0, self.q2.id: 5.0})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json['revision'], 1)
+
+        # null clears a cell
+        resp = self.save_delta(1, {self.q2.id: None})
+        self.assertEqual(resp.json['revision'], 2)
+        saved = {s.question_id: (s.score, s.is_correct) for s in Score.query.filter_by(student_id=self.student.id)}
+        self.assertEqual(saved, {self.q1.id: (8.0, False)})
+
+        # Invalid values are rejected without consuming a revision
+        self.assertEqual(self.save_delta(2, {self.q1.id: 11.0}).status_code, 400)
+        self.assertEqual(self.save_delta(2, {999: 1.0}).status_code, 400)
+        self.assertEqual(db.session.query(ExamRegistration.score_revision).filter_by(id=self.reg.id).scalar(), 2)
+
+    def test_delta_save_rejects_stale_revision_with_conflicts(self):
+        self.login()
+        self.save_delta(0, {self.q1.id: 8.0, self.q2.id: 3.0})
+
+        # A second grader still holding revision 0
+        resp = self.save_delta(0, {self.q1.id: 6.0, self.q2.id: 3.0})
+        self.assertEqual(resp.status_code, 409)
+        self.assertEqual(resp.json['error'], 'conflict')
+        self.assertEqual(resp.json['revision'], 1)
+        self.assertEqual(resp.json['conflicts'], {str(self.q1.id): 8.0})
+        self.assertEqual(resp.json['scores'], {str(self.q1.id): 8.0, str(self.q2.id): 3.0})
+        self.assertEqual(Score.query.filter_by(student_id=self.student.id, question_id=self.q1.id).first().score, 8.0)
+
+        # Retrying with the returned revision succeeds
+        resp = self.save_delta(resp.json['revision'], {self.q1.id: 6.0})
+        self.assertEqual(resp.json['revision'], 2)
+
+    def test_full_save_advances_revision(self):
+        self.login()
+        self.save_scores({self.q1.id: 1.0})
+        self.assertEqual(self.save_delta(0, {self.q1.id: 2.0}).status_code, 409)
+
+    def navigation(self, student_id):
+        resp = self.app.get(f'/api/score-entry/student-detail/{student_id}?template_name={self.template.name}')
+        return resp.json['navigation']
+
+    def test_navigation_uses_cached_roster_until_registrations_change(self):
+        self.login()
+        later = ExamSession(name="Later Session", exam_date=datetime(2025, 2, 1).date(), location="Test Loc", session_type="standard", start_time="09:00", end_time="11:00")
+        db.session.add(later)
+        db.session.flush()
+        students = []
+        for code, session_id in [("TS003", later.id), ("TS002", self.session_obj.id)]:
+            student = Student(name=code, student_id=code, gender="M", school_id=self.school_obj.id, grade_level="1")
+            db.session.add(student)
+            db.session.flush()
+            db.session.add(ExamRegistration(student_id=student.id, exam_session_id=session_id, exam_template_id=self.template.id))
+            students.append(student)
+        db.session.commit()
+        late, early = students
+
+        # Order: exam date, then student code -> TS001, TS002, TS003
+        self.assertEqual(self.navigation(early.id), {'prev_id': self.student.id, 'next_id': late.id})
+        index = roster_indexes[self.template.name]
+        # Within the stamp interval a lookup is a pure cache hit
+        with patch('wtf_app_simple.roster_stamp') as stamp:
+            self.assertEqual(self.navigation(late.id), {'prev_id': early.id, 'next_id': None})
+        stamp.assert_not_called()
+        self.assertIs(roster_indexes[self.template.name], index)
+
+        # Score writes leave the cache alone; an ORM change to an ordering column drops it
+        self.app.post('/api/score-entry/save', json={'student_id': early.id, 'scores': {str(self.q1.id): 1.0}})
+        self.assertIs(roster_indexes[self.template.name], index)
+        self.student.student_id = "TS009"
+        db.session.commit()
+        self.assertNotIn(self.template.name, roster_indexes)
+        self.assertEqual(self.navigation(early.id), {'prev_id': None, 'next_id': self.student.id})
+
+        # A registration added outside the ORM (another process) changes the stamp, seen once the interval passed
+        other = Student(name="TS004", student_id="TS004", gender="M", school_id=self.school_obj.id, grade_level="1")
+        db.session.add(other)
+        db.session.commit()
+        self.assertEqual(self.navigation(late.id), {'prev_id': self.student.id, 'next_id': None})
+        roster_indexes[self.template.name].checked_at -= app.config['ROSTER_STAMP_INTERVAL']
+        db.session.execute(ExamRegistration.__table__.insert().values(
+            student_id=other.id, exam_session_id=later.id, exam_template_id=self.template.id, score_revision=0))
+        db.session.commit()
+        self.assertEqual(self.navigation(late.id), {'prev_id': self.student.id, 'next_id': other.id})
+
+    def test_template_questions_etag_and_slim_student_scores(self):
+        self.login()
+        db.session.add(Question(exam_template_id=self.template.id, question_number="10", score=2.0, module="Module C"))
+        db.session.commit()
+
+        url = f'/api/score-entry/templates/{self.template.id}/questions'
+        resp = self.app.get(url)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual([q['number'] for q in resp.json['questions']], ["1", "2", "10"])
+        etag = resp.headers['ETag']
+        self.assertFalse(etag.startswith('W/'))
+        self.assertIn('no-cache', resp.headers['Cache-Control'])
+
+        resp = self.app.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.data, b'')
+
+        # Editing a question changes the tag
+        self.q2.module = "Module Z"
+        db.session.commit()
+        resp = self.app.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+
+        # The per-student payload carries no question list
+        db.session.add(Score(student_id=self.student.id, question_id=self.q1.id, score=7.0, is_correct=False))
+        db.session.commit()
+        resp = self.app.get(f'/api/score-entry/student-scores/{self.student.id}?template_name={self.template.name}')
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotIn('questions', resp.json)
+        self.assertEqual(resp.json['template_id'], self.template.id)
+        self.assertEqual(resp.json['scores'], {str(self.q1.id): 7.0})
+        self.assertEqual(self.app.get(f'/api/score-entry/student-scores/999?template_name={self.template.name}').status_code, 404)
+
+    def registration_totals(self):
+        db.session.expire_all()
+        reg = ExamRegistration.query.get(self.reg.id)
+        return reg.score, reg.scored_count, reg.correct_count, reg.status
+
+    def test_save_paths_maintain_registration_totals(self):
+        self.login()
+        self.assertEqual(self.registration_totals(), (None, 0, 0, 'pending'))
+
+        self.save_scores({self.q1.id: 10.0})
+        self.assertEqual(self.registration_totals(), (10.0, 1, 1, 'in_progress'))
+        self.assertIsNotNone(ExamRegistration.query.get(self.reg.id).last_scored_at)
+
+        resp = self.save_delta(1, {self.q2.id: 3.0})
+        self.assertEqual(self.registration_totals(), (13.0, 2, 1, 'completed'))
+
+        # A new question makes the registration incomplete again
+        self.app.post(f'/api/exam_templates/{self.template.id}/questions', json={'question_number': '3', 'score': 5.0})
+        self.assertEqual(self.registration_totals()[3], 'in_progress')
+
+        # Lowering a question's full marks to the awarded score makes that answer correct
+        self.app.put(f'/api/questions/{self.q2.id}', json={'score': 3})
+        self.assertEqual(self.registration_totals()[2], 2)
+        self.assertTrue(Score.query.filter_by(question_id=self.q2.id).one().is_correct)
+
+        self.save_delta(resp.json['revision'], {self.q1.id: None, self.q2.id: None})
+        self.assertEqual(self.registration_totals(), (None, 0, 0, 'pending'))
+
+        # Exports and list views read the maintained columns
+        self.save_scores({self.q1.id: 4.0, self.q2.id: 3.0})
+        resp = self.app.get('/data/export/scores')
+        exported = pd.read_excel(io.BytesIO(resp.data))
+        self.assertEqual(exported['得分'].tolist(), [7.0])
+        resp = self.app.get(f'/api/report-cards?templateId={self.template.id}&status=partial')
+        self.assertEqual(resp.json['totalCount'], 1)
+        self.assertEqual(resp.json['reportCards'][0]['totalScore'], 7.0)
+        self.assertEqual(self.app.get(f'/api/report-cards?templateId={self.template.id}&status=pending').json['totalCount'], 0)
+
+    def test_new_registration_picks_up_existing_scores(self):
+        self.login()
+        other = Student(name="Returning Student", student_id="TS002", gender="F", school_id=self.school_obj.id, grade_level="1")
+        db.session.add(other)
+        db.session.commit()
+        # Scores left over from an earlier, cancelled registration
+        db.session.add(Score(student_id=other.id, question_id=self.q1.id, score=10.0, is_correct=True))
+        db.session.commit()
+
+        resp = self.app.post('/api/registrations', json={'template_id': self.template.id, 'student_ids': [other.id]})
+        self.assertTrue(resp.json['success'])
+        reg = ExamRegistration.query.filter_by(student_id=other.id).one()
+        db.session.refresh(reg)
+        self.assertEqual((reg.score, reg.scored_count, reg.correct_count, reg.status), (10.0, 1, 1, 'in_progress'))
+
+    def test_scores_carry_template(self):
+        self.login()
+        self.save_scores({self.q1.id: 10.0})
+        self.save_delta(1, {self.q2.id: 3.0})
+        rows = db.session.query(Score.question_id, Score.exam_template_id).order_by(Score.question_id).all()
+        self.assertEqual(rows, [(self.q1.id, self.template.id), (self.q2.id, self.template.id)])
+
+        # Rows added through the ORM are filled in on flush
+        other = Question(exam_template_id=self.template.id, question_number="3", score=5.0)
+        db.session.add(other)
+        db.session.commit()
+        db.session.add(Score(student_id=self.student.id, question_id=other.id, score=1.0, is_correct=False))
+        db.session.commit()
+        self.assertEqual(Score.query.filter_by(question_id=other.id).one().exam_template_id, self.template.id)
+
+        # Deleting a question drops its scores, so they no longer count towards the template
+        self.app.delete(f'/api/questions/{other.id}')
+        self.assertEqual(Score.query.filter_by(exam_template_id=self.template.id).count(), 2)
+        self.assertEqual(self.registration_totals()[:2], (13.0, 2))
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,122 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import unittest
+from datetime import datetime
+
+from wtf_app_simple import app, db, ExamTemplate, ExamSession, Student, ExamRegistration, Question, Score, User, School, Subject
+
+class TestScoreMatrix(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
+        app.config['WTF_CSRF_ENABLED'] = False
+        self.app = app.test_client()
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+        db.session.add(Subject(id=1, name="Math", code="MATH", type="math"))
+        school = School(name="Test School", code="TS001")
+        session_obj = ExamSession(name="Matrix Session", exam_date=datetime(2025, 1, 1).date(), location="Test Loc", session_type="morning", start_time="09:00", end_time="11:00")
+        self.template = ExamTemplate(name="Matrix Template", grade_level="G1", subject_id=1, total_questions=3)
+        db.session.add_all([school, session_obj, self.template])
+        db.session.commit()
+
+        self.questions = [Question(exam_template_id=self.template.id, question_number=str(i + 1), score=max_score, module="Module A")
+                          for i, max_score in enumerate([10.0, 5.0, 5.0])]
+        db.session.add_all(self.questions)
+
+        self.students = []
+        for i in range(3):
+            student = Student(name=f"Student {i}", student_id=f"M{i:03d}", gender="M", school_id=school.id, grade_level="G1")
+            db.session.add(student)
+            db.session.flush()
+            db.session.add(ExamRegistration(student_id=student.id, exam_session_id=session_obj.id, exam_template_id=self.template.id))
+            self.students.append(student)
+
+        user = User(username="admin", role="admin")
+        user.set_password("password")
+        grader = User(username="grader", role="teacher")
+        grader.set_password("password")
+        db.session.add_all([user, grader])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def login(self, username='admin'):
+        self.app.post('/login', data=dict(username=username, password='password'))
+
+    def saved_scores(self):
+        return {(s.student_id, s.question_id): s.score for s in Score.query.all()}
+
+    def test_json_matrix_writes_valid_cells_and_reports_errors(self):
+        self.login()
+        q1, q2, q3 = [q.id for q in self.questions]
+        s0, s1, s2 = [s.id for s in self.students]
+        resp = self.app.post('/api/score-entry/matrix', json={
+            'template_name': self.template.name,
+            'columns': ['1', '2', '3', '99'],
+            'rows': [
+                ['M000', 10, 4.5, '', 1],
+                ['M001', 'abc', 6, 5],
+                ['M002', 0, 5],
+                ['X999', 1, 1, 1],
+                ['M000', 1, 1, 1]
+            ]
+        })
+        self.assertEqual(resp.status_code, 200)
+        report = resp.json
+        self.assertEqual(report['written'], 5)
+        self.assertEqual(report['students'], 3)
+        self.assertEqual(self.saved_scores(), {
+            (s0, q1): 10.0, (s0, q2): 4.5,
+            (s1, q3): 5.0,
+            (s2, q1): 0.0, (s2, q2): 5.0
+        })
+        self.assertTrue(Score.query.filter_by(student_id=s0, question_id=q1).first().is_correct)
+
+        errors = {(e['row'], e['question']): e['message'] for e in report['errors']}
+        self.assertEqual(errors, {
+            (None, '99'): '题号不存在',
+            (2, '1'): '不是数字',
+            (2, '2'): '超出范围 0 - 5',
+            (4, None): '考号未报名该试卷',
+            (5, None): '考号重复'
+        })
+        revisions = {r.student_id: r.score_revision for r in ExamRegistration.query.all()}
+        self.assertEqual(revisions, {s0: 1, s1: 1, s2: 1})
+
+    def test_pasted_tsv_with_dry_run_and_unchanged_cells(self):
+        self.login()
+        text = "考号\tQ1\tQ2\tQ3\nM000\t8\t5\t2.5\nM001\t7\t\t3\n"
+        resp = self.app.post('/api/score-entry/matrix', json={'template_name': self.template.name, 'text': text, 'dry_run': True})
+        self.assertEqual(resp.json['valid_cells'], 5)
+        self.assertEqual(resp.json['written'], 0)
+        self.assertEqual(Score.query.count(), 0)
+
+        resp = self.app.post('/api/score-entry/matrix', json={'template_name': self.template.name, 'text': text})
+        self.assertEqual(resp.json['written'], 5)
+        self.assertEqual(resp.json['errors'], [])
+
+        # Same sheet as CSV with one edit: only the changed cell is written
+        csv_text = "学号,1,2,3\nM000,8,5,2.5\nM001,7,,4\n"
+        resp = self.app.post('/api/score-entry/matrix', json={'template_name': self.template.name, 'text': csv_text})
+        self.assertEqual(resp.json['written'], 1)
+        self.assertEqual(resp.json['unchanged'], 4)
+        self.assertEqual(Score.query.filter_by(student_id=self.students[1].id, question_id=self.questions[2].id).first().score, 4.0)
+
+    def test_matrix_requires_assigned_template(self):
+        self.login('grader')
+        resp = self.app.post('/api/score-entry/matrix', json={'template_name': self.template.name, 'text': "考号\t1\nM000\t1\n"})
+        self.assertEqual(resp.status_code, 404)
+
+        self.login()
+        resp = self.app.post('/api/score-entry/matrix', json={'template_name': self.template.name, 'text': '   '})
+        self.assertEqual(resp.status_code, 400)
+
+if __name__ == '__main__':
+    unittest.main()
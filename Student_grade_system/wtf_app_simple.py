@@ -5,15 +5,23 @@
 橡心国际WTF活动管理平台 - 简化版本
 """
 
-from flask import Flask, render_template, request, jsonify, send_file, session, redirect, url_for, flash, make_response
+from flask import Flask, render_template, request, jsonify, send_file, session, redirect, url_for, flash, make_response, Response, stream_with_context
 import flask
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import inspect
-from datetime import datetime, date
+from sqlalchemy import inspect, event
+from datetime import datetime, date, timedelta
 import os
 import io
 import hashlib
+import json
+import shutil
+import time
+import queue
+from collections import deque
+import atexit
+import threading
 import pandas as pd
+import numpy as np
 import zipfile
 from functools import wraps
 from werkzeug.security import generate_password_hash, check_password_hash
@@ -34,6 +42,8 @@ from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from email.mime.application import MIMEApplication
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # 创建Flask应用
 app = Flask(__name__)
@@ -51,6 +61,62 @@ app.config['MAIL_USERNAME'] = os.environ.get('MAIL_USERNAME', 'user@example.com'
 app.config['MAIL_PASSWORD'] = os.environ.get('MAIL_PASSWORD', 'password')
 app.config['MAIL_USE_TLS'] = os.environ.get('MAIL_USE_TLS', 'true').lower() == 'true'
 app.config['MAIL_DEFAULT_SENDER'] = os.environ.get('MAIL_DEFAULT_SENDER', 'noreply@example.com')
+app.config['MAIL_TIMEOUT'] = int(os.environ.get('MAIL_TIMEOUT', 30))
+# Persistent SMTP connections per process (see SMTPConnectionPool)
+app.config['MAIL_POOL_SIZE'] = int(os.environ.get('MAIL_POOL_SIZE', 2))
+app.config['MAIL_MAX_MESSAGES_PER_CONNECTION'] = int(os.environ.get('MAIL_MAX_MESSAGES_PER_CONNECTION', 100))
+
+# PDF Batch Config (process pool size for batch report cards; 1 = render inline)
+app.config['PDF_BATCH_WORKERS'] = int(os.environ.get('PDF_BATCH_WORKERS', os.cpu_count() or 1))
+
+# Report card PDF cache (content-addressed files, LRU-evicted by total size)
+app.config['REPORT_CARD_CACHE_ENABLED'] = os.environ.get('REPORT_CARD_CACHE_ENABLED', 'true').lower() == 'true'
+app.config['REPORT_CARD_CACHE_DIR'] = os.environ.get('REPORT_CARD_CACHE_DIR', os.path.join(app.instance_path, 'report_card_cache'))
+app.config['REPORT_CARD_CACHE_MAX_BYTES'] = int(os.environ.get('REPORT_CARD_CACHE_MAX_MB', 512)) * 1024 * 1024
+
+# Background jobs (executed by scripts/job_worker.py processes, not by web workers)
+app.config['JOB_RESULT_DIR'] = os.environ.get('JOB_RESULT_DIR', os.path.join(app.instance_path, 'job_results'))
+app.config['JOB_RESULT_TTL_HOURS'] = int(os.environ.get('JOB_RESULT_TTL_HOURS', 24))
+app.config['JOB_STALE_SECONDS'] = int(os.environ.get('JOB_STALE_SECONDS', 600))
+# 批量导出默认作为后台任务执行 (需要 scripts/job_worker.py 在运行); 关闭后仅在请求显式传 async 时才排队
+app.config['JOB_ASYNC_DEFAULT'] = os.environ.get('JOB_ASYNC_DEFAULT', 'true').lower() == 'true'
+
+# Email outbox (drained by scripts/email_sender.py)
+app.config['EMAIL_RATE_PER_MINUTE'] = int(os.environ.get('EMAIL_RATE_PER_MINUTE', 60))  # 0 = unlimited
+app.config['EMAIL_MAX_ATTEMPTS'] = int(os.environ.get('EMAIL_MAX_ATTEMPTS', 5))
+app.config['EMAIL_RETRY_BASE_SECONDS'] = int(os.environ.get('EMAIL_RETRY_BASE_SECONDS', 60))
+app.config['EMAIL_RETRY_MAX_SECONDS'] = int(os.environ.get('EMAIL_RETRY_MAX_SECONDS', 3600))
+app.config['EMAIL_SENDER_BATCH'] = int(os.environ.get('EMAIL_SENDER_BATCH', 20))
+app.config['EMAIL_LOCK_SECONDS'] = int(os.environ.get('EMAIL_LOCK_SECONDS', 300))
+# Render -> send pipeline: sender threads share the SMTP pool, rendered PDFs wait in a bounded queue
+app.config['EMAIL_SENDER_THREADS'] = int(os.environ.get('EMAIL_SENDER_THREADS', app.config['MAIL_POOL_SIZE']))
+app.config['EMAIL_PIPELINE_DEPTH'] = int(os.environ.get('EMAIL_PIPELINE_DEPTH', 8))
+
+# Batch AI comments: concurrent LLM calls per job, rate-limited per provider (0 = unlimited)
+app.config['LLM_BATCH_CONCURRENCY'] = int(os.environ.get('LLM_BATCH_CONCURRENCY', 4))
+app.config['LLM_RATE_PER_MINUTE'] = int(os.environ.get('LLM_RATE_PER_MINUTE', 60))
+# LLM HTTP client: keep-alive connections per provider, (connect, read) timeouts, retries on connect errors only
+app.config['LLM_POOL_SIZE'] = int(os.environ.get('LLM_POOL_SIZE', app.config['LLM_BATCH_CONCURRENCY']))
+app.config['LLM_CONNECT_TIMEOUT'] = float(os.environ.get('LLM_CONNECT_TIMEOUT', 5))
+app.config['LLM_READ_TIMEOUT'] = float(os.environ.get('LLM_READ_TIMEOUT', 30))
+app.config['LLM_CONNECT_RETRIES'] = int(os.environ.get('LLM_CONNECT_RETRIES', 2))
+# Fallback providers: hedge with the next provider once a call outlives the current one's p95 latency
+app.config['LLM_HEDGE_ENABLED'] = os.environ.get('LLM_HEDGE_ENABLED', 'true').lower() == 'true'
+app.config['LLM_HEDGE_PERCENTILE'] = float(os.environ.get('LLM_HEDGE_PERCENTILE', 95))
+app.config['LLM_HEDGE_DEFAULT_DELAY'] = float(os.environ.get('LLM_HEDGE_DEFAULT_DELAY', 8))
+app.config['LLM_HEDGE_MIN_DELAY'] = float(os.environ.get('LLM_HEDGE_MIN_DELAY', 0.5))
+app.config['LLM_HEDGE_MIN_SAMPLES'] = int(os.environ.get('LLM_HEDGE_MIN_SAMPLES', 10))
+app.config['LLM_LATENCY_WINDOW'] = int(os.environ.get('LLM_LATENCY_WINDOW', 200))
+# AI comment prompt: per-module / knowledge-point aggregates, capped at an estimated token budget
+app.config['AI_COMMENT_PROMPT_TOKEN_BUDGET'] = int(os.environ.get('AI_COMMENT_PROMPT_TOKEN_BUDGET', 400))
+app.config['AI_COMMENT_PROMPT_TOP_N'] = int(os.environ.get('AI_COMMENT_PROMPT_TOP_N', 5))
+# AI comment cache: identical score vectors on the same template reuse one generated text
+app.config['AI_COMMENT_CACHE_ENABLED'] = os.environ.get('AI_COMMENT_CACHE_ENABLED', 'true').lower() == 'true'
+app.config['AI_COMMENT_CACHE_MAX_ENTRIES'] = int(os.environ.get('AI_COMMENT_CACHE_MAX_ENTRIES', 5000))
+# Score entry prev/next: per-process roster order cache, rebuilt at the latest after this many seconds
+app.config['ROSTER_CACHE_TTL'] = int(os.environ.get('ROSTER_CACHE_TTL', 300))
+# ...and checked against the registrations table (changes made by other processes) at most this often
+app.config['ROSTER_STAMP_INTERVAL'] = float(os.environ.get('ROSTER_STAMP_INTERVAL', 5))
 
 # 初始化数据库
 db = SQLAlchemy(app)
@@ -131,6 +197,8 @@ class SystemSetting(db.Model):
     llm_api_key = db.Column(db.String(255))
     llm_api_base_url = db.Column(db.String(255), default='https://api.deepseek.com')
     llm_model = db.Column(db.String(100), default='deepseek-chat')
+    # JSON list of {provider, base_url, model, api_key}, tried in order after the primary provider
+    llm_fallback_providers = db.Column(db.Text)
     
     def to_dict(self):
         return {
@@ -140,7 +208,8 @@ class SystemSetting(db.Model):
             'llm_api_provider': self.llm_api_provider,
             'llm_api_key': self.llm_api_key,
             'llm_api_base_url': self.llm_api_base_url,
-            'llm_model': self.llm_model
+            'llm_model': self.llm_model,
+            'llm_fallback_providers': self.llm_fallback_providers
         }
 
 class ExamSession(db.Model):
@@ -239,8 +308,13 @@ class ExamRegistration(db.Model):
     exam_template_id = db.Column(db.Integer, db.ForeignKey('exam_templates.id'))
     registration_date = db.Column(db.DateTime, default=datetime.utcnow)
     attendance_status = db.Column(db.String(20))  # present/absent
-    score = db.Column(db.Float)
-    status = db.Column(db.String(20))
+    # 以下汇总由 refresh_registration_totals 在保存分数的同一事务中维护
+    score = db.Column(db.Float)  # 总分, 未录入任何题目时为空
+    status = db.Column(db.String(20), default='pending')  # pending / in_progress / completed
+    scored_count = db.Column(db.Integer, default=0, nullable=False)
+    correct_count = db.Column(db.Integer, default=0, nullable=False)
+    last_scored_at = db.Column(db.DateTime)
+    score_revision = db.Column(db.Integer, default=0, nullable=False)  # 乐观并发: 每次分数变更 +1
     
     student = db.relationship('Student', backref='registrations')
     exam_session = db.relationship('ExamSession')
@@ -276,12 +350,21 @@ class Score(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     student_id = db.Column(db.Integer, db.ForeignKey('students.id'))
     question_id = db.Column(db.Integer, db.ForeignKey('questions.id'))
+    # 冗余自 Question, 按 (试卷, 考生) 取分数时无需先查题目ID再 IN; ORM 写入时由 fill_score_exam_template_id 补齐,
+    # 批量/Core 写入 (bulk_insert_mappings, upsert_scores) 不经过 flush 事件, 须显式填写
+    exam_template_id = db.Column(db.Integer, db.ForeignKey('exam_templates.id'))
     score = db.Column(db.Float, nullable=False)
     is_correct = db.Column(db.Boolean)
     scoring_time = db.Column(db.DateTime, default=datetime.utcnow)
     
     student = db.relationship('Student')
     question = db.relationship('Question')
+    
+    __table_args__ = (
+        db.UniqueConstraint('student_id', 'question_id', name='uq_score_student_question'),
+        # 覆盖索引: (试卷, 考生) 查找及其 question_id/score 均可只读索引
+        db.Index('ix_score_template_student', 'exam_template_id', 'student_id', 'question_id', 'score'),
+    )
 
 class AICommentHistory(db.Model):
     __tablename__ = 'ai_comment_history'
@@ -302,6 +385,19 @@ class AICommentHistory(db.Model):
         db.UniqueConstraint('registration_id', 'version', name='uq_registration_version'),
     )
 
+class AICommentCache(db.Model):
+    """AI评语缓存 (按 试卷/模型/提示词版本/得分向量 取键, 文本中学生姓名为占位符)"""
+    __tablename__ = 'ai_comment_cache'
+    id = db.Column(db.Integer, primary_key=True)
+    cache_key = db.Column(db.String(64), unique=True, nullable=False)
+    exam_template_id = db.Column(db.Integer, db.ForeignKey('exam_templates.id'), index=True)
+    model = db.Column(db.String(100))
+    prompt_version = db.Column(db.String(20))
+    content = db.Column(db.Text, nullable=False)
+    hit_count = db.Column(db.Integer, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    last_used_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
 class ReportCard(db.Model):
     __tablename__ = 'report_cards'
     id = db.Column(db.Integer, primary_key=True)
@@ -315,6 +411,74 @@ class ReportCard(db.Model):
     registration = db.relationship('ExamRegistration', backref=db.backref('report_card', uselist=False))
     confirmed_comment = db.relationship('AICommentHistory', foreign_keys=[confirmed_comment_id])
 
+class BackgroundJob(db.Model):
+    __tablename__ = 'background_jobs'
+    id = db.Column(db.Integer, primary_key=True)
+    job_type = db.Column(db.String(50), nullable=False)
+    status = db.Column(db.String(20), default='pending', index=True)  # pending, running, succeeded, failed, cancelled
+    params = db.Column(db.Text)  # JSON
+    progress_current = db.Column(db.Integer, default=0)
+    progress_total = db.Column(db.Integer, default=0)
+    message = db.Column(db.String(255))
+    result = db.Column(db.Text)  # JSON summary
+    result_path = db.Column(db.String(255))
+    result_name = db.Column(db.String(255))
+    error = db.Column(db.Text)
+    cancel_requested = db.Column(db.Boolean, default=False)
+    worker_id = db.Column(db.String(64))
+    created_by = db.Column(db.Integer, db.ForeignKey('users.id'))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    heartbeat_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'type': self.job_type,
+            'status': self.status,
+            'progress': {
+                'current': self.progress_current or 0,
+                'total': self.progress_total or 0,
+                'percent': round(100.0 * (self.progress_current or 0) / self.progress_total, 1) if self.progress_total else 0
+            },
+            'message': self.message,
+            'result': json.loads(self.result) if self.result else None,
+            'error': self.error,
+            'cancel_requested': bool(self.cancel_requested),
+            'has_download': bool(self.status == 'succeeded' and self.result_path),
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None
+        }
+
+class EmailOutbox(db.Model):
+    __tablename__ = 'email_outbox'
+    id = db.Column(db.Integer, primary_key=True)
+    dedup_key = db.Column(db.String(128), unique=True, nullable=False)  # one row per student/session/template
+    batch_id = db.Column(db.String(32), index=True)
+    student_id = db.Column(db.Integer, db.ForeignKey('students.id'), nullable=False)
+    exam_session_id = db.Column(db.Integer, db.ForeignKey('exam_sessions.id'), nullable=False)
+    exam_template_id = db.Column(db.Integer, db.ForeignKey('exam_templates.id'))
+    to_email = db.Column(db.String(120))
+    status = db.Column(db.String(20), default='pending', index=True)  # pending, sending, sent, failed
+    attempts = db.Column(db.Integer, default=0)
+    next_attempt_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    last_attempt_at = db.Column(db.DateTime, index=True)
+    locked_until = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+    created_by = db.Column(db.Integer, db.ForeignKey('users.id'))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime)
+
+    student = db.relationship('Student')
+
+class SchemaMigration(db.Model):
+    __tablename__ = 'schema_migrations'
+    version = db.Column(db.Integer, primary_key=True)  # SCHEMA_MIGRATIONS 中的版本号
+    name = db.Column(db.String(100), nullable=False)
+    applied_at = db.Column(db.DateTime, default=datetime.utcnow)
+
 # 登录验证装饰器
 def login_required(f):
     @wraps(f)
@@ -366,6 +530,11 @@ def settings():
         setting.llm_api_key = request.form.get('llm_api_key')
         setting.llm_api_base_url = request.form.get('llm_api_base_url')
         setting.llm_model = request.form.get('llm_model')
+        try:
+            fallbacks = parse_llm_fallbacks(request.form.get('llm_fallback_providers'))
+            setting.llm_fallback_providers = json.dumps(fallbacks, ensure_ascii=False) if fallbacks else None
+        except ValueError as e:
+            flash(f'备用服务商配置有误，未保存该项: {e}', 'danger')
         
         # Handle logo upload
         if 'logo' in request.files:
@@ -382,7 +551,10 @@ def settings():
                 file.save(logo_path)
                 setting.logo_path = f'img/{filename}'
                 
+        # Cached PDFs need no purge: the digest covers company names and the logo file, so new keys are used
         db.session.commit()
+        invalidate_report_card_render_context()
+        reset_llm_clients()
         flash('系统设置已保存', 'success')
         return redirect(url_for('settings'))
         
@@ -394,28 +566,28 @@ def settings():
 def test_llm_connection():
     """测试LLM连接"""
     data = request.get_json()
-    api_key = data.get('api_key')
-    base_url = data.get('base_url', 'https://api.deepseek.com')
-    model = data.get('model', 'deepseek-chat')
+    llm = {
+        'provider': data.get('provider'),
+        'api_key': data.get('api_key'),
+        'base_url': data.get('base_url', 'https://api.deepseek.com'),
+        'model': data.get('model', 'deepseek-chat')
+    }
     
-    if not api_key:
+    if not llm['api_key']:
         return jsonify({'success': False, 'message': 'API Key 不能为空'})
         
+    # Ad-hoc key/URL being tried out: use a throwaway client instead of adding it to the process pool
+    client = LLMClient(llm['base_url'], llm['api_key'], pool_size=1,
+                       connect_timeout=app.config['LLM_CONNECT_TIMEOUT'], read_timeout=10,
+                       connect_retries=app.config['LLM_CONNECT_RETRIES'])
     try:
-        headers = {
-            'Authorization': f'Bearer {api_key}',
-            'Content-Type': 'application/json'
-        }
         payload = {
-            'model': model,
+            'model': llm['model'],
             'messages': [{'role': 'user', 'content': 'Ping'}],
             'max_tokens': 5
         }
         
-        endpoint = f"{base_url.rstrip('/')}/chat/completions"
-        
-        import requests
-        response = requests.post(endpoint, json=payload, headers=headers, timeout=10)
+        response = client.chat_completions(payload)
         
         if response.status_code == 200:
             return jsonify({'success': True, 'message': '连接成功！LLM 响应正常。'})
@@ -424,6 +596,8 @@ def test_llm_connection():
             
     except Exception as e:
         return jsonify({'success': False, 'message': f'连接测试出错: {str(e)}'})
+    finally:
+        client.close()
 
 # Context processor to inject settings into all templates
 @app.context_processor
@@ -642,29 +816,326 @@ def generate_ai_comment():
     if not registration_id:
         return jsonify({'success': False, 'message': 'Missing registration_id'}), 400
         
+    fresh = data.get('fresh', False)
+    if data.get('stream'):
+        return stream_ai_comment_response(registration_id, force, session['user_id'], fresh)
+        
+    body, status = generate_ai_comment_for_registration(registration_id, force, session['user_id'], fresh,
+                                                        rule_fallback=data.get('rule_fallback', False))
+    return jsonify(body), status
+
+def sse_event(event, data):
+    """Server-Sent Events 格式的一条消息"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def stream_ai_comment_response(registration_id, force=False, user_id=None, fresh=False):
+    """
+    流式生成AI评语 (SSE): 逐段推送 delta 事件, 完成后保存草稿并推送 done 事件
+    配额与成绩完整性校验失败时仍返回普通 JSON 错误; 缓存命中时一次推送全文
+    """
+    prepared, error = prepare_ai_comment(registration_id, force, fresh)
+    if error:
+        body, status = error
+        return jsonify(body), status
+    cached_content = read_ai_comment_cache(prepared)
+        
+    def generate():
+        student_name = prepared['student_name']
+        try:
+            if cached_content is not None:
+                content = cached_content
+                yield sse_event('delta', {'text': personalize_ai_comment(content, student_name)})
+            else:
+                parts = []
+                answered_by = {}
+                # The placeholder may be split across deltas: hold back a possible partial prefix
+                pending = ''
+                for text in stream_llm_completion(prepared['llm'], prepared['messages'], answered_by=answered_by):
+                    parts.append(text)
+                    pending += text
+                    ready, pending = split_name_placeholder(pending)
+                    if ready:
+                        yield sse_event('delta', {'text': personalize_ai_comment(ready, student_name)})
+                if pending:
+                    yield sse_event('delta', {'text': personalize_ai_comment(pending, student_name)})
+                content = ''.join(parts)
+                if not content.strip():
+                    raise LLMError('LLM 返回内容为空')
+                write_ai_comment_cache(prepared, content, answered_by.get('llm'))
+            body, status = save_ai_comment_draft(registration_id, personalize_ai_comment(content, student_name), user_id)
+            body['cached'] = cached_content is not None
+            yield sse_event('done' if body.get('success') else 'error', body)
+        except Exception as e:
+            db.session.rollback()
+            yield sse_event('error', {'success': False, 'message': str(e)})
+            
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # Let nginx pass events through as they are produced
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+def generate_ai_comment_for_registration(registration_id, force=False, user_id=None, fresh=False, rule_fallback=False):
+    """
+    为单个报名生成AI评语 (HTTP 接口与后台任务共用), 返回 (body, status_code)
+    rule_fallback: LLM 请求失败时改存规则评语草稿 (is_ai_generated=False, body['rule_based'] 为 True)
+    """
+    prepared, error = prepare_ai_comment(registration_id, force, fresh)
+    if error:
+        return error
+        
+    try:
+        ai_content = read_ai_comment_cache(prepared)
+        cached = ai_content is not None
+        if not cached:
+            answered_by = {}
+            try:
+                ai_content = request_llm_completion(prepared['llm'], prepared['messages'], answered_by=answered_by)
+            except Exception as e:
+                if not rule_fallback:
+                    raise
+                template = ExamTemplate.query.get(prepared['template_id'])
+                draft = rule_based_comment_drafts(template, [prepared['registration_id']])[prepared['registration_id']]
+                body, status = save_ai_comment_draft(registration_id, draft['comment'], user_id, is_ai_generated=False)
+                body.update(cached=False, rule_based=True, llm_error=str(e))
+                return body, status
+            write_ai_comment_cache(prepared, ai_content, answered_by['llm'])
+        body, status = save_ai_comment_draft(registration_id, personalize_ai_comment(ai_content, prepared['student_name']), user_id)
+        body['cached'] = cached
+        return body, status
+    except Exception as e:
+        db.session.rollback()
+        return {'success': False, 'message': str(e)}, 500
+
+# 每个报名最多生成的AI评语版本数
+MAX_GENERATIONS = 3
+
+# 提示词变更时递增, 旧缓存不再命中
+AI_COMMENT_PROMPT_VERSION = 'v3'
+AI_COMMENT_NAME_PLACEHOLDER = '[学生姓名]'
+
+AI_COMMENT_SYSTEM_PROMPT = "你是一位专业的老师，负责根据学生的考试成绩撰写评语。评语应客观、鼓励为主，指出具体知识点的掌握情况。" \
+    f"提到学生姓名时请原样使用占位符{AI_COMMENT_NAME_PLACEHOLDER}。"
+
+def llm_settings(setting):
+    """LLM 调用所需的配置 (普通 dict, 可跨线程使用); fallbacks 为按顺序尝试的备用服务商"""
+    llm = {
+        'provider': setting.llm_api_provider,
+        'api_key': setting.llm_api_key,
+        'base_url': setting.llm_api_base_url,
+        'model': setting.llm_model
+    }
+    try:
+        fallbacks = parse_llm_fallbacks(setting.llm_fallback_providers)
+    except ValueError as e:
+        print(f"Ignoring invalid llm_fallback_providers: {e}")
+        fallbacks = []
+    # Missing fields inherit from the primary provider (e.g. same account, cheaper model)
+    llm['fallbacks'] = [{
+        'provider': f.get('provider') or llm['provider'],
+        'api_key': f.get('api_key') or llm['api_key'],
+        'base_url': f.get('base_url') or llm['base_url'],
+        'model': f.get('model') or llm['model']
+    } for f in fallbacks]
+    return llm
+
+def parse_llm_fallbacks(text):
+    """解析备用服务商 JSON 列表, 格式错误时抛出 ValueError"""
+    if not text or not text.strip():
+        return []
+    try:
+        fallbacks = json.loads(text)
+    except ValueError:
+        raise ValueError('需要 JSON 数组')
+    if not isinstance(fallbacks, list) or not all(isinstance(f, dict) for f in fallbacks):
+        raise ValueError('需要 JSON 数组, 每项为 {provider, base_url, model, api_key}')
+    for f in fallbacks:
+        if not (f.get('base_url') or f.get('model')):
+            raise ValueError('每项至少需要 base_url 或 model')
+    return [{k: f[k] for k in ('provider', 'base_url', 'model', 'api_key') if f.get(k)} for f in fallbacks]
+
+# --- LLM Client ---
+# 每个进程按 provider/base_url/api_key 复用一个 keep-alive requests.Session, 免去每次调用的 DNS/TCP/TLS 握手;
+# 模型只在请求体中, 同一账号的不同模型 (如备用的低价模型) 共用一个客户端;
+# 连接参数变化或 fork 之后换用新客户端, 旧客户端不主动关闭, 其他线程的在途请求完成后由 GC 回收.
+
+class LLMClient:
+    """单个 LLM 服务的 HTTP 客户端 (连接池, 线程安全)"""
+    def __init__(self, base_url, api_key, pool_size=4, connect_timeout=5, read_timeout=30, connect_retries=2):
+        self.base_url = (base_url or '').rstrip('/')
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = requests.Session()
+        self.session.headers.update({
+            'Authorization': f'Bearer {api_key}',
+            'Content-Type': 'application/json'
+        })
+        # Only connection failures are retried: a POST that reached the provider is never replayed
+        retry = Retry(total=connect_retries, connect=connect_retries, read=0, status=0, other=0,
+                      redirect=0, backoff_factor=0.2, raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(1, pool_size), max_retries=retry)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        
+    def chat_completions(self, payload, timeout=None, stream=False):
+        return self.session.post(f"{self.base_url}/chat/completions", json=payload,
+                                 timeout=timeout or self.timeout, stream=stream)
+        
+    def close(self):
+        self.session.close()
+
+llm_clients = {}
+llm_clients_lock = threading.Lock()
+
+def get_llm_client(llm):
+    """当前进程中与 llm 配置对应的客户端"""
+    key = (llm['provider'], (llm['base_url'] or '').rstrip('/'), llm['api_key'])
+    signature = (
+        app.config['LLM_POOL_SIZE'], app.config['LLM_CONNECT_TIMEOUT'],
+        app.config['LLM_READ_TIMEOUT'], app.config['LLM_CONNECT_RETRIES']
+    )
+    with llm_clients_lock:
+        client = llm_clients.get(key)
+        if client is None or client.signature != signature or client.pid != os.getpid():
+            # Swap only: a hedged or concurrent request may still be using the old session
+            client = LLMClient(
+                llm['base_url'], llm['api_key'],
+                pool_size=app.config['LLM_POOL_SIZE'],
+                connect_timeout=app.config['LLM_CONNECT_TIMEOUT'],
+                read_timeout=app.config['LLM_READ_TIMEOUT'],
+                connect_retries=app.config['LLM_CONNECT_RETRIES']
+            )
+            client.signature = signature
+            client.pid = os.getpid()
+            llm_clients[key] = client
+        return client
+
+def reset_llm_clients():
+    """丢弃当前进程的全部 LLM 客户端 (系统设置保存后调用); 不关闭, 在途请求照常完成"""
+    with llm_clients_lock:
+        llm_clients.clear()
+
+def close_llm_clients():
+    """关闭当前进程的全部 LLM 客户端 (进程退出时)"""
+    with llm_clients_lock:
+        for client in llm_clients.values():
+            if client.pid == os.getpid():
+                client.close()
+        llm_clients.clear()
+
+atexit.register(close_llm_clients)
+
+# --- AI Comment Prompt ---
+# 提示词按模块 / 知识点汇总得分率, 只列出最薄弱与最突出的知识点, 并按估算 token 数截断,
+# 题目数量再多提示词长度也基本不变.
+
+def estimate_tokens(text):
+    """粗略估算 token 数: 中日韩字符及全角标点各计 1, 其余字符约 4 个计 1"""
+    wide = sum(1 for ch in text if ord(ch) >= 0x2E80)
+    return wide + (len(text) - wide + 3) // 4
+
+def format_percentage(got, total):
+    return f"{got / total * 100:.0f}%" if total else "-"
+
+def aggregate_question_scores(questions, score_by_question, key):
+    """
+    按 key(question) 汇总已录入题目的 得分/满分, 保持首次出现顺序
+    未录入的题目只计入 missing, 不拉低得分率
+    """
+    groups = {}
+    for q in questions:
+        name = key(q)
+        if not name:
+            continue
+        group = groups.setdefault(name, {'name': name, 'got': 0.0, 'total': 0.0, 'missing': 0})
+        score = score_by_question.get(q.id)
+        if score is None:
+            group['missing'] += 1
+        else:
+            group['got'] += score
+            group['total'] += q.score or 0
+    return list(groups.values())
+
+def build_ai_comment_prompt(template_name, grade_level, questions, score_by_question, token_budget=None, top_n=None):
+    """
+    构造评语提示词 (学生姓名使用占位符, 生成后再替换)
+    按 模块得分率 -> 最薄弱/最突出知识点 的优先级追加内容, 超出 token 预算的部分省略
+    """
+    token_budget = token_budget or app.config['AI_COMMENT_PROMPT_TOKEN_BUDGET']
+    top_n = top_n or app.config['AI_COMMENT_PROMPT_TOP_N']
+    
+    max_score = sum(q.score or 0 for q in questions)
+    total_score = sum(score for score in score_by_question.values() if score is not None)
+    missing = len([q for q in questions if score_by_question.get(q.id) is None])
+    
+    lines = [
+        "请根据以下学生考试数据生成一段简短的评语（200字以内），包含优点和改进建议。",
+        "",
+        f"学生姓名：{AI_COMMENT_NAME_PLACEHOLDER}",
+        f"考试名称：{template_name}",
+        f"年级：{grade_level}",
+        f"总分：{total_score:g}/{max_score:g}（{format_percentage(total_score, max_score)}）"
+    ]
+    if missing:
+        lines.append(f"未录入成绩：{missing}题")
+    used = estimate_tokens("\n".join(lines))
+    
+    def append_items(title, items):
+        """逐项追加到一行, 直到预算用完"""
+        nonlocal used
+        parts = []
+        cost = estimate_tokens(title)
+        for item in items:
+            item_cost = estimate_tokens(item) + 1
+            if used + cost + item_cost > token_budget:
+                break
+            parts.append(item)
+            cost += item_cost
+        if parts:
+            lines.append(title + "；".join(parts))
+            used += cost
+        
+    modules = [m for m in aggregate_question_scores(questions, score_by_question, lambda q: q.module or '综合') if m['total'] > 0]
+    points = [kp for kp in aggregate_question_scores(questions, score_by_question, lambda q: q.knowledge_point) if kp['total'] > 0]
+    ranked = sorted(points, key=lambda kp: (kp['got'] / kp['total'], kp['name']))
+    weakest = [kp for kp in ranked[:top_n] if kp['got'] / kp['total'] < 0.8]
+    strongest = [kp for kp in sorted(points, key=lambda kp: (-kp['got'] / kp['total'], kp['name']))[:top_n]
+                 if kp not in weakest and kp['got'] / kp['total'] >= 0.8]
+    
+    # Modules weakest first, so truncation drops the least informative ones
+    append_items("模块得分率：", [f"{m['name']} {format_percentage(m['got'], m['total'])}（{m['got']:g}/{m['total']:g}）"
+                                  for m in sorted(modules, key=lambda m: m['got'] / m['total'])])
+    append_items("薄弱知识点：", [f"{kp['name']} {format_percentage(kp['got'], kp['total'])}" for kp in weakest])
+    append_items("优势知识点：", [f"{kp['name']} {format_percentage(kp['got'], kp['total'])}" for kp in strongest])
+    
+    return "\n".join(lines)
+
+def prepare_ai_comment(registration_id, force=False, fresh=False):
+    """
+    校验配额与成绩完整性并构造 LLM 请求 (只读数据库)
+    fresh: 跳过评语缓存 (已有版本时重新生成也会跳过)
+    Returns (prepared, None) 或 (None, (body, status_code))
+    """
     registration = ExamRegistration.query.get(registration_id)
     if not registration:
-        return jsonify({'success': False, 'message': 'Registration not found'}), 404
+        return None, ({'success': False, 'message': 'Registration not found'}, 404)
         
     # 1. Check Quota
-    MAX_GENERATIONS = 3
     used_count = AICommentHistory.query.filter_by(registration_id=registration_id).count()
     if used_count >= MAX_GENERATIONS:
-        return jsonify({
+        return None, ({
             'success': False, 
             'error': 'quota_exceeded', 
             'message': f'已达到生成上限（{MAX_GENERATIONS}/{MAX_GENERATIONS}），无法继续生成。'
-        }), 400
+        }, 400)
         
     # 2. Check Completeness
-    questions = Question.query.filter_by(exam_template_id=registration.exam_template_id).all()
-    question_ids = [q.id for q in questions]
+    questions = Question.query.filter_by(exam_template_id=registration.exam_template_id).order_by(Question.id).all()
     total_count = len(questions)
     
     if total_count > 0:
         scores = Score.query.filter(
-            Score.student_id == registration.student_id,
-            Score.question_id.in_(question_ids)
+            Score.exam_template_id == registration.exam_template_id,
+            Score.student_id == registration.student_id
         ).all()
         filled_count = len(scores)
         missing_count = total_count - filled_count
@@ -674,94 +1145,519 @@ def generate_ai_comment():
         missing_count = 0
     
     if missing_count > 0 and not force:
-        return jsonify({
+        return None, ({
             'success': False,
             'error': 'incomplete_scores',
             'message': '检测到部分题目未填写成绩，请确认后重试。',
             'missing_count': missing_count,
             'total_count': total_count
-        }), 400
+        }, 400)
         
-    # 3. Call LLM
+    # 3. LLM settings
     setting = SystemSetting.query.first()
     if not setting or not setting.llm_api_key:
-        return jsonify({'success': False, 'message': 'LLM API尚未配置，请联系管理员。'}), 500
+        return None, ({'success': False, 'message': 'LLM API尚未配置，请联系管理员。'}, 500)
         
     student = registration.student
     template = registration.exam_template
+    llm = llm_settings(setting)
     
-    score_details = []
-    for s in scores:
-        q = next((x for x in questions if x.id == s.question_id), None)
-        if q:
-            score_details.append(f"题目{q.question_number}({q.knowledge_point}): {s.score}/{q.score}")
-            
-    prompt = f"""
-    请根据以下学生考试数据生成一段简短的评语（200字以内），包含优点和改进建议。
-    
-    学生姓名：{student.name}
-    考试名称：{template.name}
-    年级：{student.grade_level}
-    总分：{registration.score}
+    # Question order, not row order, so equal score vectors build identical prompts
+    score_by_question = {s.question_id: s.score for s in scores}
+    score_vector = [[q.id, q.question_number, q.module, q.knowledge_point, q.score, normalize_score(score_by_question.get(q.id))]
+                    for q in questions]
+    total_score = sum(score for score in score_by_question.values() if score is not None)
+    prompt = build_ai_comment_prompt(template.name, student.grade_level, questions, score_by_question)
     
-    题目得分详情：
-    {"; ".join(score_details)}
-    """
-    
-    try:
-        headers = {
-            "Authorization": f"Bearer {setting.llm_api_key}",
-            "Content-Type": "application/json"
-        }
+    return {
+        'registration_id': registration.id,
+        'student_name': student.name,
+        'llm': llm,
+        'template_id': template.id,
+        'cache_key': ai_comment_cache_key(template, llm, student.grade_level, total_score, score_vector),
+        'use_cache': not fresh and used_count == 0,
+        'messages': [
+            {"role": "system", "content": AI_COMMENT_SYSTEM_PROMPT},
+            {"role": "user", "content": prompt}
+        ]
+    }, None
+
+# --- LLM Provider Failover ---
+# 主服务商之后可配置备用服务商 (SystemSetting.llm_fallback_providers):
+# 5xx/429/超时/连接失败时自动切换下一家; 请求超过当前服务商 p95 延迟仍未返回时, 并发向下一家发出对冲请求, 取先返回者.
+
+class LLMError(Exception):
+    def __init__(self, message, retryable=False):
+        super().__init__(message)
+        self.retryable = retryable
+
+class LLMLatencyTracker:
+    """单个 provider/base_url/model 的近期延迟与失败统计 (线程安全)"""
+    def __init__(self, window=200):
+        self.latencies = deque(maxlen=window)
+        self.lock = threading.Lock()
+        self.successes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.last_failure_at = None
+        
+    def record(self, latency, ok):
+        with self.lock:
+            if ok:
+                self.latencies.append(latency)
+                self.successes += 1
+                self.consecutive_failures = 0
+            else:
+                self.failures += 1
+                self.consecutive_failures += 1
+                self.last_failure_at = time.monotonic()
+                
+    def percentile(self, p):
+        with self.lock:
+            samples = sorted(self.latencies)
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * p / 100.0))]
         
-        payload = {
-            "model": setting.llm_model,
-            "messages": [
-                {"role": "system", "content": "你是一位专业的老师，负责根据学生的考试成绩撰写评语。评语应客观、鼓励为主，指出具体知识点的掌握情况。"},
-                {"role": "user", "content": prompt}
-            ],
-            "temperature": 0.7
+    def is_degraded(self, threshold=3, cooldown=60):
+        """连续失败且仍在冷却期内: 暂时排到备用服务商之后"""
+        with self.lock:
+            return self.consecutive_failures >= threshold and time.monotonic() - self.last_failure_at < cooldown
+            
+    def to_dict(self):
+        with self.lock:
+            count = len(self.latencies)
+        return {
+            'samples': count,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'successes': self.successes,
+            'failures': self.failures,
+            'consecutive_failures': self.consecutive_failures
         }
+
+llm_latency_trackers = {}
+llm_latency_trackers_lock = threading.Lock()
+
+def llm_provider_label(llm):
+    return f"{llm['provider']}|{(llm['base_url'] or '').rstrip('/')}|{llm['model']}"
+
+def get_llm_latency_tracker(llm):
+    label = llm_provider_label(llm)
+    with llm_latency_trackers_lock:
+        if label not in llm_latency_trackers:
+            llm_latency_trackers[label] = LLMLatencyTracker(app.config['LLM_LATENCY_WINDOW'])
+        return llm_latency_trackers[label]
+
+def llm_provider_chain(llm):
+    """主服务商 + 备用服务商; 近期连续失败的排到最后"""
+    chain = [llm] + list(llm.get('fallbacks') or [])
+    return sorted(chain, key=lambda item: get_llm_latency_tracker(item).is_degraded())
+
+def llm_hedge_delay(llm):
+    """对冲等待时间: 该服务商近期 p95 延迟 (样本不足时用默认值); None 表示不对冲"""
+    if not app.config['LLM_HEDGE_ENABLED']:
+        return None
+    tracker = get_llm_latency_tracker(llm)
+    delay = None
+    if len(tracker.latencies) >= app.config['LLM_HEDGE_MIN_SAMPLES']:
+        delay = tracker.percentile(app.config['LLM_HEDGE_PERCENTILE'])
+    if delay is None:
+        delay = app.config['LLM_HEDGE_DEFAULT_DELAY']
+    return max(app.config['LLM_HEDGE_MIN_DELAY'], delay)
+
+def call_llm_provider(llm, messages, temperature=0.7):
+    """向单个服务商请求一次并记录延迟; 可切换备用服务商的错误标记为 retryable"""
+    payload = {
+        "model": llm['model'],
+        "messages": messages,
+        "temperature": temperature
+    }
+    
+    tracker = get_llm_latency_tracker(llm)
+    start = time.monotonic()
+    try:
+        response = get_llm_client(llm).chat_completions(payload)
+    except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+        tracker.record(time.monotonic() - start, False)
+        raise LLMError(f'LLM API Error ({llm["provider"]}): {e}', retryable=True)
         
-        response = requests.post(
-            f"{setting.llm_api_base_url}/chat/completions",
-            headers=headers,
-            json=payload,
-            timeout=30
-        )
+    if response.status_code != 200:
+        tracker.record(time.monotonic() - start, False)
+        raise LLMError(f'LLM API Error: {response.text}',
+                       retryable=response.status_code >= 500 or response.status_code == 429)
         
-        if response.status_code != 200:
-            return jsonify({'success': False, 'message': f'LLM API Error: {response.text}'}), 500
+    result = response.json()
+    tracker.record(time.monotonic() - start, True)
+    return result['choices'][0]['message']['content']
+
+def request_llm_completion(llm, messages, temperature=0.7, answered_by=None):
+    """
+    调用 LLM chat/completions 并返回文本 (不访问数据库, 可在线程池中调用)
+    配置了备用服务商时按顺序失败切换, 并在超过 p95 延迟后发出对冲请求;
+    传入 answered_by (dict) 时, answered_by['llm'] 记录实际返回结果的服务商配置
+    """
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+    
+    if answered_by is None:
+        answered_by = {}
+    chain = llm_provider_chain(llm)
+    if len(chain) == 1:
+        content = call_llm_provider(chain[0], messages, temperature)
+        answered_by['llm'] = chain[0]
+        return content
+        
+    executor = ThreadPoolExecutor(max_workers=len(chain))
+    providers = {}
+    pending = set()
+    last_error = None
+    launched = 0
+    try:
+        while True:
+            if not pending:
+                if launched == len(chain):
+                    raise last_error
+                future = executor.submit(call_llm_provider, chain[launched], messages, temperature)
+                providers[future] = chain[launched]
+                pending.add(future)
+                launched += 1
+                
+            # Hedge: if the newest request outlives its provider's p95, start the next provider too
+            timeout = llm_hedge_delay(chain[launched - 1]) if launched < len(chain) else None
+            done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    content = future.result()
+                except LLMError as e:
+                    if not e.retryable:
+                        raise
+                    last_error = e
+                else:
+                    answered_by['llm'] = providers[future]
+                    return content
+            # Either the hedge delay passed or a request failed over: bring in the next provider now
+            if launched < len(chain):
+                future = executor.submit(call_llm_provider, chain[launched], messages, temperature)
+                providers[future] = chain[launched]
+                pending.add(future)
+                launched += 1
+    finally:
+        # Losing requests finish in the background (bounded by the read timeout)
+        executor.shutdown(wait=False)
+
+def open_llm_stream(llm, messages, temperature=0.7):
+    """向单个服务商发起 stream=true 请求, 返回已确认 200 的响应; 失败时按实际耗时记入延迟统计"""
+    payload = {
+        "model": llm['model'],
+        "messages": messages,
+        "temperature": temperature,
+        "stream": True
+    }
+    
+    tracker = get_llm_latency_tracker(llm)
+    start = time.monotonic()
+    try:
+        response = get_llm_client(llm).chat_completions(payload, stream=True)
+    except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+        tracker.record(time.monotonic() - start, False)
+        raise LLMError(f'LLM API Error ({llm["provider"]}): {e}', retryable=True)
+        
+    if response.status_code != 200:
+        tracker.record(time.monotonic() - start, False)
+        error = LLMError(f'LLM API Error: {response.text}',
+                         retryable=response.status_code >= 500 or response.status_code == 429)
+        response.close()
+        raise error
+    return response
+
+def stream_llm_completion(llm, messages, temperature=0.7, answered_by=None):
+    """
+    以 stream=true 调用 LLM, 逐段 yield 文本 (OpenAI 兼容的 SSE 响应); 开始输出前失败时切换备用服务商
+    answered_by 同 request_llm_completion; 与非流式调用一样, 完整读完响应的耗时记为一次成功,
+    中途断开记为失败 (调用方提前停止读取时不记录)
+    """
+    if answered_by is None:
+        answered_by = {}
+    last_error = None
+    for provider in llm_provider_chain(llm):
+        start = time.monotonic()
+        try:
+            response = open_llm_stream(provider, messages, temperature)
+        except LLMError as e:
+            if not e.retryable:
+                raise
+            last_error = e
+            continue
             
-        result = response.json()
-        ai_content = result['choices'][0]['message']['content']
-        
-        # 4. Save to History
-        new_version = used_count + 1
-        history = AICommentHistory(
-            registration_id=registration_id,
-            version=new_version,
-            content=ai_content,
-            status='draft',
-            confirmed_by=session['user_id']
-        )
-        db.session.add(history)
+        answered_by['llm'] = provider
+        tracker = get_llm_latency_tracker(provider)
+        try:
+            for line in response.iter_lines(decode_unicode=False):
+                if not line.startswith(b'data:'):
+                    continue
+                data = line[5:].strip()
+                if data == b'[DONE]':
+                    break
+                choices = json.loads(data).get('choices') or [{}]
+                text = (choices[0].get('delta') or {}).get('content')
+                if text:
+                    yield text
+            tracker.record(time.monotonic() - start, True)
+        except (requests.exceptions.RequestException, ValueError):
+            tracker.record(time.monotonic() - start, False)
+            raise
+        finally:
+            response.close()
+        return
+    raise last_error
+
+def save_ai_comment_draft(registration_id, content, user_id=None, is_ai_generated=True):
+    """保存新版本草稿 (保存时重新校验配额), 返回 (body, status_code)"""
+    used_count = AICommentHistory.query.filter_by(registration_id=registration_id).count()
+    if used_count >= MAX_GENERATIONS:
+        return {
+            'success': False, 
+            'error': 'quota_exceeded', 
+            'message': f'已达到生成上限（{MAX_GENERATIONS}/{MAX_GENERATIONS}），无法继续生成。'
+        }, 400
+        
+    # 4. Save to History
+    new_version = used_count + 1
+    history = AICommentHistory(
+        registration_id=registration_id,
+        version=new_version,
+        content=content,
+        is_ai_generated=is_ai_generated,
+        status='draft',
+        confirmed_by=user_id
+    )
+    db.session.add(history)
+    db.session.commit()
+    
+    return {
+        'success': True,
+        'comment': {
+            'id': history.id,
+            'version': history.version,
+            'content': history.content,
+            'status': history.status,
+            'generated_at': history.generated_at.isoformat()
+        },
+        'remaining_quota': MAX_GENERATIONS - new_version
+    }, 200
+
+# --- AI Comment Cache ---
+# 短试卷上大量学生得分完全相同, 同一 试卷/模型/提示词版本/得分向量 只调用一次 LLM;
+# 缓存文本中学生姓名为占位符, 取出时替换为当前学生姓名. 表行数超过上限时按最近使用时间淘汰.
+# 失败切换/对冲后由备用服务商返回的文本不写入缓存, 缓存键中的模型始终是实际生成该文本的模型.
+
+ai_comment_cache_stats = {'hits': 0, 'misses': 0, 'bypassed': 0}
+ai_comment_cache_stats_lock = threading.Lock()
+
+def count_ai_comment_cache(key):
+    with ai_comment_cache_stats_lock:
+        ai_comment_cache_stats[key] += 1
+
+def normalize_score(value):
+    """8 / 8.0 / '8.00' 归一为同一个值"""
+    if value is None:
+        return None
+    return round(float(value), 2)
+
+def ai_comment_cache_key(template, llm, grade_level, total_score, score_vector):
+    payload = json.dumps([
+        AI_COMMENT_PROMPT_VERSION, llm['provider'], llm['model'],
+        template.id, template.name, grade_level, normalize_score(total_score), score_vector
+    ], ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def personalize_ai_comment(content, student_name):
+    return content.replace(AI_COMMENT_NAME_PLACEHOLDER, student_name or '')
+
+def split_name_placeholder(text):
+    """流式输出时拆出可安全替换的部分: 末尾可能是被截断的占位符前缀, 留待下一段"""
+    for size in range(min(len(text), len(AI_COMMENT_NAME_PLACEHOLDER) - 1), 0, -1):
+        if AI_COMMENT_NAME_PLACEHOLDER.startswith(text[-size:]):
+            return text[:-size], text[-size:]
+    return text, ''
+
+def read_ai_comment_cache(prepared):
+    """命中返回缓存文本 (含姓名占位符), 未命中或跳过缓存返回 None"""
+    if not app.config['AI_COMMENT_CACHE_ENABLED'] or not prepared['use_cache']:
+        count_ai_comment_cache('bypassed')
+        return None
+    entry = AICommentCache.query.filter_by(cache_key=prepared['cache_key']).first()
+    if not entry:
+        count_ai_comment_cache('misses')
+        return None
+    db.session.query(AICommentCache).filter_by(id=entry.id).update({
+        'hit_count': AICommentCache.hit_count + 1,
+        'last_used_at': datetime.utcnow()
+    }, synchronize_session=False)
+    db.session.commit()
+    count_ai_comment_cache('hits')
+    return entry.content
+
+def write_ai_comment_cache(prepared, content, answered_llm=None):
+    """
+    写入/覆盖缓存 (重新生成的新版本会替换旧文本)
+    answered_llm: 实际返回文本的服务商配置; 由备用服务商返回的文本不写入主模型的缓存键
+    """
+    from sqlalchemy.exc import IntegrityError
+    
+    if not app.config['AI_COMMENT_CACHE_ENABLED'] or not content or not content.strip():
+        return
+    if answered_llm is not None and llm_provider_label(answered_llm) != llm_provider_label(prepared['llm']):
+        return
+    entry = AICommentCache.query.filter_by(cache_key=prepared['cache_key']).first()
+    if entry:
+        entry.content = content
+        entry.last_used_at = datetime.utcnow()
+    else:
+        db.session.add(AICommentCache(
+            cache_key=prepared['cache_key'],
+            exam_template_id=prepared.get('template_id'),
+            model=prepared['llm']['model'],
+            prompt_version=AI_COMMENT_PROMPT_VERSION,
+            content=content
+        ))
+    try:
         db.session.commit()
-        
-        return jsonify({
-            'success': True,
-            'comment': {
-                'id': history.id,
-                'version': history.version,
-                'content': history.content,
-                'status': history.status,
-                'generated_at': history.generated_at.isoformat()
-            },
-            'remaining_quota': MAX_GENERATIONS - new_version
-        })
-        
-    except Exception as e:
-        return jsonify({'success': False, 'message': str(e)}), 500
+    except IntegrityError:
+        # Same key written concurrently by another worker; either text is fine
+        db.session.rollback()
+        return
+    evict_ai_comment_cache()
+
+def evict_ai_comment_cache():
+    """超过 AI_COMMENT_CACHE_MAX_ENTRIES 时删除最久未使用的条目 (降到上限的 90%)"""
+    max_entries = app.config['AI_COMMENT_CACHE_MAX_ENTRIES']
+    count = AICommentCache.query.count()
+    if count <= max_entries:
+        return
+    stale_ids = [row[0] for row in db.session.query(AICommentCache.id)
+                 .order_by(AICommentCache.last_used_at, AICommentCache.id)
+                 .limit(count - max(1, int(max_entries * 0.9))).all()]
+    for chunk in chunked(stale_ids):
+        AICommentCache.query.filter(AICommentCache.id.in_(chunk)).delete(synchronize_session=False)
+    db.session.commit()
+
+@app.route('/api/ai-comment/cache', methods=['GET'])
+@login_required
+@admin_required
+def ai_comment_cache_status():
+    """评语缓存统计 (命中/未命中为本进程计数)"""
+    entries, hits = db.session.query(db.func.count(AICommentCache.id), db.func.sum(AICommentCache.hit_count)).one()
+    with ai_comment_cache_stats_lock:
+        process_stats = dict(ai_comment_cache_stats)
+    return jsonify({
+        'success': True,
+        'enabled': app.config['AI_COMMENT_CACHE_ENABLED'],
+        'entries': entries,
+        'max_entries': app.config['AI_COMMENT_CACHE_MAX_ENTRIES'],
+        'total_hits': hits or 0,
+        'process': process_stats
+    })
+
+@app.route('/api/llm/latency', methods=['GET'])
+@login_required
+@admin_required
+def llm_latency_status():
+    """各 LLM 服务商近期延迟与失败统计 (本进程)"""
+    with llm_latency_trackers_lock:
+        trackers = dict(llm_latency_trackers)
+    return jsonify({
+        'success': True,
+        'hedge_enabled': app.config['LLM_HEDGE_ENABLED'],
+        'providers': {label: tracker.to_dict() for label, tracker in trackers.items()}
+    })
+
+@app.route('/api/ai-comment/cache', methods=['DELETE'])
+@login_required
+@admin_required
+def clear_ai_comment_cache():
+    """清空评语缓存"""
+    deleted = AICommentCache.query.delete(synchronize_session=False)
+    db.session.commit()
+    return jsonify({'success': True, 'deleted': deleted})
+
+class RateLimiter:
+    """令牌桶限速 (线程安全): 每分钟 rate_per_minute 次, 允许 burst 次突发"""
+    def __init__(self, rate_per_minute, burst=1):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = max(1, burst)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+        
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+llm_rate_limiters = {}
+llm_rate_limiters_lock = threading.Lock()
+
+def get_llm_rate_limiter(llm):
+    """按 provider/base_url 共享的限速器; LLM_RATE_PER_MINUTE=0 时不限速"""
+    rate = app.config['LLM_RATE_PER_MINUTE']
+    if rate <= 0:
+        return None
+    key = (llm['provider'], llm['base_url'], rate)
+    with llm_rate_limiters_lock:
+        if key not in llm_rate_limiters:
+            llm_rate_limiters[key] = RateLimiter(rate, burst=app.config['LLM_BATCH_CONCURRENCY'])
+        return llm_rate_limiters[key]
+
+def select_ai_comment_registrations(template_name, force=False, only_missing=True):
+    """
+    按试卷名称选出待生成评语的报名 (集合查询)
+    默认只选成绩已全部录入、尚无评语且未达配额的报名
+    Returns (registration_ids, counts)
+    """
+    template_ids = [t.id for t in ExamTemplate.query.filter_by(name=template_name).all()]
+    counts = {'total': 0, 'eligible': 0, 'skipped_incomplete': 0, 'skipped_existing': 0, 'skipped_quota': 0}
+    if not template_ids:
+        return [], counts
+        
+    question_counts = dict(db.session.query(Question.exam_template_id, db.func.count(Question.id))
+                           .filter(Question.exam_template_id.in_(template_ids))
+                           .group_by(Question.exam_template_id).all())
+    scored_counts = {(student_id, template_id): count for student_id, template_id, count in
+                     db.session.query(Score.student_id, Score.exam_template_id, db.func.count(Score.id))
+                     .filter(Score.exam_template_id.in_(template_ids))
+                     .group_by(Score.student_id, Score.exam_template_id).all()}
+    registrations = ExamRegistration.query.filter(ExamRegistration.exam_template_id.in_(template_ids))\
+        .order_by(ExamRegistration.id).all()
+    used_counts = {}
+    for chunk in chunked([r.id for r in registrations]):
+        used_counts.update(db.session.query(AICommentHistory.registration_id, db.func.count(AICommentHistory.id))
+                           .filter(AICommentHistory.registration_id.in_(chunk))
+                           .group_by(AICommentHistory.registration_id).all())
+        
+    registration_ids = []
+    for reg in registrations:
+        counts['total'] += 1
+        total = question_counts.get(reg.exam_template_id, 0)
+        scored = scored_counts.get((reg.student_id, reg.exam_template_id), 0)
+        used = used_counts.get(reg.id, 0)
+        if not force and (total == 0 or scored < total):
+            counts['skipped_incomplete'] += 1
+        elif used >= MAX_GENERATIONS:
+            counts['skipped_quota'] += 1
+        elif only_missing and used > 0:
+            counts['skipped_existing'] += 1
+        else:
+            registration_ids.append(reg.id)
+    counts['eligible'] = len(registration_ids)
+    return registration_ids, counts
 
 @app.route('/api/ai-comment/history', methods=['GET'])
 @login_required
@@ -786,7 +1682,6 @@ def get_ai_comment_history():
         
     history = AICommentHistory.query.filter_by(registration_id=registration_id).order_by(AICommentHistory.version.asc()).all()
     
-    MAX_GENERATIONS = 3
     used_count = len(history)
     
     return jsonify({
@@ -834,11 +1729,43 @@ def confirm_ai_comment():
     
     report_card.confirmed_comment_id = comment.id
     report_card.teacher_comment = content 
+    invalidate_report_card_cache([comment.registration_id])
     
     db.session.commit()
     
     return jsonify({'success': True, 'message': '评语已确认'})
 
+@app.route('/api/ai-comment/batch-generate', methods=['POST'])
+@login_required
+def batch_generate_ai_comments():
+    """按试卷名称批量生成AI评语草稿 (后台任务, 返回 job_id)"""
+    data = request.get_json() or {}
+    template_name = data.get('template_name')
+    if not template_name:
+        return jsonify({'success': False, 'message': 'Missing template_name'}), 400
+        
+    setting = SystemSetting.query.first()
+    if not setting or not setting.llm_api_key:
+        return jsonify({'success': False, 'message': 'LLM API尚未配置，请联系管理员。'}), 500
+        
+    registration_ids, counts = select_ai_comment_registrations(
+        template_name, data.get('force', False), data.get('only_missing', True))
+    if not registration_ids:
+        return jsonify({'success': False, 'message': '没有需要生成评语的考生', 'counts': counts}), 400
+        
+    job = submit_job('ai_comment', {
+        'registration_ids': registration_ids,
+        'force': data.get('force', False),
+        'fresh': data.get('fresh', False),
+        'rule_fallback': data.get('rule_fallback', False)
+    }, session.get('user_id'))
+    return jsonify({
+        'success': True,
+        'job_id': job.id,
+        'status_url': url_for('api_job_status', job_id=job.id),
+        'counts': counts
+    }), 202
+
 @app.route('/registration')
 @login_required
 def registration():
@@ -1051,46 +1978,27 @@ def api_score_entry_students():
         return jsonify([])
         
     try:
-        # 2. Find all students registered for these templates
+        # 2. All students registered for these templates with their scoring progress
+        # (maintained on the registration by refresh_registration_totals, single query)
         query = db.session.query(
-            ExamRegistration, Student, ExamSession, ExamTemplate
-        ).join(Student)\
+            Student.id, Student.student_id, Student.name, ExamSession.name,
+            ExamTemplate.total_questions, ExamRegistration.scored_count, ExamRegistration.status
+        ).select_from(ExamRegistration)\
+         .join(Student, ExamRegistration.student_id == Student.id)\
          .join(ExamSession, ExamRegistration.exam_session_id == ExamSession.id)\
          .join(ExamTemplate, ExamRegistration.exam_template_id == ExamTemplate.id)\
          .filter(ExamRegistration.exam_template_id.in_(template_ids))\
          .order_by(ExamSession.exam_date, Student.student_id)
          
-        registrations = query.all()
-         
-        # 3. Check scoring status for each student
         results = []
-        for reg, student, session_obj, template in registrations:
-            # Get total questions count
-            total_q = template.total_questions
-            # Get scored count
-            # Note: This is a bit expensive (N+1), but for <1000 students it's okay for now. 
-            # Can be optimized with a group by query later if needed.
-            # We need to find questions for this template
-            q_ids = db.session.query(Question.id).filter_by(exam_template_id=template.id).all()
-            q_ids = [q[0] for q in q_ids]
-            
-            scored_count = 0
-            if q_ids:
-                scored_count = Score.query.filter(
-                    Score.student_id == student.id,
-                    Score.question_id.in_(q_ids)
-                ).count()
-                
-            status = 'completed' if scored_count >= total_q and total_q > 0 else \
-                     'in_progress' if scored_count > 0 else 'pending'
-                     
+        for student_pk, student_code, name, session_name, total_q, scored_count, status in query.all():
             results.append({
-                'student_id': student.id,
-                'student_code': student.student_id,
-                'name': student.name,
-                'session_name': session_obj.name,
-                'status': status,
-                'scored_count': scored_count,
+                'student_id': student_pk,
+                'student_code': student_code,
+                'name': name,
+                'session_name': session_name,
+                'status': status or 'pending',
+                'scored_count': scored_count or 0,
                 'total_questions': total_q
             })
             
@@ -1100,12 +2008,113 @@ def api_score_entry_students():
         traceback.print_exc()
         return jsonify({'error': str(e)}), 500
 
-@app.route('/api/score-entry/student-detail/<int:student_id>')
-@login_required
-def api_score_entry_student_detail(student_id):
-    """获取单个考生的录入详情 (题目 + 已有分数)"""
-    template_name = request.args.get('template_name')
-    
+# --- Score Entry Roster ---
+# 登分页上一名/下一名: 每个试卷名称的考生顺序 (考试日期, 考号) 缓存在进程内, 位置查找 O(1).
+# 本进程内的报名/考生/场次/试卷变更立即失效; 其他进程的增删由 (报名数, 最大报名ID) 戳发现
+# (每 ROSTER_STAMP_INTERVAL 秒最多查一次, 其间导航不访问数据库), TTL 兜底.
+
+class RosterIndex:
+    """试卷名称下的有序考生ID及位置表"""
+    def __init__(self, student_ids, stamp):
+        self.student_ids = student_ids
+        self.positions = {}
+        for position, student_id in enumerate(student_ids):
+            self.positions.setdefault(student_id, position)
+        self.stamp = stamp
+        self.loaded_at = self.checked_at = time.monotonic()
+
+    def neighbours(self, student_id):
+        """(prev_id, next_id), 不在名单中返回 (None, None)"""
+        position = self.positions.get(student_id)
+        if position is None:
+            return None, None
+        prev_id = self.student_ids[position - 1] if position > 0 else None
+        next_id = self.student_ids[position + 1] if position + 1 < len(self.student_ids) else None
+        return prev_id, next_id
+
+roster_indexes = {}
+roster_indexes_lock = threading.Lock()
+
+def roster_stamp(template_name):
+    """(报名数, 最大报名ID): 其他进程增删报名后变化"""
+    count, max_id = db.session.query(db.func.count(ExamRegistration.id), db.func.max(ExamRegistration.id))\
+        .join(ExamTemplate, ExamRegistration.exam_template_id == ExamTemplate.id)\
+        .filter(ExamTemplate.name == template_name).one()
+    return count, max_id
+
+def get_roster_index(template_name):
+    """试卷名称对应的考生顺序, 与考生列表一致: ExamSession.exam_date, Student.student_id"""
+    now = time.monotonic()
+    with roster_indexes_lock:
+        index = roster_indexes.get(template_name)
+    if index and now - index.loaded_at >= app.config['ROSTER_CACHE_TTL']:
+        index = None
+    if index and now - index.checked_at < app.config['ROSTER_STAMP_INTERVAL']:
+        return index
+    stamp = roster_stamp(template_name)
+    if index and index.stamp == stamp:
+        index.checked_at = now
+        return index
+    
+    rows = db.session.query(Student.id)\
+        .join(ExamRegistration, Student.id == ExamRegistration.student_id)\
+        .join(ExamSession, ExamRegistration.exam_session_id == ExamSession.id)\
+        .join(ExamTemplate, ExamRegistration.exam_template_id == ExamTemplate.id)\
+        .filter(ExamTemplate.name == template_name)\
+        .order_by(ExamSession.exam_date, Student.student_id)\
+        .all()
+    index = RosterIndex([row[0] for row in rows], stamp)
+    with roster_indexes_lock:
+        roster_indexes[template_name] = index
+    return index
+
+def clear_roster_indexes():
+    with roster_indexes_lock:
+        roster_indexes.clear()
+
+# Columns that decide roster membership or order
+ROSTER_COLUMNS = {
+    'ExamRegistration': ('student_id', 'exam_session_id', 'exam_template_id'),
+    'Student': ('student_id',),
+    'ExamSession': ('exam_date',),
+    'ExamTemplate': ('name',)
+}
+
+@event.listens_for(db.session, 'after_flush')
+def invalidate_roster_on_flush(flush_session, flush_context):
+    """本进程 ORM 写入涉及名单成员或排序时清空缓存 (score_revision 等批量 UPDATE 不影响)"""
+    for obj in flush_session.new | flush_session.deleted:
+        if type(obj).__name__ in ROSTER_COLUMNS:
+            clear_roster_indexes()
+            return
+    for obj in flush_session.dirty:
+        columns = ROSTER_COLUMNS.get(type(obj).__name__)
+        if columns:
+            state = inspect(obj)
+            if any(state.attrs[column].history.has_changes() for column in columns):
+                clear_roster_indexes()
+                return
+
+def question_sort_key(q):
+    """题号自然排序 (Q1, Q2, Q10 而非 Q1, Q10, Q2)"""
+    import re
+    parts = re.split(r'(\d+)', q.question_number)
+    return [int(p) if p.isdigit() else p for p in parts]
+
+def template_questions_payload(template_id):
+    """试卷题目元数据 (已排序) 及其强 ETag; 同一试卷的所有考生共用"""
+    questions = sorted(Question.query.filter_by(exam_template_id=template_id).all(), key=question_sort_key)
+    payload = [{
+        'id': q.id,
+        'number': q.question_number,
+        'score': q.score, # max score
+        'module': q.module
+    } for q in questions]
+    etag = hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+    return payload, etag
+
+def score_entry_student_payload(student_id, template_name):
+    """单个考生的录入数据 (不含题目): 分数、评语、AI生成次数、导航; 未报名返回 None"""
     # 1. Get Registration and Template
     query = db.session.query(ExamRegistration, ExamTemplate)\
         .join(ExamTemplate, ExamRegistration.exam_template_id == ExamTemplate.id)\
@@ -1117,89 +2126,141 @@ def api_score_entry_student_detail(student_id):
     reg_data = query.first()
     
     if not reg_data:
-        return jsonify({'error': 'Registration not found'}), 404
+        return None
         
     reg, template = reg_data
     
-    # 2. Get Questions
-    questions = Question.query.filter_by(exam_template_id=template.id).all()
-    
-    # Natural sort
-    def natural_sort_key(q):
-        import re
-        parts = re.split(r'(\d+)', q.question_number)
-        return [int(p) if p.isdigit() else p for p in parts]
-    questions.sort(key=natural_sort_key)
-    
-    # 3. Get Scores
-    q_ids = [q.id for q in questions]
-    scores = []
-    if q_ids:
-        saved_scores = Score.query.filter(
-            Score.student_id == student_id,
-            Score.question_id.in_(q_ids)
-        ).all()
-        scores = {s.question_id: s.score for s in saved_scores}
+    # 2. Get Scores
+    scores = registration_scores(reg)
         
-    # 3.1 Get Report Card Comment
+    # 3. Get Report Card Comment
     report_card = ReportCard.query.filter_by(registration_id=reg.id).first()
     ai_comment = report_card.ai_comment if report_card else ""
 
     # Get AI Generation Count
     ai_gen_count = AICommentHistory.query.filter_by(registration_id=reg.id).count()
         
-    # 4. Navigation (Prev/Next)
+    # 4. Navigation (Prev/Next), from the cached roster order
     prev_id = None
     next_id = None
     
     if template_name:
-        # Find all template IDs with this name
-        templates = ExamTemplate.query.filter_by(name=template_name).all()
-        template_ids = [t.id for t in templates]
-        
-        # Get sorted list of student IDs
-        # Order must match the list view: ExamSession.exam_date, Student.student_id
-        student_ids_tuples = db.session.query(Student.id)\
-            .join(ExamRegistration, Student.id == ExamRegistration.student_id)\
-            .join(ExamSession, ExamRegistration.exam_session_id == ExamSession.id)\
-            .filter(ExamRegistration.exam_template_id.in_(template_ids))\
-            .order_by(ExamSession.exam_date, Student.student_id)\
-            .all()
-            
-        all_ids = [s[0] for s in student_ids_tuples]
-        
-        try:
-            curr_idx = all_ids.index(student_id)
-            if curr_idx > 0:
-                prev_id = all_ids[curr_idx - 1]
-            if curr_idx < len(all_ids) - 1:
-                next_id = all_ids[curr_idx + 1]
-        except ValueError:
-            pass
+        prev_id, next_id = get_roster_index(template_name).neighbours(student_id)
             
-    # 5. Construct Response
-    return jsonify({
+    return {
         'student': {
             'id': student_id,
             'name': reg.student.name,
             'student_id': reg.student.student_id,
             'template_name': template.name
         },
-        'questions': [{
-            'id': q.id,
-            'number': q.question_number,
-            'score': q.score, # max score
-            'module': q.module
-        } for q in questions],
+        'template_id': template.id,
         'scores': scores,
+        'registration': {
+            'id': reg.id,
+            'revision': reg.score_revision or 0
+        },
         'ai_comment': ai_comment,
         'ai_gen_count': ai_gen_count,
         'navigation': {
             'prev_id': prev_id,
             'next_id': next_id
         }
-    })
+    }
+
+@app.route('/api/score-entry/templates/<int:template_id>/questions')
+@login_required
+def api_score_entry_template_questions(template_id):
+    """试卷题目列表 (强 ETag, 客户端缓存后只需 304 校验)"""
+    template = ExamTemplate.query.get_or_404(template_id)
+    questions, etag = template_questions_payload(template.id)
+    
+    response = jsonify({'template_id': template.id, 'template_name': template.name, 'questions': questions})
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True # always revalidate via ETag
+    return response.make_conditional(request)
 
+@app.route('/api/score-entry/student-scores/<int:student_id>')
+@login_required
+def api_score_entry_student_scores(student_id):
+    """单个考生的分数/评语/导航 (题目见 /api/score-entry/templates/<id>/questions)"""
+    payload = score_entry_student_payload(student_id, request.args.get('template_name'))
+    if not payload:
+        return jsonify({'error': 'Registration not found'}), 404
+    return jsonify(payload)
+
+@app.route('/api/score-entry/student-detail/<int:student_id>')
+@login_required
+def api_score_entry_student_detail(student_id):
+    """获取单个考生的录入详情 (题目 + 已有分数)"""
+    payload = score_entry_student_payload(student_id, request.args.get('template_name'))
+    if not payload:
+        return jsonify({'error': 'Registration not found'}), 404
+    payload['questions'], _ = template_questions_payload(payload['template_id'])
+    return jsonify(payload)
+
+
+@event.listens_for(db.session, 'before_flush')
+def fill_score_exam_template_id(flush_session, flush_context, instances):
+    """ORM 新增的 Score (测试、导入脚本等) 自动补齐 exam_template_id"""
+    new_scores = [obj for obj in flush_session.new if isinstance(obj, Score) and obj.exam_template_id is None]
+    if not new_scores:
+        return
+    with flush_session.no_autoflush:
+        q_ids = set(s.question_id for s in new_scores if s.question_id)
+        template_by_question = {}
+        for chunk in chunked(q_ids):
+            template_by_question.update(db.session.query(Question.id, Question.exam_template_id)
+                                        .filter(Question.id.in_(chunk)).all())
+        for s in new_scores:
+            s.exam_template_id = template_by_question.get(s.question_id)
+
+def upsert_scores(rows, existing=None):
+    """
+    批量写入分数 rows: [{student_id, question_id, exam_template_id, score, is_correct}] (不提交事务)
+    依赖 (student_id, question_id) 唯一约束: SQLite/PostgreSQL 用 INSERT ... ON CONFLICT DO UPDATE,
+    MySQL 用 ON DUPLICATE KEY UPDATE; 其他数据库按 existing ({question_id: score}) 分为批量插入/更新
+    """
+    if not rows:
+        return
+    now = datetime.utcnow()
+    values = [dict(row, scoring_time=now) for row in rows]
+    dialect = db.engine.dialect.name
+    
+    if dialect in ('sqlite', 'postgresql', 'mysql'):
+        if dialect == 'sqlite':
+            from sqlalchemy.dialects.sqlite import insert
+        elif dialect == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert
+        else:
+            from sqlalchemy.dialects.mysql import insert
+        # One compiled statement executed with executemany (no per-chunk multi-VALUES compilation)
+        stmt = insert(Score.__table__)
+        if dialect == 'mysql':
+            stmt = stmt.on_duplicate_key_update(
+                score=stmt.inserted.score, is_correct=stmt.inserted.is_correct, scoring_time=stmt.inserted.scoring_time,
+                exam_template_id=stmt.inserted.exam_template_id)
+        else:
+            stmt = stmt.on_conflict_do_update(
+                index_elements=['student_id', 'question_id'],
+                set_={'score': stmt.excluded.score, 'is_correct': stmt.excluded.is_correct,
+                      'scoring_time': stmt.excluded.scoring_time,
+                      'exam_template_id': stmt.excluded.exam_template_id})
+        for chunk in chunked(values, 1000):
+            db.session.execute(stmt, chunk)
+        return
+        
+    existing = existing or {}
+    new_rows = [row for row in values if row['question_id'] not in existing]
+    if new_rows:
+        db.session.bulk_insert_mappings(Score, new_rows)
+    updated = [row for row in values if row['question_id'] in existing]
+    for row in updated:
+        Score.query.filter_by(student_id=row['student_id'], question_id=row['question_id'])\
+            .update({'score': row['score'], 'is_correct': row['is_correct'], 'scoring_time': row['scoring_time'],
+                     'exam_template_id': row['exam_template_id']},
+                    synchronize_session=False)
 
 @app.route('/api/score-entry/save', methods=['POST'])
 @login_required
@@ -1247,38 +2308,44 @@ def api_score_entry_save():
                         report_card = ReportCard(registration_id=reg.id)
                         db.session.add(report_card)
                     report_card.ai_comment = ai_comment
+                    invalidate_report_card_cache([reg.id])
                              
+            # 1. Load every referenced question and the student's existing scores (two queries)
+            q_ids = set()
+            for q_id_str in scores_dict.keys():
+                try:
+                    q_ids.add(int(q_id_str))
+                except (TypeError, ValueError):
+                    continue
+            questions = {q.id: q for q in Question.query.filter(Question.id.in_(q_ids)).all()} if q_ids else {}
+            existing = dict(db.session.query(Score.question_id, Score.score)
+                            .filter(Score.student_id == student_id, Score.question_id.in_(list(questions))).all()) if questions else {}
+            
+            # 2. Validate in memory; nothing is written unless every value is valid
+            rows = []
             for q_id_str, score_val in scores_dict.items():
-                q_id = int(q_id_str)
-                # Logic reused for each score
-                # 1. Check Question
-                question = Question.query.get(q_id)
+                question = questions.get(to_int(q_id_str))
                 if not question:
                     continue # Skip invalid questions
-                
-                # 2. Validate
                 try:
                     val = float(score_val)
                     if val < 0 or val > question.score:
                         return jsonify({'success': False, 'message': f'题目Q{question.question_number}分数必须在 0 - {question.score} 之间'}), 400
-                except ValueError:
+                except (TypeError, ValueError):
                     return jsonify({'success': False, 'message': f'题目Q{question.question_number}分数必须是数字'}), 400
+                if existing.get(question.id) == val:
+                    continue # Unchanged
+                rows.append({'student_id': student_id, 'question_id': question.id,
+                             'exam_template_id': question.exam_template_id,
+                             'score': val, 'is_correct': val == question.score})
                 
-                # 3. Upsert
-                score = Score.query.filter_by(student_id=student_id, question_id=q_id).first()
-                if score:
-                    score.score = val
-                    score.is_correct = (val == question.score)
-                    score.scoring_time = datetime.utcnow()
-                else:
-                    score = Score(
-                        student_id=student_id,
-                        question_id=q_id,
-                        score=val,
-                        is_correct=(val == question.score)
-                    )
-                    db.session.add(score)
+            # 3. Upsert in bulk
+            upsert_scores(rows, existing)
+            touched_template_ids = {questions[row['question_id']].exam_template_id for row in rows}
             
+            invalidate_student_report_cards(student_id, touched_template_ids)
+            bump_score_revision(student_id, touched_template_ids)
+            refresh_registration_totals(student_id=student_id, template_ids=touched_template_ids)
             db.session.commit()
             return jsonify({'success': True})
             
@@ -1315,19 +2382,17 @@ def api_score_entry_save():
             except ValueError:
                  return jsonify({'success': False, 'message': '分数必须是数字'}), 400
         
-        if score:
-            score.score = float(score_value)
-            score.is_correct = (score.score == question.score)
-            score.scoring_time = datetime.utcnow()
-        else:
-            score = Score(
-                student_id=student_id,
-                question_id=question_id,
-                score=float(score_value),
-                is_correct=(float(score_value) == question.score)
-            )
-            db.session.add(score)
+        upsert_scores([{
+            'student_id': student_id,
+            'question_id': question.id,
+            'exam_template_id': question.exam_template_id,
+            'score': float(score_value),
+            'is_correct': float(score_value) == question.score
+        }], {score.question_id: score.score} if score else {})
             
+        invalidate_student_report_cards(student_id, [question.exam_template_id])
+        bump_score_revision(student_id, [question.exam_template_id])
+        refresh_registration_totals(student_id=student_id, template_ids=[question.exam_template_id])
         db.session.commit()
         return jsonify({'success': True})
         
@@ -1335,15 +2400,324 @@ def api_score_entry_save():
         db.session.rollback()
         return jsonify({'success': False, 'message': str(e)}), 500
 
-# API removed per user request (v2.2)
+def bump_score_revision(student_id, template_ids):
+    """全量保存路径: 使对应报名的 score_revision +1, 增量保存的客户端据此发现冲突"""
+    template_ids = [t for t in template_ids if t]
+    if not template_ids:
+        return
+    db.session.query(ExamRegistration).filter(
+        ExamRegistration.student_id == student_id,
+        ExamRegistration.exam_template_id.in_(template_ids)
+    ).update({'score_revision': ExamRegistration.score_revision + 1}, synchronize_session=False)
+
+def registration_totals_values():
+    """UPDATE exam_registrations 的 SET 子句: 由该报名试卷下的 Score 行 (相关子查询) 计算汇总"""
+    reg = ExamRegistration.__table__
+    
+    def aggregate(expr, *criteria):
+        return db.select(expr)\
+            .where(Score.exam_template_id == reg.c.exam_template_id, Score.student_id == reg.c.student_id, *criteria)\
+            .scalar_subquery()
+    
+    scored = aggregate(db.func.count(Score.id))
+    total_questions = db.select(ExamTemplate.total_questions)\
+        .where(ExamTemplate.id == reg.c.exam_template_id).scalar_subquery()
+    return {
+        'score': aggregate(db.func.sum(Score.score)),
+        'scored_count': scored,
+        'correct_count': aggregate(db.func.count(Score.id), Score.is_correct == True),
+        'last_scored_at': aggregate(db.func.max(Score.scoring_time)),
+        'status': db.case(
+            (scored == 0, 'pending'),
+            (db.and_(total_questions > 0, scored >= total_questions), 'completed'),
+            else_='in_progress'
+        )
+    }
+
+def refresh_registration_totals(registration_ids=None, student_id=None, template_ids=None):
+    """
+    重新计算报名的总分/已录题数/满分题数/状态/最近录入时间 (不提交事务)
+    按 registration_ids, 或 student_id + template_ids, 或仅 template_ids 限定范围; 全部为空时刷新所有报名 (回填)
+    只刷新受影响的报名, 且每次由 Score 行重新汇总, 并发保存不会累积误差
+    """
+    reg = ExamRegistration.__table__
+    stmt = reg.update().values(**registration_totals_values())
+    if registration_ids is not None:
+        for chunk in chunked(set(r for r in registration_ids if r)):
+            db.session.execute(stmt.where(reg.c.id.in_(chunk)))
+        return
+    if template_ids is not None:
+        template_ids = [t for t in template_ids if t]
+        if not template_ids:
+            return
+        stmt = stmt.where(reg.c.exam_template_id.in_(template_ids))
+    if student_id is not None:
+        stmt = stmt.where(reg.c.student_id == student_id)
+    db.session.execute(stmt)
+
+def registration_scores(reg):
+    """报名对应试卷的已录入分数 {question_id: score}"""
+    rows = db.session.query(Score.question_id, Score.score)\
+        .filter(Score.exam_template_id == reg.exam_template_id, Score.student_id == reg.student_id)\
+        .all()
+    return dict(rows)
 
+@app.route('/api/score-entry/save-delta', methods=['POST'])
 @login_required
-def api_students_by_session(exam_session_id):
-    """获取指定考试场次的学生列表"""
-    grade = request.args.get('grade')
-    subject = request.args.get('subject') # Optional subject filter
-    
-    # 获取当前用户
+def api_score_entry_save_delta():
+    """
+    增量保存分数 {registration_id, revision, changes: {question_id: score|null}}
+    只提交修改过的题目 (null 表示清空); revision 已过期时返回 409 及冲突题目的当前分数,
+    成功时返回新的 revision
+    """
+    data = request.get_json() or {}
+    reg = ExamRegistration.query.get(to_int(data.get('registration_id')))
+    if not reg:
+        return jsonify({'success': False, 'message': 'Registration not found'}), 404
+    revision = to_int(data.get('revision'))
+    changes = data.get('changes')
+    if revision is None or not isinstance(changes, dict):
+        return jsonify({'success': False, 'message': 'Missing revision or changes'}), 400
+    
+    # 1. Validate in memory against the registration's template
+    q_ids = [q_id for q_id in (to_int(key) for key in changes) if q_id is not None]
+    questions = {q.id: q for q in Question.query.filter(
+        Question.id.in_(q_ids), Question.exam_template_id == reg.exam_template_id
+    ).all()} if q_ids else {}
+    requested = {}  # {question_id: score|None}
+    for q_id_str, score_val in changes.items():
+        question = questions.get(to_int(q_id_str))
+        if not question:
+            return jsonify({'success': False, 'message': f'题目 {q_id_str} 不属于该试卷'}), 400
+        if score_val is None or score_val == '':
+            requested[question.id] = None
+            continue
+        try:
+            val = float(score_val)
+        except (TypeError, ValueError):
+            return jsonify({'success': False, 'message': f'题目Q{question.question_number}分数必须是数字'}), 400
+        if val < 0 or val > question.score:
+            return jsonify({'success': False, 'message': f'题目Q{question.question_number}分数必须在 0 - {question.score} 之间'}), 400
+        requested[question.id] = val
+    
+    try:
+        # 2. Claim the next revision (conditional UPDATE); no row means someone else saved first
+        claimed = db.session.query(ExamRegistration)\
+            .filter(ExamRegistration.id == reg.id, ExamRegistration.score_revision == revision)\
+            .update({'score_revision': ExamRegistration.score_revision + 1}, synchronize_session=False)
+        if not claimed:
+            db.session.rollback()
+            current = registration_scores(reg)
+            return jsonify({
+                'success': False,
+                'error': 'conflict',
+                'message': '该考生成绩已被他人修改',
+                'revision': db.session.query(ExamRegistration.score_revision).filter_by(id=reg.id).scalar(),
+                'scores': current,
+                'conflicts': {q_id: current.get(q_id) for q_id, val in requested.items() if current.get(q_id) != val}
+            }), 409
+        
+        # 3. Write only the edited cells
+        upsert_scores([{'student_id': reg.student_id, 'question_id': q_id,
+                        'exam_template_id': reg.exam_template_id, 'score': val, 'is_correct': val == questions[q_id].score}
+                       for q_id, val in requested.items() if val is not None])
+        cleared = [q_id for q_id, val in requested.items() if val is None]
+        if cleared:
+            Score.query.filter(Score.exam_template_id == reg.exam_template_id, Score.student_id == reg.student_id,
+                               Score.question_id.in_(cleared))\
+                .delete(synchronize_session=False)
+        if requested:
+            invalidate_report_card_cache([reg.id])
+            refresh_registration_totals([reg.id])
+        db.session.commit()
+        return jsonify({'success': True, 'revision': revision + 1})
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+# --- Score Matrix ---
+# 整张试卷一次提交 考生×题目 成绩矩阵 (JSON 或粘贴的 TSV/CSV): 全部格子向量化校验, 有效格子一个事务写入,
+# 返回逐格错误报告, 替代逐个考生提交表单.
+
+def parse_score_matrix(data):
+    """
+    解析成绩矩阵 -> DataFrame (第一列为考号, 其余列为题号, 值为去空白的字符串)
+    JSON: {columns: [题号...], rows: [[考号, 分数...], ...]}; 粘贴文本: {text} 首行为表头, 制表符或逗号分隔
+    """
+    text = data.get('text')
+    if text is not None:
+        text = str(text).strip()
+        if not text:
+            raise ValueError('成绩表为空')
+        sep = '\t' if '\t' in text.splitlines()[0] else ','
+        try:
+            df = pd.read_csv(io.StringIO(text), sep=sep, dtype=str, keep_default_na=False)
+        except pd.errors.ParserError as e:
+            raise ValueError(f'无法解析成绩表: {e}')
+    else:
+        columns, rows = data.get('columns'), data.get('rows')
+        if not isinstance(columns, list) or not isinstance(rows, list):
+            raise ValueError('Missing columns or rows')
+        width = len(columns) + 1
+        cells = [['' if v is None else str(v) for v in list(row)[:width]] + [''] * (width - len(row)) for row in rows]
+        df = pd.DataFrame(cells, columns=['考号'] + [str(c) for c in columns], dtype=str)
+    
+    if df.shape[1] < 2:
+        raise ValueError('成绩表至少需要考号列和一道题目')
+    df.columns = [str(c).strip() for c in df.columns]
+    return df.fillna('').apply(lambda col: col.str.strip())
+
+def match_question_column(label, known_numbers):
+    """表头 -> 题号 ("Q3" / "3" 均可), 无法匹配返回 None"""
+    if label in known_numbers:
+        return label
+    if label[:1] in ('Q', 'q') and label[1:].strip() in known_numbers:
+        return label[1:].strip()
+    return None
+
+def apply_score_matrix(template_ids, df, dry_run=False):
+    """
+    校验并写入成绩矩阵, 返回报告 dict
+    空格子忽略; 非数字 / 超出 0 - Question.score / 题号不存在 / 考号未报名 逐格报告, 其余有效格子写入
+    """
+    # 1. Registrations and questions for the template(s), two queries
+    roster = {}  # 考号 -> (student pk, registration id, template id)
+    for code, student_pk, reg_id, template_id in db.session.query(
+            Student.student_id, Student.id, ExamRegistration.id, ExamRegistration.exam_template_id)\
+            .join(ExamRegistration, ExamRegistration.student_id == Student.id)\
+            .filter(ExamRegistration.exam_template_id.in_(template_ids)).order_by(ExamRegistration.id):
+        roster.setdefault(str(code), (student_pk, reg_id, template_id))
+    questions = {}  # template id -> {题号: (question id, 满分)}
+    for q_id, template_id, number, max_score in db.session.query(
+            Question.id, Question.exam_template_id, Question.question_number, Question.score)\
+            .filter(Question.exam_template_id.in_(template_ids)):
+        questions.setdefault(template_id, {})[str(number).strip()] = (q_id, max_score)
+    known_numbers = set().union(*questions.values()) if questions else set()
+    
+    errors = []
+    codes = df.iloc[:, 0].tolist()
+    headers = list(df.columns[1:])
+    numbers = [match_question_column(label, known_numbers) for label in headers]
+    for label, number in zip(headers, numbers):
+        if number is None:
+            errors.append({'row': None, 'student_code': None, 'question': label, 'value': None, 'message': '题号不存在'})
+    keep = [j for j, number in enumerate(numbers) if number is not None]
+    numbers = [numbers[j] for j in keep]
+    
+    # 2. Row checks: unknown or duplicated student codes
+    row_info = [roster.get(code) for code in codes]
+    duplicated = pd.Series(codes).duplicated().to_numpy()
+    for i, code in enumerate(codes):
+        if row_info[i] is None:
+            errors.append({'row': i + 1, 'student_code': code, 'question': None, 'value': None, 'message': '考号未报名该试卷'})
+        elif duplicated[i]:
+            errors.append({'row': i + 1, 'student_code': code, 'question': None, 'value': None, 'message': '考号重复'})
+    valid_row = np.array([info is not None for info in row_info], dtype=bool) & ~duplicated
+    
+    # 3. Cell checks, vectorized over the whole matrix
+    raw = df.iloc[:, [j + 1 for j in keep]]
+    values = raw.apply(pd.to_numeric, errors='coerce').to_numpy(dtype=float)
+    raw = raw.to_numpy(dtype=object)
+    n_rows, n_cols = raw.shape
+    question_ids = np.full((n_rows, n_cols), -1, dtype=np.int64)
+    maxima = np.full((n_rows, n_cols), np.nan)
+    row_template = np.array([info[2] if info else -1 for info in row_info], dtype=np.int64)
+    for template_id, by_number in questions.items():
+        rows_t = row_template == template_id
+        for j, number in enumerate(numbers):
+            if number in by_number:
+                question_ids[rows_t, j], maxima[rows_t, j] = by_number[number]
+    
+    filled = (raw != '') & valid_row[:, None]
+    not_number = filled & np.isnan(values)
+    no_question = filled & ~not_number & (question_ids < 0)
+    with np.errstate(invalid='ignore'):
+        out_of_range = filled & ~not_number & ~no_question & ((values < 0) | (values > maxima))
+    valid = filled & ~not_number & ~no_question & ~out_of_range
+    
+    for mask, message in ((not_number, '不是数字'), (no_question, '该考生的试卷没有此题'), (out_of_range, None)):
+        for i, j in zip(*np.nonzero(mask)):
+            errors.append({'row': int(i) + 1, 'student_code': codes[i], 'question': numbers[j], 'value': raw[i, j],
+                           'message': message or f'超出范围 0 - {maxima[i, j]:g}'})
+    
+    # 4. Drop cells equal to the stored score, write the rest in one transaction
+    student_pks = [info[0] for info in row_info if info]
+    existing = {}
+    if student_pks:
+        for chunk in chunked(set(student_pks)):
+            existing.update({(s_id, q_id): score for s_id, q_id, score in db.session.query(
+                Score.student_id, Score.question_id, Score.score)
+                .filter(Score.exam_template_id.in_(template_ids), Score.student_id.in_(chunk))})
+    rows, touched = [], set()
+    for i, j in zip(*np.nonzero(valid)):
+        student_pk, reg_id, template_id = row_info[i]
+        q_id, val = int(question_ids[i, j]), float(values[i, j])
+        if existing.get((student_pk, q_id)) == val:
+            continue
+        rows.append({'student_id': student_pk, 'question_id': q_id, 'exam_template_id': template_id,
+                     'score': val, 'is_correct': bool(val == maxima[i, j])})
+        touched.add(reg_id)
+    
+    if not dry_run and rows:
+        upsert_scores(rows)
+        for chunk in chunked(touched):
+            db.session.query(ExamRegistration).filter(ExamRegistration.id.in_(chunk))\
+                .update({'score_revision': ExamRegistration.score_revision + 1}, synchronize_session=False)
+        invalidate_report_card_cache(list(touched))
+        refresh_registration_totals(touched)
+        db.session.commit()
+    
+    errors.sort(key=lambda e: (e['row'] or 0, e['question'] or ''))
+    return {
+        'rows': n_rows,
+        'valid_cells': int(valid.sum()),
+        'written': 0 if dry_run else len(rows),
+        'unchanged': int(valid.sum()) - len(rows),
+        'students': len(touched),
+        'dry_run': dry_run,
+        'errors': errors
+    }
+
+@app.route('/api/score-entry/matrix', methods=['POST'])
+@login_required
+def api_score_entry_matrix():
+    """
+    批量导入整张试卷的成绩矩阵 {template_name, columns, rows} 或 {template_name, text}
+    dry_run: true 时只校验不写入; 返回写入数量与逐格错误报告
+    """
+    data = request.get_json() or {}
+    template_name = data.get('template_name')
+    if not template_name:
+        return jsonify({'success': False, 'message': 'Missing template name'}), 400
+    
+    query_templates = ExamTemplate.query.filter_by(name=template_name)
+    if session.get('role') != 'admin':
+        query_templates = query_templates.filter_by(grader_id=session.get('user_id'))
+    template_ids = [t.id for t in query_templates.all()]
+    if not template_ids:
+        return jsonify({'success': False, 'message': '试卷不存在或无权限'}), 404
+    
+    try:
+        df = parse_score_matrix(data)
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    
+    try:
+        report = apply_score_matrix(template_ids, df, dry_run=bool(data.get('dry_run')))
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'message': str(e)}), 500
+    return jsonify({'success': True, **report})
+
+# API removed per user request (v2.2)
+
+@login_required
+def api_students_by_session(exam_session_id):
+    """获取指定考试场次的学生列表"""
+    grade = request.args.get('grade')
+    subject = request.args.get('subject') # Optional subject filter
+    
+    # 获取当前用户
     current_user_id = session.get('user_id')
     current_user = User.query.get(current_user_id)
     
@@ -1426,12 +2800,10 @@ def api_students_by_session(exam_session_id):
         # 获取已保存的分数
         # 获取涉及的所有题目ID（不仅是第一个模板，而是所有学生的模板）
         # 但前端只能显示一套题，所以我们只获取 primary_template_id 相关的分数
-        q_ids = [q.id for q in q_objs]
-        
-        if student_ids and q_ids:
+        if student_ids and q_objs:
             saved_scores = Score.query.filter(
-                Score.student_id.in_(student_ids),
-                Score.question_id.in_(q_ids)
+                Score.exam_template_id == primary_template_id,
+                Score.student_id.in_(student_ids)
             ).all()
             
             for s in saved_scores:
@@ -1456,7 +2828,11 @@ def statistics():
 @app.route('/api/stats/session/<int:session_id>')
 @login_required
 def api_session_stats(session_id):
-    """获取考试场次详细统计"""
+    """
+    获取考试场次详细统计
+    总分统计以该场次的报名为单位 (每个报名一份试卷, 取报名汇总列 score), 同一考生在本场次报考多份试卷时各计一次;
+    total_students 为已录分的报名数
+    """
     # 1. 获取基础信息
     session = ExamSession.query.get_or_404(session_id)
     
@@ -1474,13 +2850,9 @@ def api_session_stats(session_id):
         })
         
     # 3. 计算总分统计
-    # 获取每个学生的总分
-    student_scores = []
-    for sid in student_ids:
-        scores = Score.query.filter_by(student_id=sid).all()
-        if scores:
-            total = sum(s.score for s in scores)
-            student_scores.append(total)
+    # 每个已录分报名的总分 (报名汇总列, 由 refresh_registration_totals 维护);
+    # 不再按考生汇总其全部分数, 其他场次/试卷的分数不计入本场次
+    student_scores = [r.score for r in registrations if r.scored_count]
             
     if not student_scores:
         return jsonify({
@@ -1639,8 +3011,219 @@ def api_export_stats(session_id):
         download_name=filename
     )
 
+# --- SMTP Connection Pool ---
+
+class PooledSMTPConnection:
+    def __init__(self, server):
+        self.server = server
+        self.sent = 0
+        self.last_used = time.monotonic()
+
+    def close(self):
+        try:
+            self.server.quit()
+        except Exception:
+            try:
+                self.server.close()
+            except Exception:
+                pass
+
+def smtp_send_pipelined(server, msg):
+    """
+    RFC 2920 PIPELINING: MAIL FROM / RCPT TO / DATA 一次写出后依次读取应答, 再发送正文,
+    每封邮件 2 次往返 (逐条命令时为 3 + 收件人数); 返回被拒收件人 {address: (code, resp)}
+    服务器未声明 PIPELINING, 或邮件无发件人、含 Bcc/Resent-* 头、非 ASCII 地址时退回 send_message
+    """
+    import re
+    from email.generator import BytesGenerator
+    from email.utils import getaddresses
+    
+    server.ehlo_or_helo_if_needed()
+    senders = getaddresses([msg['Sender'] or msg['From'] or ''])
+    sender = senders[0][1] if senders else ''
+
+    recipients = [addr for _, addr in getaddresses(msg.get_all('To', []) + msg.get_all('Cc', [])) if addr]
+    plain = not any(key.lower() == 'bcc' or key.lower().startswith('resent-') for key in msg.keys())
+    if not (server.has_extn('pipelining') and plain and sender and recipients and
+            all(addr.isascii() for addr in recipients + [sender])):
+        return server.send_message(msg)
+        
+    commands = [f'MAIL FROM:<{sender}>'] + [f'RCPT TO:<{addr}>' for addr in recipients] + ['DATA']
+    server.send(''.join(f'{command}\r\n' for command in commands))
+    mail_reply = server.getreply()
+    refused = {}
+    for addr in recipients:
+        code, resp = server.getreply()
+        if code not in (250, 251):
+            refused[addr] = (code, resp)
+    data_code, data_resp = server.getreply()
+    
+    # Servers must refuse DATA once MAIL or every RCPT failed (RFC 2920 3.1)
+    if mail_reply[0] != 250 or data_code != 354:
+        server.rset()
+        if mail_reply[0] != 250:
+            raise smtplib.SMTPSenderRefused(mail_reply[0], mail_reply[1], sender)
+        if len(refused) == len(recipients):
+            raise smtplib.SMTPRecipientsRefused(refused)
+        raise smtplib.SMTPDataError(data_code, data_resp)
+        
+    buffer = io.BytesIO()
+    BytesGenerator(buffer, policy=msg.policy.clone(linesep='\r\n')).flatten(msg, linesep='\r\n')
+    body = re.sub(br'(?m)^\.', b'..', buffer.getvalue())
+    if not body.endswith(b'\r\n'):
+        body += b'\r\n'
+    server.send(body + b'.\r\n')
+    code, resp = server.getreply()
+    if code != 250:
+        server.rset()
+        raise smtplib.SMTPDataError(code, resp)
+    return refused
+
+class SMTPConnectionPool:
+    """
+    进程内 SMTP 连接池: 复用已完成 STARTTLS/登录的连接, 批量发送时免去每封邮件的握手
+    - 最多 size 条并发连接, 空闲连接超过 idle_timeout 秒后先 NOOP 探活
+    - 连接断开时重连并重发一次; 单条连接发送 max_messages 封后轮换
+    - 服务器支持 PIPELINING 时信封命令合并发送 (smtp_send_pipelined)
+    """
+    def __init__(self, host, port, use_tls=False, username=None, password=None,
+                 size=2, max_messages=100, timeout=30, idle_timeout=60):
+        self.host = host
+        self.port = port
+        self.use_tls = use_tls
+        self.username = username
+        self.password = password
+        self.size = size
+        self.max_messages = max_messages
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(size)
+        self.stats_lock = threading.Lock()
+        self.stats = {'connections': 0, 'messages': 0, 'reconnects': 0}
+
+    def count(self, key):
+        with self.stats_lock:
+            self.stats[key] += 1
+
+    def connect(self):
+        server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        try:
+            if self.use_tls:
+                server.starttls()
+            if self.username and self.password:
+                server.login(self.username, self.password)
+        except Exception:
+            server.close()
+            raise
+        self.count('connections')
+        return PooledSMTPConnection(server)
+
+    def acquire(self):
+        self.slots.acquire()
+        try:
+            while True:
+                try:
+                    conn = self.idle.get_nowait()
+                except queue.Empty:
+                    return self.connect()
+                if time.monotonic() - conn.last_used < self.idle_timeout:
+                    return conn
+                try:
+                    if conn.server.noop()[0] == 250:
+                        return conn
+                except Exception:
+                    pass
+                conn.close()
+        except Exception:
+            self.slots.release()
+            raise
+
+    def release(self, conn, broken=False):
+        try:
+            if broken or conn.sent >= self.max_messages:
+                conn.close()
+            else:
+                conn.last_used = time.monotonic()
+                self.idle.put(conn)
+        finally:
+            self.slots.release()
+
+    def send(self, msg):
+        """发送一封邮件 (连接断开时重连重发一次)"""
+        for attempt in range(2):
+            conn = self.acquire()
+            try:
+                smtp_send_pipelined(conn.server, msg)
+            except (smtplib.SMTPServerDisconnected, ConnectionError, TimeoutError):
+                self.release(conn, broken=True)
+                if attempt:
+                    raise
+                self.count('reconnects')
+                continue
+            except smtplib.SMTPResponseException as e:
+                # 421: server is closing the channel
+                self.release(conn, broken=(e.smtp_code == 421))
+                raise
+            except smtplib.SMTPException:
+                # Message-level failure (e.g. recipients refused); smtplib already sent RSET
+                self.release(conn)
+                raise
+            except Exception:
+                self.release(conn, broken=True)
+                raise
+            conn.sent += 1
+            self.count('messages')
+            self.release(conn)
+            return
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+mail_pool = None
+mail_pool_lock = threading.Lock()
+
+def get_mail_pool():
+    """当前进程的 SMTP 连接池 (邮件配置变化或 fork 后重建)"""
+    global mail_pool
+    key = (
+        app.config['MAIL_SERVER'], app.config['MAIL_PORT'], app.config['MAIL_USE_TLS'],
+        app.config['MAIL_USERNAME'], app.config['MAIL_PASSWORD'],
+        app.config['MAIL_POOL_SIZE'], app.config['MAIL_MAX_MESSAGES_PER_CONNECTION']
+    )
+    with mail_pool_lock:
+        if mail_pool is None or mail_pool.key != key or mail_pool.pid != os.getpid():
+            if mail_pool is not None and mail_pool.pid == os.getpid():
+                mail_pool.close()
+            mail_pool = SMTPConnectionPool(
+                app.config['MAIL_SERVER'], app.config['MAIL_PORT'],
+                use_tls=app.config['MAIL_USE_TLS'],
+                username=app.config['MAIL_USERNAME'],
+                password=app.config['MAIL_PASSWORD'],
+                size=app.config['MAIL_POOL_SIZE'],
+                max_messages=app.config['MAIL_MAX_MESSAGES_PER_CONNECTION'],
+                timeout=app.config['MAIL_TIMEOUT']
+            )
+            mail_pool.key = key
+            mail_pool.pid = os.getpid()
+        return mail_pool
+
+def close_mail_pool():
+    if mail_pool is not None and mail_pool.pid == os.getpid():
+        mail_pool.close()
+
+atexit.register(close_mail_pool)
+
 # --- Email Functionality ---
 
+def mail_server_configured():
+    """MAIL_SERVER 仍为默认占位地址 smtp.example.com 时视为未配置: 不发送, 也不记为已发送"""
+    return app.config['MAIL_SERVER'] != 'smtp.example.com'
+
 def send_email_with_attachment(to_email, subject, body, attachment_bytes, attachment_filename):
     """Sends an email with a PDF attachment."""
     msg = MIMEMultipart()
@@ -1656,19 +3239,12 @@ def send_email_with_attachment(to_email, subject, body, attachment_bytes, attach
         msg.attach(part)
 
     try:
-        # For development/demo, if MAIL_SERVER is 'smtp.example.com', we just log it
-        if app.config['MAIL_SERVER'] == 'smtp.example.com':
-            print(f"MOCK EMAIL SENT to {to_email} with subject '{subject}'")
-            return True, "Mock email sent (Server not configured)"
+        # For development/demo, if MAIL_SERVER is 'smtp.example.com', we just log it; nothing was delivered
+        if not mail_server_configured():
+            print(f"MOCK EMAIL (not sent) to {to_email} with subject '{subject}'")
+            return False, "Mail server not configured (MAIL_SERVER); email not sent"
             
-        server = smtplib.SMTP(app.config['MAIL_SERVER'], app.config['MAIL_PORT'])
-        if app.config['MAIL_USE_TLS']:
-            server.starttls()
-        if app.config['MAIL_USERNAME'] and app.config['MAIL_PASSWORD']:
-            server.login(app.config['MAIL_USERNAME'], app.config['MAIL_PASSWORD'])
-        
-        server.send_message(msg)
-        server.quit()
+        get_mail_pool().send(msg)
         return True, "Email sent successfully"
     except Exception as e:
         print(f"EMAIL ERROR: {str(e)}")
@@ -1725,96 +3301,297 @@ def batch_generate_zip():
     if not items:
         return jsonify({'error': 'No items provided'}), 400
         
-    zip_buffer = io.BytesIO()
-    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-        for item in items:
-            s_id = item.get('student_id')
-            sess_id = item.get('exam_session_id')
-            tmpl_id = item.get('template_id')
-            
-            student = Student.query.get(s_id)
-            if not student:
-                continue
-                
-            try:
-                pdf_buffer = generate_report_card_pdf(s_id, sess_id, tmpl_id)
-                if pdf_buffer:
-                    exam_session = ExamSession.query.get(sess_id)
-                    session_name = exam_session.name if exam_session else "Exam"
-                    filename = f"ReportCard_{student.name}_{session_name}.pdf"
-                    zip_file.writestr(filename, pdf_buffer.getvalue())
-            except Exception as e:
-                print(f"Error generating PDF for {s_id}: {e}")
-                
-    zip_buffer.seek(0)
-    return send_file(
-        zip_buffer,
-        as_attachment=True,
-        download_name='ReportCards_Batch.zip',
-        mimetype='application/zip'
-    )
-
-@app.route('/api/email/batch-send-report-card-items', methods=['POST'])
-@login_required
-def batch_send_report_card_items():
-    """批量发送成绩单邮件 (按列表)"""
-    data = request.get_json()
-    items = data.get('items', [])
-    
-    success_count = 0
-    fail_count = 0
-    details = []
-    processed_keys = set()
-    
+    tasks = []
     for item in items:
         s_id = item.get('student_id')
         sess_id = item.get('exam_session_id')
-        tmpl_id = item.get('template_id')
-        
-        key = f"{s_id}-{sess_id}"
-        if key in processed_keys:
-            continue
-        processed_keys.add(key)
         
         student = Student.query.get(s_id)
         if not student:
             continue
             
-        if not student.email:
-            fail_count += 1
-            details.append({'student': student.name, 'status': 'No Email'})
-            continue
-            
-        try:
-            pdf_buffer = generate_report_card_pdf(s_id, sess_id, tmpl_id)
-            if not pdf_buffer:
-                fail_count += 1
-                details.append({'student': student.name, 'status': 'PDF Generation Failed'})
-                continue
+        exam_session = ExamSession.query.get(sess_id)
+        session_name = exam_session.name if exam_session else "Exam"
+        tasks.append({
+            'student_id': s_id,
+            'session_id': sess_id,
+            'template_id': item.get('template_id'),
+            'filename': f"ReportCard_{student.name}_{session_name}.pdf"
+        })
+        
+    if wants_background_job():
+        return submit_job_response('report_card_zip', {'tasks': tasks, 'download_name': 'ReportCards_Batch.zip'})
+        
+    def entries():
+        for task, pdf_bytes, error in render_report_card_batch(tasks):
+            if pdf_bytes:
+                yield task['filename'], pdf_bytes
+            elif error:
+                print(f"Error generating PDF for {task['student_id']}: {error}")
                 
-            exam_session = ExamSession.query.get(sess_id)
-            session_name = exam_session.name if exam_session else "Exam"
-            subject = f"Score Report: {student.name} - {session_name}"
-            body = f"Dear {student.name},\n\nPlease find attached your score report for {session_name}.\n\nBest regards,\nWay To Future Team"
-            filename = f"ReportCard_{student.name}_{session_name}.pdf"
+    return zip_stream_response(entries(), 'ReportCards_Batch.zip')
+
+# --- Email Outbox ---
+# 批量发送只写入 email_outbox (每个 学生/场次/试卷 一行, dedup_key 唯一), 由 scripts/email_sender.py 按
+# EMAIL_RATE_PER_MINUTE 限速投递; 失败按指数退避重试, 重复提交同一批次不会重发已成功的邮件.
+
+def report_card_email_key(student_id, exam_session_id, template_id=None):
+    return f"report_card:{student_id}:{exam_session_id}:{template_id or 'all'}"
+
+def enqueue_report_card_emails(items, created_by=None, resend=False):
+    """
+    将成绩单邮件写入发件箱 (幂等)
+    items: list of dict {'student_id', 'exam_session_id', 'template_id'}
+    resend: 已发送成功的也重新排队
+    Returns (batch_id, counts)
+    """
+    import uuid
+    from sqlalchemy.exc import IntegrityError
+    
+    keys = {}
+    for item in items:
+        student_id = to_int(item.get('student_id'))
+        exam_session_id = to_int(item.get('exam_session_id'))
+        template_id = to_int(item.get('template_id'))
+        if student_id and exam_session_id:
+            keys.setdefault(report_card_email_key(student_id, exam_session_id, template_id),
+                            (student_id, exam_session_id, template_id))
             
-            success, msg = send_email_with_attachment(student.email, subject, body, pdf_buffer, filename)
+    batch_id = uuid.uuid4().hex
+    for attempt in range(2):
+        counts = {'queued': 0, 'already_sent': 0, 'already_queued': 0}
+        existing = {}
+        for chunk in chunked(list(keys)):
+            for row in EmailOutbox.query.filter(EmailOutbox.dedup_key.in_(chunk)).all():
+                existing[row.dedup_key] = row
+                
+        now = datetime.utcnow()
+        for key, (student_id, exam_session_id, template_id) in keys.items():
+            row = existing.get(key)
+            if row is None:
+                db.session.add(EmailOutbox(
+                    dedup_key=key, batch_id=batch_id, student_id=student_id,
+                    exam_session_id=exam_session_id, exam_template_id=template_id,
+                    created_by=created_by, next_attempt_at=now
+                ))
+                counts['queued'] += 1
+            elif row.status in ('pending', 'sending'):
+                counts['already_queued'] += 1
+            elif row.status == 'sent' and not resend:
+                counts['already_sent'] += 1
+            else:
+                row.status = 'pending'
+                row.attempts = 0
+                row.next_attempt_at = now
+                row.last_error = None
+                row.batch_id = batch_id
+                counts['queued'] += 1
+        try:
+            db.session.commit()
+            break
+        except IntegrityError:
+            # Same key enqueued concurrently by another request
+            db.session.rollback()
+            if attempt:
+                raise
+    return batch_id, counts
+
+def email_send_budget():
+    """本分钟内剩余可发送数量 (所有发送进程共享, 按最近60秒的投递次数计算); None 表示不限速"""
+    rate = app.config['EMAIL_RATE_PER_MINUTE']
+    if rate <= 0:
+        return None
+    since = datetime.utcnow() - timedelta(seconds=60)
+    attempted = EmailOutbox.query.filter(EmailOutbox.last_attempt_at >= since).count()
+    return max(0, rate - attempted)
+
+def claim_due_emails(limit):
+    """领取到期的待发送邮件 (条件 UPDATE, 多个发送进程不会重复领取)"""
+    now = datetime.utcnow()
+    # Rows left in 'sending' by a crashed sender become due again
+    db.session.query(EmailOutbox)\
+        .filter(EmailOutbox.status == 'sending', EmailOutbox.locked_until < now)\
+        .update({'status': 'pending'}, synchronize_session=False)
+    db.session.commit()
+    
+    candidate_ids = [row[0] for row in db.session.query(EmailOutbox.id)
+                     .filter(EmailOutbox.status == 'pending', EmailOutbox.next_attempt_at <= now)
+                     .order_by(EmailOutbox.next_attempt_at, EmailOutbox.id).limit(limit).all()]
+    claimed_ids = []
+    locked_until = now + timedelta(seconds=app.config['EMAIL_LOCK_SECONDS'])
+    for outbox_id in candidate_ids:
+        claimed = db.session.query(EmailOutbox)\
+            .filter(EmailOutbox.id == outbox_id, EmailOutbox.status == 'pending')\
+            .update({'status': 'sending', 'locked_until': locked_until, 'last_attempt_at': now},
+                    synchronize_session=False)
+        if claimed:
+            claimed_ids.append(outbox_id)
+    db.session.commit()
+    if not claimed_ids:
+        return []
+    return EmailOutbox.query.filter(EmailOutbox.id.in_(claimed_ids)).order_by(EmailOutbox.id).all()
+
+def email_retry_delay(attempts):
+    """指数退避: base, 2*base, 4*base ... 上限 EMAIL_RETRY_MAX_SECONDS"""
+    delay = app.config['EMAIL_RETRY_BASE_SECONDS'] * (2 ** max(0, attempts - 1))
+    return min(delay, app.config['EMAIL_RETRY_MAX_SECONDS'])
+
+def mark_email_result(row, success, error=None, permanent=False):
+    now = datetime.utcnow()
+    row.attempts = (row.attempts or 0) + 1
+    row.locked_until = None
+    if success:
+        row.status = 'sent'
+        row.sent_at = now
+        row.last_error = None
+    elif permanent or row.attempts >= app.config['EMAIL_MAX_ATTEMPTS']:
+        row.status = 'failed'
+        row.last_error = error
+    else:
+        row.status = 'pending'
+        row.last_error = error
+        row.next_attempt_at = now + timedelta(seconds=email_retry_delay(row.attempts))
+    db.session.commit()
+
+def record_email_results(results, rows_by_id):
+    """在主线程中落库发送线程的结果 (数据库会话不跨线程)"""
+    while True:
+        try:
+            outbox_id, success, error, permanent = results.get_nowait()
+        except queue.Empty:
+            return
+        mark_email_result(rows_by_id[outbox_id], success, error, permanent)
+
+def deliver_outbox_emails(rows):
+    """
+    渲染-发送流水线: 进程池渲染成绩单 -> 有界队列 -> 发送线程 (SMTP 连接池)
+    CPU 渲染与网络发送重叠, 总耗时趋近 max(渲染, 发送) 而非两者之和;
+    每个 学生/场次(/试卷) 只渲染一份 PDF, 重试时命中成绩单缓存
+    """
+    rows_by_id = {row.id: row for row in rows}
+    session_ids = {row.exam_session_id for row in rows}
+    session_names = {s.id: s.name for s in ExamSession.query.filter(ExamSession.id.in_(session_ids)).all()}
+    
+    tasks = []
+    for row in rows:
+        student = row.student
+        if not student or not student.email:
+            mark_email_result(row, False, 'No Email', permanent=True)
+            continue
+        row.to_email = student.email
+        session_name = session_names.get(row.exam_session_id, "Exam")
+        tasks.append({
+            'student_id': row.student_id,
+            'session_id': row.exam_session_id,
+            'template_id': row.exam_template_id,
+            'filename': f"ReportCard_{student.name}_{session_name}.pdf",
+            'outbox_id': row.id,
+            'to_email': student.email,
+            'subject': f"Score Report: {student.name} - {session_name}",
+            'body': f"Dear {student.name},\n\nPlease find attached your score report for {session_name}.\n\nBest regards,\nWay To Future Team"
+        })
+    if not tasks:
+        return
+        
+    outgoing = queue.Queue(maxsize=app.config['EMAIL_PIPELINE_DEPTH'])
+    results = queue.Queue()
+    
+    def sender():
+        while True:
+            item = outgoing.get()
+            if item is None:
+                return
+            task, pdf_bytes = item
+            try:
+                success, msg = send_email_with_attachment(task['to_email'], task['subject'], task['body'],
+                                                          io.BytesIO(pdf_bytes), task['filename'])
+            except Exception as e:
+                success, msg = False, str(e)
+            results.put((task['outbox_id'], success, None if success else f'Email Error: {msg}', False))
             
-            if success:
-                success_count += 1
+    senders = [threading.Thread(target=sender, daemon=True)
+               for _ in range(max(1, min(app.config['EMAIL_SENDER_THREADS'], len(tasks))))]
+    for thread in senders:
+        thread.start()
+        
+    try:
+        for task, pdf_bytes, error in render_report_card_batch(tasks):
+            if pdf_bytes:
+                outgoing.put((task, pdf_bytes))
+            elif error:
+                results.put((task['outbox_id'], False, f'Error: {error}', False))
             else:
-                fail_count += 1
-                details.append({'student': student.name, 'status': f'Email Error: {msg}'})
-                
-        except Exception as e:
-            fail_count += 1
-            details.append({'student': student.name, 'status': f'Error: {str(e)}'})
+                results.put((task['outbox_id'], False, 'PDF Generation Failed', True))
+            record_email_results(results, rows_by_id)
+    finally:
+        for _ in senders:
+            outgoing.put(None)
+        for thread in senders:
+            thread.join()
+    record_email_results(results, rows_by_id)
+
+def send_due_emails(limit=None):
+    """投递一批到期邮件 (受限速约束), 返回处理数量; 未配置邮件服务器时不领取, 邮件保持待发送"""
+    if not mail_server_configured():
+        return 0
+    limit = limit or app.config['EMAIL_SENDER_BATCH']
+    budget = email_send_budget()
+    if budget is not None:
+        limit = min(limit, budget)
+    if limit <= 0:
+        return 0
+        
+    rows = claim_due_emails(limit)
+    if rows:
+        deliver_outbox_emails(rows)
+    return len(rows)
+
+def run_email_sender(poll_interval=2.0, max_rounds=None):
+    """发件箱投递主循环 (scripts/email_sender.py 以独立进程运行)"""
+    if not mail_server_configured():
+        print("MAIL_SERVER not configured: outbox emails stay pending until it is set")
+    rounds = 0
+    while max_rounds is None or rounds < max_rounds:
+        with app.app_context():
+            processed = send_due_emails()
+            db.session.remove()
+        rounds += 1
+        if not processed:
+            if max_rounds is not None:
+                break
+            time.sleep(poll_interval)
+
+def email_outbox_counts(batch_id=None, exam_session_id=None):
+    query = db.session.query(EmailOutbox.status, db.func.count(EmailOutbox.id))
+    if batch_id:
+        query = query.filter(EmailOutbox.batch_id == batch_id)
+    if exam_session_id:
+        query = query.filter(EmailOutbox.exam_session_id == exam_session_id)
+    by_status = dict(query.group_by(EmailOutbox.status).all())
+    return {
+        'pending': by_status.get('pending', 0) + by_status.get('sending', 0),
+        'sent': by_status.get('sent', 0),
+        'failed': by_status.get('failed', 0)
+    }
 
+def email_batch_response(items, resend=False):
+    """批量邮件只入队, 立即返回"""
+    batch_id, counts = enqueue_report_card_emails(items, session.get('user_id'), resend)
     return jsonify({
-        'success': True, 
-        'summary': f"Sent: {success_count}, Failed: {fail_count}",
-        'details': details
-    })
+        'success': True,
+        'batch_id': batch_id,
+        'summary': f"Queued: {counts['queued']}, Already sent: {counts['already_sent']}, Already queued: {counts['already_queued']}",
+        'counts': counts,
+        'status_url': url_for('api_email_outbox_status', batch_id=batch_id)
+    }), 202
+
+@app.route('/api/email/batch-send-report-card-items', methods=['POST'])
+@login_required
+def batch_send_report_card_items():
+    """批量发送成绩单邮件 (按列表)"""
+    data = request.get_json()
+    items = data.get('items', [])
+    return email_batch_response(items, data.get('resend', False))
 
 @app.route('/api/email/batch-send-report-card', methods=['POST'])
 @login_required
@@ -1825,60 +3602,44 @@ def batch_send_report_card_email():
     template_id = data.get('template_id') # Optional
     
     # Logic: Get all students in session (and template if provided)
-    query = db.session.query(ExamRegistration)\
+    query = db.session.query(ExamRegistration.student_id)\
         .filter(ExamRegistration.exam_session_id == exam_session_id)
         
     if template_id:
         query = query.filter(ExamRegistration.exam_template_id == template_id)
         
-    registrations = query.all()
-    
-    success_count = 0
-    fail_count = 0
-    details = []
-    
-    processed_student_ids = set()
+    items = [{
+        'student_id': student_id,
+        'exam_session_id': exam_session_id,
+        'template_id': template_id
+    } for (student_id,) in query.order_by(ExamRegistration.id).all()]
+    return email_batch_response(items, data.get('resend', False))
+
+@app.route('/api/email/outbox/status', methods=['GET'])
+@login_required
+def api_email_outbox_status():
+    """发件箱投递状态 (按 batch_id 或 exam_session_id 过滤)"""
+    batch_id = request.args.get('batch_id')
+    exam_session_id = request.args.get('exam_session_id', type=int)
+    
+    query = EmailOutbox.query.filter_by(status='failed')
+    if batch_id:
+        query = query.filter_by(batch_id=batch_id)
+    if exam_session_id:
+        query = query.filter_by(exam_session_id=exam_session_id)
+    failed = query.order_by(EmailOutbox.id).limit(200).all()
     
-    for reg in registrations:
-        if reg.student_id in processed_student_ids:
-            continue
-        processed_student_ids.add(reg.student_id)
-        
-        student = reg.student
-        if not student.email:
-            fail_count += 1
-            details.append({'student': student.name, 'status': 'No Email'})
-            continue
-            
-        try:
-            pdf_buffer = generate_report_card_pdf(student.id, exam_session_id, template_id)
-            if not pdf_buffer:
-                fail_count += 1
-                details.append({'student': student.name, 'status': 'PDF Generation Failed'})
-                continue
-                
-            exam_session = ExamSession.query.get(exam_session_id)
-            session_name = exam_session.name if exam_session else "Exam"
-            subject = f"Score Report: {student.name} - {session_name}"
-            body = f"Dear {student.name},\n\nPlease find attached your score report for {session_name}.\n\nBest regards,\nWay To Future Team"
-            filename = f"ReportCard_{student.name}_{session_name}.pdf"
-            
-            success, msg = send_email_with_attachment(student.email, subject, body, pdf_buffer, filename)
-            
-            if success:
-                success_count += 1
-            else:
-                fail_count += 1
-                details.append({'student': student.name, 'status': f'Email Error: {msg}'})
-                
-        except Exception as e:
-            fail_count += 1
-            details.append({'student': student.name, 'status': f'Error: {str(e)}'})
-            
     return jsonify({
-        'success': True, 
-        'summary': f"Sent: {success_count}, Failed: {fail_count}",
-        'details': details
+        'success': True,
+        'counts': email_outbox_counts(batch_id, exam_session_id),
+        'failed': [{
+            'student': row.student.name if row.student else None,
+            'student_id': row.student_id,
+            'exam_session_id': row.exam_session_id,
+            'template_id': row.exam_template_id,
+            'attempts': row.attempts,
+            'error': row.last_error
+        } for row in failed]
     })
 
 # API removed per user request (v2.2)
@@ -1899,88 +3660,90 @@ def api_init_templates():
     return jsonify({'success': True, 'message': 'Development mode: init allowed (logic pending)'})
     # ... (rest of code removed/commented)
 
-@app.route('/api/ai-comment/generate', methods=['POST'])
-@login_required
-def api_generate_ai_comment():
-    """生成AI评语 (Mock AI)"""
-    data = request.get_json()
-    student_id = data.get('student_id')
-    template_name = data.get('template_name') # Optional
-    
-    if not student_id:
-        return jsonify({'error': 'Missing student_id'}), 400
-        
-    student = Student.query.get(student_id)
-    if not student:
-        return jsonify({'error': 'Student not found'}), 404
-        
-    # Get scores
-    # Logic similar to student-detail
-    query = db.session.query(ExamRegistration, ExamTemplate)\
-        .join(ExamTemplate, ExamRegistration.exam_template_id == ExamTemplate.id)\
-        .filter(ExamRegistration.student_id == student_id)
-        
-    if template_name:
-        query = query.filter(ExamTemplate.name == template_name)
+# --- Rule-Based Comments ---
+# 不调用 LLM 的规则评语: 按试卷一次构建 学生×题目 得分矩阵, 矩阵乘法得到各模块得分率,
+# 整张试卷的草稿可在一秒内生成, 作为 LLM 缓慢或不可用时的即时兜底.
+
+def compute_module_mastery(template_id, registration_ids=None):
+    """
+    一次性计算试卷下所有报名的总分与各模块得分率
+    Returns (modules, max_total, rows): rows 为 list of dict
+        {registration_id, student_name, total_score, percentage, module_pcts (与 modules 对齐, 无题目的模块为 nan)}
+    """
+    questions = db.session.query(Question.id, Question.module, Question.score)\
+        .filter(Question.exam_template_id == template_id).order_by(Question.id).all()
+    reg_query = db.session.query(ExamRegistration.id, ExamRegistration.student_id, Student.name)\
+        .join(Student, ExamRegistration.student_id == Student.id)\
+        .filter(ExamRegistration.exam_template_id == template_id)
+    registrations = []
+    if registration_ids is None:
+        registrations = reg_query.order_by(ExamRegistration.id).all()
+    else:
+        for chunk in chunked(list(registration_ids)):
+            registrations.extend(reg_query.filter(ExamRegistration.id.in_(chunk)).all())
+        registrations.sort(key=lambda r: r.id)
+    if not registrations:
+        return [], 0.0, []
         
-    reg_data = query.first()
-    if not reg_data:
-         return jsonify({'error': 'Registration not found'}), 404
-         
-    reg, template = reg_data
-    
-    questions = Question.query.filter_by(exam_template_id=template.id).all()
-    q_ids = [q.id for q in questions]
-    scores = Score.query.filter(
-        Score.student_id == student_id,
-        Score.question_id.in_(q_ids)
-    ).all()
+    # Questions x modules membership, modules in first-appearance order
+    max_scores = np.array([q.score or 0 for q in questions], dtype=float)
+    module_codes, modules = pd.factorize(pd.Series([q.module or 'General' for q in questions], dtype=object))
+    membership = np.zeros((len(questions), len(modules)))
+    membership[np.arange(len(questions)), module_codes] = 1
     
-    # Calculate Module Performance
-    module_stats = {}
-    total_score = 0
-    max_score = 0
-    
-    for q in questions:
-        module = q.module or 'General'
-        if module not in module_stats:
-            module_stats[module] = {'got': 0, 'total': 0}
-        
-        module_stats[module]['total'] += q.score
-        max_score += q.score
-        
-        # Find score
-        s = next((x for x in scores if x.question_id == q.id), None)
-        if s:
-            module_stats[module]['got'] += s.score
-            total_score += s.score
+    # Students x questions score matrix, filled from a single query
+    student_rows = {}
+    for reg in registrations:
+        student_rows.setdefault(reg.student_id, len(student_rows))
+    question_cols = {q.id: j for j, q in enumerate(questions)}
+    matrix = np.zeros((len(student_rows), len(questions)))
+    if questions:
+        cells = [(student_rows[student_id], question_cols[question_id], score)
+                 for student_id, question_id, score in db.session.query(Score.student_id, Score.question_id, Score.score)
+                 .filter(Score.exam_template_id == template_id).all()
+                 if student_id in student_rows]
+        if cells:
+            rows, cols, values = zip(*cells)
+            matrix[list(rows), list(cols)] = values
             
-    # Generate Comment
+    module_got = matrix @ membership
+    module_max = max_scores @ membership
+    with np.errstate(divide='ignore', invalid='ignore'):
+        module_pcts = np.where(module_max > 0, module_got / module_max * 100, np.nan)
+    totals = matrix.sum(axis=1)
+    max_total = float(max_scores.sum())
+    percentages = totals / max_total * 100 if max_total > 0 else np.zeros(len(totals))
+    
+    result = []
+    for reg in registrations:
+        i = student_rows[reg.student_id]
+        result.append({
+            'registration_id': reg.id,
+            'student_name': reg.name,
+            'total_score': float(totals[i]),
+            'percentage': float(percentages[i]),
+            'module_pcts': module_pcts[i]
+        })
+    return list(modules), max_total, result
+
+def build_rule_based_comment(student_name, template_name, total_score, max_score, percentage, module_pcts):
+    """规则评语: 总体评价 + 强/弱模块 + 鼓励; module_pcts 为 [(module, pct)]"""
     comment_parts = []
     
     # Part 1: Overall
-    percentage = (total_score / max_score * 100) if max_score > 0 else 0
     if percentage >= 90:
-        intro = f"{student.name}同学在本次{template.name}测评中表现卓越，总分达到了{total_score}分（满分{max_score}分）。"
+        intro = f"{student_name}同学在本次{template_name}测评中表现卓越，总分达到了{total_score}分（满分{max_score}分）。"
     elif percentage >= 80:
-        intro = f"{student.name}同学在本次{template.name}测评中表现优异，基础扎实，总分为{total_score}分。"
+        intro = f"{student_name}同学在本次{template_name}测评中表现优异，基础扎实，总分为{total_score}分。"
     elif percentage >= 60:
-        intro = f"{student.name}同学在本次{template.name}测评中顺利完成考试，总分为{total_score}分，仍有进步空间。"
+        intro = f"{student_name}同学在本次{template_name}测评中顺利完成考试，总分为{total_score}分，仍有进步空间。"
     else:
-        intro = f"{student.name}同学在本次{template.name}测评中表现有待提高，总分为{total_score}分，建议加强基础练习。"
+        intro = f"{student_name}同学在本次{template_name}测评中表现有待提高，总分为{total_score}分，建议加强基础练习。"
     comment_parts.append(intro)
     
     # Part 2: Module Analysis
-    strong_modules = []
-    weak_modules = []
-    
-    for mod, stats in module_stats.items():
-        if stats['total'] > 0:
-            mod_pct = (stats['got'] / stats['total']) * 100
-            if mod_pct >= 85:
-                strong_modules.append(mod)
-            elif mod_pct < 60:
-                weak_modules.append(mod)
+    strong_modules = [mod for mod, pct in module_pcts if pct >= 85]
+    weak_modules = [mod for mod, pct in module_pcts if pct < 60]
                 
     if strong_modules:
         comment_parts.append(f"在{', '.join(strong_modules)}模块上掌握得非常好，展现了深厚的理解能力。")
@@ -1989,419 +3752,974 @@ def api_generate_ai_comment():
         comment_parts.append(f"建议后续重点复习{', '.join(weak_modules)}相关知识点，通过针对性练习填补知识盲区。")
         
     # Part 3: Encouragement
-    encourage = "希望在未来的学习中继续保持热情，取得更大的突破！"
-    comment_parts.append(encourage)
-    
-    generated_comment = "".join(comment_parts)
-    
-    return jsonify({'comment': generated_comment})
+    comment_parts.append("希望在未来的学习中继续保持热情，取得更大的突破！")
+    
+    return "".join(comment_parts)
+
+def rule_based_comment_drafts(template, registration_ids=None):
+    """试卷下全部 (或指定) 报名的规则评语, Returns {registration_id: {...}}"""
+    modules, max_total, rows = compute_module_mastery(template.id, registration_ids)
+    drafts = {}
+    for row in rows:
+        module_pcts = [(mod, pct) for mod, pct in zip(modules, row['module_pcts']) if not np.isnan(pct)]
+        drafts[row['registration_id']] = {
+            'registration_id': row['registration_id'],
+            'student_name': row['student_name'],
+            'total_score': row['total_score'],
+            'max_score': max_total,
+            'percentage': round(row['percentage'], 1),
+            'comment': build_rule_based_comment(row['student_name'], template.name, row['total_score'],
+                                                max_total, row['percentage'], module_pcts)
+        }
+    return drafts
+
+def save_rule_based_drafts(drafts, user_id=None):
+    """为尚无评语版本的报名保存规则评语草稿 (占用一次生成配额), 返回保存数量"""
+    registration_ids = [d['registration_id'] for d in drafts]
+    existing = set()
+    for chunk in chunked(registration_ids):
+        existing.update(row[0] for row in db.session.query(AICommentHistory.registration_id)
+                        .filter(AICommentHistory.registration_id.in_(chunk)).distinct().all())
+    new_rows = [{
+        'registration_id': d['registration_id'],
+        'version': 1,
+        'content': d['comment'],
+        'is_ai_generated': False,
+        'status': 'draft',
+        'generated_at': datetime.utcnow(),
+        'confirmed_by': user_id
+    } for d in drafts if d['registration_id'] not in existing]
+    if new_rows:
+        db.session.bulk_insert_mappings(AICommentHistory, new_rows)
+        db.session.commit()
+    return len(new_rows)
 
-def generate_report_card_pdf(student_id, exam_session_id, template_id=None):
-    """生成学生成绩单PDF - Refactored v9 (Compact Layout)"""
-    try:
-        # 注册中文字体
-        try:
-            pdfmetrics.registerFont(TTFont('DroidSansFallback', '/usr/share/fonts/google-droid/DroidSansFallback.ttf'))
-            font_name = 'DroidSansFallback'
-        except Exception:
-            font_name = 'Helvetica' # Fallback
-            
-        # 获取学生信息
-        student = Student.query.get(student_id)
-        if not student:
-            student = Student.query.filter_by(student_id=str(student_id)).first()
-            
-        if not student:
-            print(f"Student not found: {student_id}")
-            return None
-            
-        # 获取考试场次信息
-        exam_session = ExamSession.query.get(exam_session_id)
+@app.route('/api/ai-comment/rule-based', methods=['POST'])
+@login_required
+def rule_based_ai_comments():
+    """按试卷名称为全部考生生成规则评语 (不调用 LLM); save=true 时为尚无评语的报名保存为草稿"""
+    data = request.get_json() or {}
+    template_name = data.get('template_name')
+    if not template_name:
+        return jsonify({'success': False, 'message': 'Missing template_name'}), 400
         
-        # 获取该场次下该学生的所有报名信息
-        query = db.session.query(ExamRegistration, ExamTemplate, Subject)\
-            .join(ExamTemplate, ExamRegistration.exam_template_id == ExamTemplate.id)\
-            .join(Subject, ExamTemplate.subject_id == Subject.id)\
-            .filter(ExamRegistration.student_id == student.id)\
-            .filter(ExamRegistration.exam_session_id == exam_session_id)
-            
-        if template_id:
-            query = query.filter(ExamTemplate.id == template_id)
-            
-        registrations = query.all()
+    drafts = []
+    for template in ExamTemplate.query.filter_by(name=template_name).order_by(ExamTemplate.id).all():
+        drafts.extend(rule_based_comment_drafts(template).values())
         
-        if not registrations:
-            return None
-            
-        # 创建PDF
-        buffer = io.BytesIO()
-        # Reduce margins
-        doc = SimpleDocTemplate(buffer, pagesize=A4, 
-                              rightMargin=15*mm, leftMargin=15*mm,
-                              topMargin=15*mm, bottomMargin=15*mm)
-        
-        story = []
+    saved = save_rule_based_drafts(drafts, session.get('user_id')) if data.get('save') else 0
+    return jsonify({'success': True, 'count': len(drafts), 'saved': saved, 'comments': drafts})
+
+# --- Report Card Render Context ---
+
+class ReportCardRenderContext:
+    """
+    成绩单渲染上下文 (每进程/线程构建一次)
+    持有已解析的中文字体、样式表、页眉表格骨架以及解码后的 Logo
+    """
+    FONT_NAME = 'DroidSansFallback'
+    FONT_PATH = '/usr/share/fonts/google-droid/DroidSansFallback.ttf'
+
+    def __init__(self, logo_file=None, generation=0):
+        self.generation = generation
+        self.font_name = self.register_font()
+        self.styles = self.build_styles(self.font_name)
+        
+        # Header skeleton: fixed columns/style, only the texts change per session
+        self.header_col_widths = [55*mm, 70*mm, 55*mm]
+        self.header_table_style = TableStyle([
+            ('ALIGN', (0, 0), (0, 0), 'LEFT'),
+            ('ALIGN', (1, 0), (1, 0), 'CENTER'),
+            ('ALIGN', (2, 0), (2, 0), 'RIGHT'),
+            ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+            ('LINEBELOW', (0, 0), (-1, 0), 1, colors.black),
+            ('BOTTOMPADDING', (0, 0), (-1, -1), 4), # Reduced padding
+            ('TOPPADDING', (0, 0), (-1, -1), 0),
+        ])
+        
+        self.logo_file = logo_file
+        self.logo_signature = self.file_signature(logo_file)
+        self.logo = self.load_logo(logo_file)
+
+    @classmethod
+    def register_font(cls):
+        """注册中文字体 (TTF 只解析一次)"""
+        if cls.FONT_NAME in pdfmetrics.getRegisteredFontNames():
+            return cls.FONT_NAME
+        try:
+            pdfmetrics.registerFont(TTFont(cls.FONT_NAME, cls.FONT_PATH))
+            return cls.FONT_NAME
+        except Exception:
+            return 'Helvetica' # Fallback
+
+    @staticmethod
+    def build_styles(font_name):
         styles = getSampleStyleSheet()
         
         # --- Styles v9 ---
-        
-        title_style = ParagraphStyle(
-            'ReportTitle',
-            parent=styles['Title'],
-            fontName=font_name,
-            fontSize=22, # Slightly smaller
-            leading=26,
-            alignment=1, 
-            spaceAfter=6 # Reduced
-        )
-        
-        heading_style = ParagraphStyle(
-            'ReportHeading',
-            parent=styles['Heading3'],
-            fontName=font_name,
-            fontSize=13, # Slightly smaller
-            textColor=colors.HexColor('#333333'),
-            borderPadding=0,
-            spaceBefore=10, # Reduced
-            spaceAfter=5
-        )
-        
-        normal_style = ParagraphStyle(
-            'ReportNormal',
-            parent=styles['Normal'],
-            fontName=font_name,
-            fontSize=10,
-            leading=13
-        )
-        
-        small_style = ParagraphStyle(
-            'ReportSmall',
-            parent=styles['Normal'],
-            fontName=font_name,
-            fontSize=9,
-            leading=11
-        )
-        
-        # Table Content - Keep small 8pt
-        table_content_style = ParagraphStyle(
-            'TableContent',
-            parent=styles['Normal'],
-            fontName=font_name,
-            fontSize=8,
-            leading=10,
-            alignment=1 
-        )
-        
-        # Header Left - Smaller
-        header_left_style = ParagraphStyle(
-            'HeaderLeft',
-            parent=styles['Normal'],
-            fontName=font_name,
-            fontSize=9, # Reduced from 11
-            alignment=0 
-        )
-        
-        # Header Center - Smaller
-        header_center_style = ParagraphStyle(
-            'HeaderCenter',
-            parent=styles['Normal'],
-            fontName=font_name,
-            fontSize=14, # Reduced from 16
-            alignment=1 
-        )
-        
-        # Settings
-        setting = SystemSetting.query.first()
-        system_company_name_zh = setting.company_name_zh if setting else '橡心国际'
-        system_logo_path = setting.logo_path if setting else None
-        
-        header_left_text = exam_session.exam_name_en or 'Way To Future'
-        header_middle_text = exam_session.company_brand or system_company_name_zh
-        
+        return {
+            'title': ParagraphStyle(
+                'ReportTitle',
+                parent=styles['Title'],
+                fontName=font_name,
+                fontSize=22, # Slightly smaller
+                leading=26,
+                alignment=1, 
+                spaceAfter=6 # Reduced
+            ),
+            'heading': ParagraphStyle(
+                'ReportHeading',
+                parent=styles['Heading3'],
+                fontName=font_name,
+                fontSize=13, # Slightly smaller
+                textColor=colors.HexColor('#333333'),
+                borderPadding=0,
+                spaceBefore=10, # Reduced
+                spaceAfter=5
+            ),
+            'normal': ParagraphStyle(
+                'ReportNormal',
+                parent=styles['Normal'],
+                fontName=font_name,
+                fontSize=10,
+                leading=13
+            ),
+            'small': ParagraphStyle(
+                'ReportSmall',
+                parent=styles['Normal'],
+                fontName=font_name,
+                fontSize=9,
+                leading=11
+            ),
+            # Table Content - Keep small 8pt
+            'table_content': ParagraphStyle(
+                'TableContent',
+                parent=styles['Normal'],
+                fontName=font_name,
+                fontSize=8,
+                leading=10,
+                alignment=1 
+            ),
+            # Header Left - Smaller
+            'header_left': ParagraphStyle(
+                'HeaderLeft',
+                parent=styles['Normal'],
+                fontName=font_name,
+                fontSize=9, # Reduced from 11
+                alignment=0 
+            ),
+            # Header Center - Smaller
+            'header_center': ParagraphStyle(
+                'HeaderCenter',
+                parent=styles['Normal'],
+                fontName=font_name,
+                fontSize=14, # Reduced from 16
+                alignment=1 
+            ),
+        }
+
+    @staticmethod
+    def file_signature(path):
+        if not path:
+            return None
+        try:
+            stat = os.stat(path)
+            return (path, stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            return None
+
+    @staticmethod
+    def load_logo(path):
         # Logo - Smaller
-        header_right_logo = ''
-        if system_logo_path:
-             abs_logo_path = os.path.join(app.static_folder, system_logo_path)
-             if os.path.exists(abs_logo_path):
-                 try:
-                     img = Image(abs_logo_path)
-                     img_height = 20*mm # Reduced from 25
-                     img.drawHeight = img_height
-                     img.drawWidth = img_height * (img.imageWidth / img.imageHeight)
-                     header_right_logo = img
-                 except:
-                     pass
-
-        for exam_reg, template, subject in registrations:
-            if exam_reg != registrations[0][0]:
-                story.append(PageBreak())
-                
-            # --- Header (Compact) ---
-            header_data = [[
-                Paragraph(header_left_text, header_left_style), 
-                Paragraph(header_middle_text, header_center_style), 
-                header_right_logo
-            ]]
-            
-            # Reduce row height
-            header_table = Table(header_data, colWidths=[55*mm, 70*mm, 55*mm])
-            header_table.setStyle(TableStyle([
-                ('ALIGN', (0, 0), (0, 0), 'LEFT'),
-                ('ALIGN', (1, 0), (1, 0), 'CENTER'),
-                ('ALIGN', (2, 0), (2, 0), 'RIGHT'),
-                ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
-                ('LINEBELOW', (0, 0), (-1, 0), 1, colors.black),
-                ('BOTTOMPADDING', (0, 0), (-1, -1), 4), # Reduced padding
-                ('TOPPADDING', (0, 0), (-1, -1), 0),
-            ]))
-            story.append(header_table)
-            story.append(Spacer(1, 8)) # Reduced spacer
-            
-            # --- Title (Simplified) ---
-            story.append(Paragraph("测评报告", title_style))
-            story.append(Spacer(1, 8))
-            
-            # --- Basic Info ---
-            basic_info_data = [
-                [
-                    Paragraph(f"<b>考生姓名：</b> {student.name}", normal_style),
-                    Paragraph(f"<b>测评名称：</b> {template.name}", normal_style),
-                    Paragraph(f"<b>测评时间：</b> {exam_session.exam_date.strftime('%Y-%m-%d')}", normal_style)
-                ]
-            ]
-            
-            basic_info_table = Table(basic_info_data, colWidths=[60*mm, 60*mm, 60*mm])
-            basic_info_table.setStyle(TableStyle([
-                ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
-                ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
-                ('BOTTOMPADDING', (0, 0), (-1, -1), 6),
-            ]))
-            story.append(basic_info_table)
-            
-            # --- Analysis ---
-            story.append(Paragraph("测评分析", heading_style))
+        if not path:
+            return ''
+        try:
+            img = Image(path, lazy=0)
+            img_height = 20*mm # Reduced from 25
+            img.drawHeight = img_height
+            img.drawWidth = img_height * (img.imageWidth / img.imageHeight)
+            return img
+        except:
+            return ''
+
+    def is_current(self, logo_file, generation):
+        return self.generation == generation and \
+               self.logo_file == logo_file and \
+               self.logo_signature == self.file_signature(logo_file)
+
+    def header_table(self, left_text, middle_text):
+        header_table = Table([[
+            Paragraph(left_text, self.styles['header_left']), 
+            Paragraph(middle_text, self.styles['header_center']), 
+            self.logo
+        ]], colWidths=self.header_col_widths)
+        header_table.setStyle(self.header_table_style)
+        return header_table
+
+report_card_render_local = threading.local()
+report_card_render_generation = 0
+
+def get_report_card_render_context(logo_file=None):
+    """获取当前进程/线程的渲染上下文, Logo 文件变更或设置更新后自动重建"""
+    context = getattr(report_card_render_local, 'context', None)
+    if context is None or not context.is_current(logo_file, report_card_render_generation):
+        context = ReportCardRenderContext(logo_file, report_card_render_generation)
+        report_card_render_local.context = context
+    return context
+
+def invalidate_report_card_render_context():
+    """系统设置 (Logo/品牌) 变更后调用, 使本进程已缓存的渲染上下文失效"""
+    global report_card_render_generation
+    report_card_render_generation += 1
+
+def warm_report_card_render_context(logo_file=None):
+    """进程池 initializer: 在 worker 启动时预热渲染上下文"""
+    get_report_card_render_context(logo_file)
+
+def get_report_card_branding():
+    """读取成绩单品牌设置 (每批次查询一次)"""
+    setting = SystemSetting.query.first()
+    system_logo_path = setting.logo_path if setting else None
+    
+    logo_file = None
+    if system_logo_path:
+        abs_logo_path = os.path.join(app.static_folder, system_logo_path)
+        if os.path.exists(abs_logo_path):
+            logo_file = abs_logo_path
             
-            questions = Question.query.filter_by(exam_template_id=template.id).all()
+    return {
+        'company_name_zh': setting.company_name_zh if setting else '橡心国际',
+        'logo_file': logo_file
+    }
+
+def chunked(items, size=500):
+    """Split a list into chunks (keeps IN-lists below the SQLite variable limit)"""
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+def load_report_card_batch(keys, branding=None):
+    """
+    批量预取成绩单数据 (集合查询, 查询次数与学生人数无关)
+    keys: list of (student_id, exam_session_id, template_id|None)
+    返回与 keys 一一对应的 list, 每项为纯 dict 视图模型或 None (无数据)
+    """
+    keys = list(keys)
+    if not keys:
+        return []
+        
+    def natural_sort_key(q):
+        import re
+        parts = re.split(r'(\d+)', q.question_number)
+        return [int(p) if p.isdigit() else p for p in parts]
+    
+    # 1. Students (by primary key, falling back to student code as before)
+    raw_ids = set(str(k[0]) for k in keys)
+    pk_ids = set(i for i in (to_int(r) for r in raw_ids) if i is not None)
+    students_by_pk = {}
+    for chunk in chunked(pk_ids):
+        for s in Student.query.filter(Student.id.in_(chunk)).all():
+            students_by_pk[s.id] = s
             
-            def natural_sort_key(q):
-                import re
-                parts = re.split(r'(\d+)', q.question_number)
-                return [int(p) if p.isdigit() else p for p in parts]
-            questions.sort(key=natural_sort_key)
+    missing_codes = [r for r in raw_ids if to_int(r) not in students_by_pk]
+    students_by_code = {}
+    for chunk in chunked(missing_codes):
+        for s in Student.query.filter(Student.student_id.in_(chunk)).all():
+            students_by_code[s.student_id] = s
             
-            q_ids = [q.id for q in questions]
-            scores_map = {} 
-            if q_ids:
-                found_scores = Score.query.filter(
-                    Score.student_id == student.id,
-                    Score.question_id.in_(q_ids)
-                ).all()
-                scores_map = {s.question_id: s for s in found_scores}
+    def resolve_student(raw):
+        return students_by_pk.get(to_int(raw)) or students_by_code.get(str(raw))
+    
+    # 2. Sessions
+    session_ids = set(i for i in (to_int(k[1]) for k in keys) if i is not None)
+    sessions = {}
+    if session_ids:
+        sessions = {s.id: s for s in ExamSession.query.filter(ExamSession.id.in_(session_ids)).all()}
+        
+    # 3. Registrations (+ template) for every (student, session) pair in the batch
+    student_pks = set(s.id for s in (resolve_student(k[0]) for k in keys) if s)
+    regs_by_pair = {}
+    for chunk in chunked(student_pks):
+        if not session_ids:
+            break
+        rows = db.session.query(ExamRegistration, ExamTemplate)\
+            .join(ExamTemplate, ExamRegistration.exam_template_id == ExamTemplate.id)\
+            .join(Subject, ExamTemplate.subject_id == Subject.id)\
+            .filter(ExamRegistration.student_id.in_(chunk))\
+            .filter(ExamRegistration.exam_session_id.in_(session_ids))\
+            .order_by(ExamRegistration.id)\
+            .all()
+        for reg, template in rows:
+            regs_by_pair.setdefault((reg.student_id, reg.exam_session_id), []).append((reg, template))
             
-            detail_rows = []
-            total_score = 0
-            correct_count = 0
+    template_ids = set(t.id for pairs in regs_by_pair.values() for _, t in pairs)
+    registration_ids = set(r.id for pairs in regs_by_pair.values() for r, _ in pairs)
+    
+    # 4. Questions per template
+    questions_by_template = {}
+    if template_ids:
+        for q in Question.query.filter(Question.exam_template_id.in_(template_ids)).all():
+            questions_by_template.setdefault(q.exam_template_id, []).append(q)
+    for questions in questions_by_template.values():
+        questions.sort(key=natural_sort_key)
+        
+    # 5. Scores (student x template questions)
+    scores_map = {}
+    for chunk in chunked(student_pks):
+        if not template_ids:
+            break
+        rows = db.session.query(Score)\
+            .filter(Score.exam_template_id.in_(template_ids))\
+            .filter(Score.student_id.in_(chunk))\
+            .all()
+        for s in rows:
+            scores_map[(s.student_id, s.question_id)] = s
             
-            for q in questions:
-                score_obj = scores_map.get(q.id)
-                if score_obj:
-                    is_correct_text = '正确' if score_obj.is_correct else '错误'
-                    color = colors.green if score_obj.is_correct else colors.red
-                    if score_obj.is_correct:
-                        correct_count += 1
-                    total_score += float(score_obj.score)
-                else:
-                    # User requested empty value if not graded
-                    is_correct_text = '' 
-                    color = colors.black
+    # 6. Comments
+    comments = {}
+    for chunk in chunked(registration_ids):
+        for rc in ReportCard.query.filter(ReportCard.registration_id.in_(chunk)).all():
+            if rc.registration_id not in comments and (rc.teacher_comment or rc.ai_comment):
+                comments[rc.registration_id] = rc.teacher_comment or rc.ai_comment
                 
-                kp = q.knowledge_point or '' # User wants correct content, assuming empty if None
-                module_text = q.module or ''
-                
-                detail_rows.append([
-                    Paragraph(f"Q{q.question_number}", table_content_style),
-                    Paragraph(module_text, table_content_style),
-                    Paragraph(kp, table_content_style),
-                    Paragraph(f'<font color="{color}">{is_correct_text}</font>', table_content_style)
-                ])
-
-            mid = (len(detail_rows) + 1) // 2
-            left_data = detail_rows[:mid]
-            right_data = detail_rows[mid:]
+    # Settings
+    if branding is None:
+        branding = get_report_card_branding()
+        
+    # Build per-key view models
+    results = []
+    for raw_student_id, raw_session_id, raw_template_id in keys:
+        student = resolve_student(raw_student_id)
+        if not student:
+            print(f"Student not found: {raw_student_id}")
+            results.append(None)
+            continue
             
-            while len(right_data) < len(left_data):
-                right_data.append(['', '', '', ''])
-                
-            header_row = ['题号', '模块', '知识点', '结果', '', '题号', '模块', '知识点', '结果']
+        exam_session = sessions.get(to_int(raw_session_id))
+        if not exam_session:
+            results.append(None)
+            continue
             
-            table_data = [header_row]
-            for l, r in zip(left_data, right_data):
-                table_data.append(l + [''] + r)
-                
-            col_w = [10*mm, 18*mm, 47*mm, 12*mm]
-            gap_w = 6*mm
-            full_col_widths = col_w + [gap_w] + col_w
+        registrations = regs_by_pair.get((student.id, exam_session.id), [])
+        if raw_template_id:
+            registrations = [(r, t) for r, t in registrations if t.id == to_int(raw_template_id)]
+        if not registrations:
+            results.append(None)
+            continue
             
-            detail_table = Table(table_data, colWidths=full_col_widths, repeatRows=1)
-            detail_table.setStyle(TableStyle([
-                ('FONTNAME', (0, 0), (-1, -1), font_name),
-                ('FONTSIZE', (0, 0), (-1, -1), 9),
-                ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-                ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
-                ('BACKGROUND', (0, 0), (3, 0), colors.HexColor('#E8F4FC')),
-                ('BACKGROUND', (5, 0), (8, 0), colors.HexColor('#E8F4FC')),
-                ('GRID', (0, 0), (3, -1), 0.5, colors.grey),
-                ('GRID', (5, 0), (8, -1), 0.5, colors.grey),
-                ('BOTTOMPADDING', (0, 0), (-1, -1), 2),
-                ('TOPPADDING', (0, 0), (-1, -1), 2),
-            ]))
-            story.append(detail_table)
-            story.append(Spacer(1, 8))
+        sections = []
+        for exam_reg, template in registrations:
+            question_rows = []
+            for q in questions_by_template.get(template.id, []):
+                score_obj = scores_map.get((student.id, q.id))
+                question_rows.append({
+                    'number': q.question_number,
+                    'module': q.module or '',
+                    'knowledge_point': q.knowledge_point or '',
+                    'max_score': q.score,
+                    'score': float(score_obj.score) if score_obj else None,
+                    'is_correct': bool(score_obj.is_correct) if score_obj else None
+                })
+                
+            sections.append({
+                'registration_id': exam_reg.id,
+                'template_id': template.id,
+                'template_name': template.name,
+                'questions': question_rows,
+                'comment': comments.get(exam_reg.id, "")
+            })
             
-            # --- Analysis Summary ---
-            total_questions = len(questions)
-            incorrect_count = total_questions - correct_count
-            accuracy_pct = (correct_count / total_questions * 100) if total_questions > 0 else 0
+        results.append({
+            'student': {
+                'id': student.id,
+                'name': student.name,
+                'student_id': student.student_id
+            },
+            'exam_session_id': exam_session.id,
+            'exam_date': exam_session.exam_date.strftime('%Y-%m-%d'),
+            'header_left': exam_session.exam_name_en or 'Way To Future',
+            'header_middle': exam_session.company_brand or branding['company_name_zh'],
+            'logo_file': branding['logo_file'],
+            'sections': sections
+        })
+        
+    return results
+
+def build_report_card_data(student_id, exam_session_id, template_id=None, branding=None):
+    """
+    预取单份成绩单数据 (与批量导出共用 load_report_card_batch 数据通路)
+    返回纯 dict (可跨进程传递)，None 表示无可生成的数据
+    """
+    return load_report_card_batch([(student_id, exam_session_id, template_id)], branding)[0]
+
+def render_report_card_pdf(data):
+    """根据预取数据渲染成绩单PDF - Refactored v9 (Compact Layout), 返回 PDF bytes"""
+    context = get_report_card_render_context(data.get('logo_file'))
+    font_name = context.font_name
+    styles = context.styles
+    
+    student = data['student']
+    
+    # 创建PDF
+    buffer = io.BytesIO()
+    # Reduce margins
+    doc = SimpleDocTemplate(buffer, pagesize=A4, 
+                          rightMargin=15*mm, leftMargin=15*mm,
+                          topMargin=15*mm, bottomMargin=15*mm)
+    
+    story = []
+    
+    header_left_text = data['header_left']
+    header_middle_text = data['header_middle']
+    
+    for index, section in enumerate(data['sections']):
+        if index > 0:
+            story.append(PageBreak())
             
-            analysis_data = [
-                ['测评总题数', '正确题数', '错误题数', '正确率'],
-                [str(total_questions), str(correct_count), str(incorrect_count), f"{accuracy_pct:.1f}%"]
+        # --- Header (Compact) ---
+        story.append(context.header_table(header_left_text, header_middle_text))
+        story.append(Spacer(1, 8)) # Reduced spacer
+        
+        # --- Title (Simplified) ---
+        story.append(Paragraph("测评报告", styles['title']))
+        story.append(Spacer(1, 8))
+        
+        # --- Basic Info ---
+        basic_info_data = [
+            [
+                Paragraph(f"<b>考生姓名：</b> {student['name']}", styles['normal']),
+                Paragraph(f"<b>测评名称：</b> {section['template_name']}", styles['normal']),
+                Paragraph(f"<b>测评时间：</b> {data['exam_date']}", styles['normal'])
             ]
+        ]
+        
+        basic_info_table = Table(basic_info_data, colWidths=[60*mm, 60*mm, 60*mm])
+        basic_info_table.setStyle(TableStyle([
+            ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
+            ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+            ('BOTTOMPADDING', (0, 0), (-1, -1), 6),
+        ]))
+        story.append(basic_info_table)
+        
+        # --- Analysis ---
+        story.append(Paragraph("测评分析", styles['heading']))
+        
+        questions = section['questions']
+        detail_rows = []
+        total_score = 0
+        correct_count = 0
+        
+        for q in questions:
+            if q['score'] is not None:
+                is_correct_text = '正确' if q['is_correct'] else '错误'
+                color = colors.green if q['is_correct'] else colors.red
+                if q['is_correct']:
+                    correct_count += 1
+                total_score += q['score']
+            else:
+                # User requested empty value if not graded
+                is_correct_text = '' 
+                color = colors.black
             
-            analysis_table = Table(analysis_data, colWidths=[45*mm]*4)
-            analysis_table.setStyle(TableStyle([
-                ('FONTNAME', (0, 0), (-1, -1), font_name),
-                ('FONTSIZE', (0, 0), (-1, -1), 10),
-                ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-                ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
-                ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#E8F4FC')), 
-                ('GRID', (0, 0), (-1, -1), 0.5, colors.grey),
-                ('BOTTOMPADDING', (0, 0), (-1, -1), 6),
-                ('TOPPADDING', (0, 0), (-1, -1), 6),
-            ]))
-            story.append(analysis_table)
-            story.append(Spacer(1, 15))
-            
-            # --- Teacher Comment (Conditional Page Break) ---
-            # Instead of forcing page break, we let it flow. 
-            # But we want to ensure it doesn't break awkwardly.
-            # KeepTogether might be complex here, so we'll just check if we want to force it?
-            # User wants "Control within 2 pages (1 sheet duplex)".
-            # If the table is long, it might push comment to 3rd page.
-            # Let's try to keep it compact.
-            
-            # story.append(PageBreak()) # Removed forced break to save space if possible
-            
-            # Check if we need a break? Hard to know current position.
-            # But "3. 测评评价区域缩小到页面三分之一" (approx 90-100mm)
-            # If we just append, it might fit on page 2 bottom.
+            detail_rows.append([
+                Paragraph(f"Q{q['number']}", styles['table_content']),
+                Paragraph(q['module'], styles['table_content']),
+                Paragraph(q['knowledge_point'], styles['table_content']),
+                Paragraph(f'<font color="{color}">{is_correct_text}</font>', styles['table_content'])
+            ])
+
+        mid = (len(detail_rows) + 1) // 2
+        left_data = detail_rows[:mid]
+        right_data = detail_rows[mid:]
+        
+        while len(right_data) < len(left_data):
+            right_data.append(['', '', '', ''])
             
-            story.append(Paragraph("测评评价", heading_style))
+        header_row = ['题号', '模块', '知识点', '结果', '', '题号', '模块', '知识点', '结果']
+        
+        table_data = [header_row]
+        for l, r in zip(left_data, right_data):
+            table_data.append(l + [''] + r)
             
-            report_card = ReportCard.query.filter_by(registration_id=exam_reg.id).first()
-            comment_text = ""
-            if report_card and (report_card.teacher_comment or report_card.ai_comment):
-                comment_text = report_card.teacher_comment or report_card.ai_comment
+        col_w = [10*mm, 18*mm, 47*mm, 12*mm]
+        gap_w = 6*mm
+        full_col_widths = col_w + [gap_w] + col_w
+        
+        detail_table = Table(table_data, colWidths=full_col_widths, repeatRows=1)
+        detail_table.setStyle(TableStyle([
+            ('FONTNAME', (0, 0), (-1, -1), font_name),
+            ('FONTSIZE', (0, 0), (-1, -1), 9),
+            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+            ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+            ('BACKGROUND', (0, 0), (3, 0), colors.HexColor('#E8F4FC')),
+            ('BACKGROUND', (5, 0), (8, 0), colors.HexColor('#E8F4FC')),
+            ('GRID', (0, 0), (3, -1), 0.5, colors.grey),
+            ('GRID', (5, 0), (8, -1), 0.5, colors.grey),
+            ('BOTTOMPADDING', (0, 0), (-1, -1), 2),
+            ('TOPPADDING', (0, 0), (-1, -1), 2),
+        ]))
+        story.append(detail_table)
+        story.append(Spacer(1, 8))
+        
+        # --- Analysis Summary ---
+        total_questions = len(questions)
+        incorrect_count = total_questions - correct_count
+        accuracy_pct = (correct_count / total_questions * 100) if total_questions > 0 else 0
+        
+        analysis_data = [
+            ['测评总题数', '正确题数', '错误题数', '正确率'],
+            [str(total_questions), str(correct_count), str(incorrect_count), f"{accuracy_pct:.1f}%"]
+        ]
+        
+        analysis_table = Table(analysis_data, colWidths=[45*mm]*4)
+        analysis_table.setStyle(TableStyle([
+            ('FONTNAME', (0, 0), (-1, -1), font_name),
+            ('FONTSIZE', (0, 0), (-1, -1), 10),
+            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+            ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+            ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#E8F4FC')), 
+            ('GRID', (0, 0), (-1, -1), 0.5, colors.grey),
+            ('BOTTOMPADDING', (0, 0), (-1, -1), 6),
+            ('TOPPADDING', (0, 0), (-1, -1), 6),
+        ]))
+        story.append(analysis_table)
+        story.append(Spacer(1, 15))
+        
+        # --- Teacher Comment ---
+        # "3. 测评评价区域缩小到页面三分之一" (approx 90-100mm), flows onto page 2 if needed
+        story.append(Paragraph("测评评价", styles['heading']))
+        
+        # Reduced height: 90mm (approx 1/3 page)
+        comment_data = [[Paragraph(section['comment'], styles['normal'])]]
+        comment_table = Table(comment_data, colWidths=[180*mm], rowHeights=[90*mm])
+        comment_table.setStyle(TableStyle([
+            ('FONTNAME', (0, 0), (-1, -1), font_name),
+            ('GRID', (0, 0), (-1, -1), 0.5, colors.grey),
+            ('VALIGN', (0, 0), (-1, -1), 'TOP'),
+            ('TOPPADDING', (0, 0), (-1, -1), 8),
+            ('LEFTPADDING', (0, 0), (-1, -1), 8),
+        ]))
+        story.append(comment_table)
+        
+        # Footer
+        story.append(Spacer(1, 8))
+        footer_text = f"{header_left_text} | {header_middle_text}"
+        story.append(Paragraph(footer_text, styles['small']))
+        
+    doc.build(story)
+    return buffer.getvalue()
+
+# --- Report Card PDF Cache (content-addressed, on disk) ---
+
+# Bump when the PDF layout changes so previously cached files are no longer addressed
+REPORT_CARD_RENDER_VERSION = 'v9'
+
+def report_card_digest(data):
+    """成绩单输入摘要: 分数/评语/题目/场次页眉/品牌设置 任一变化都会得到新的 key"""
+    payload = json.dumps(data, sort_keys=True, ensure_ascii=False, default=str)
+    digest = hashlib.sha256()
+    digest.update(REPORT_CARD_RENDER_VERSION.encode('utf-8'))
+    digest.update(payload.encode('utf-8'))
+    # Same logo path but a re-uploaded file must not hit the old entry
+    digest.update(repr(ReportCardRenderContext.file_signature(data.get('logo_file'))).encode('utf-8'))
+    return digest.hexdigest()
+
+def report_card_cache_path(digest):
+    return os.path.join(app.config['REPORT_CARD_CACHE_DIR'], f"{digest}.pdf")
+
+def report_card_cache_exists(digest):
+    """是否命中 (只检查文件, 不读入内存)"""
+    return app.config['REPORT_CARD_CACHE_ENABLED'] and os.path.exists(report_card_cache_path(digest))
+
+def read_report_card_cache(digest):
+    """命中返回 PDF bytes，未命中返回 None"""
+    if not app.config['REPORT_CARD_CACHE_ENABLED']:
+        return None
+    path = report_card_cache_path(digest)
+    try:
+        with open(path, 'rb') as f:
+            pdf_bytes = f.read()
+        os.utime(path) # LRU: mark as recently used
+        return pdf_bytes
+    except OSError:
+        return None
+
+def write_report_card_cache(digest, pdf_bytes):
+    if not app.config['REPORT_CARD_CACHE_ENABLED']:
+        return
+    cache_dir = app.config['REPORT_CARD_CACHE_DIR']
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        path = report_card_cache_path(digest)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(pdf_bytes)
+        os.replace(tmp_path, path)
+        evict_report_card_cache()
+    except OSError as e:
+        print(f"Report card cache write failed: {e}")
+
+def evict_report_card_cache():
+    """按容量淘汰最久未使用的缓存文件 (降到上限的 90%)"""
+    cache_dir = app.config['REPORT_CARD_CACHE_DIR']
+    max_bytes = app.config['REPORT_CARD_CACHE_MAX_BYTES']
+    try:
+        entries = [e for e in os.scandir(cache_dir) if e.is_file() and e.name.endswith('.pdf')]
+    except OSError:
+        return
+    sized = [(e.stat().st_mtime, e.stat().st_size, e.path) for e in entries]
+    total = sum(size for _, size, _ in sized)
+    if total <= max_bytes:
+        return
+    for mtime, size, path in sorted(sized):
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        if total <= max_bytes * 0.9:
+            break
+
+def report_card_pdf_url(digest):
+    return f"report_card_cache/{digest}.pdf"
+
+def record_report_card_pdf_urls(entries):
+    """
+    回写 ReportCard.pdf_url (仅单科目成绩单与报名记录一一对应), 供分数/评语变更时删除旧文件
+    只在批量渲染 (任务/邮件/批量导出) 中调用; 单份预览等 GET 请求不写数据库, 其缓存文件按容量淘汰
+    entries: list of (data, digest)
+    """
+    url_by_reg = {}
+    for data, digest in entries:
+        if len(data['sections']) == 1:
+            url_by_reg[data['sections'][0]['registration_id']] = report_card_pdf_url(digest)
+    if not url_by_reg:
+        return
+    try:
+        existing = {}
+        for chunk in chunked(url_by_reg.keys()):
+            for rc in ReportCard.query.filter(ReportCard.registration_id.in_(chunk)).all():
+                existing.setdefault(rc.registration_id, rc)
+        changed = False
+        for reg_id, url in url_by_reg.items():
+            report_card = existing.get(reg_id)
+            if not report_card:
+                report_card = ReportCard(registration_id=reg_id)
+                db.session.add(report_card)
+            if report_card.pdf_url != url:
+                report_card.pdf_url = url
+                changed = True
+        if changed:
+            db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        print(f"Failed to record report card pdf_url: {e}")
+
+def invalidate_report_card_cache(registration_ids=None):
+    """
+    使成绩单缓存失效 (分数/评语变更时调用, 不提交事务)
+    registration_ids 为 None 时清空全部缓存 (品牌设置变更无需调用, 摘要已包含品牌与 logo)
+    """
+    query = ReportCard.query.filter(ReportCard.pdf_url != None)
+    if registration_ids is not None:
+        registration_ids = [r for r in registration_ids if r]
+        if not registration_ids:
+            return
+        query = query.filter(ReportCard.registration_id.in_(registration_ids))
+    
+    for report_card in query.all():
+        path = os.path.join(app.config['REPORT_CARD_CACHE_DIR'], os.path.basename(report_card.pdf_url))
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        report_card.pdf_url = None
+        
+    if registration_ids is None:
+        shutil.rmtree(app.config['REPORT_CARD_CACHE_DIR'], ignore_errors=True)
+
+def invalidate_student_report_cards(student_id, template_ids):
+    """分数变更后使该学生对应试卷的成绩单缓存失效"""
+    template_ids = [t for t in template_ids if t]
+    if not template_ids:
+        return
+    regs = db.session.query(ExamRegistration.id).filter(
+        ExamRegistration.student_id == student_id,
+        ExamRegistration.exam_template_id.in_(template_ids)
+    ).all()
+    invalidate_report_card_cache([r[0] for r in regs])
+
+def get_report_card_pdf(data, digest=None):
+    """返回 (pdf_bytes, digest)，优先读取磁盘缓存 (不写数据库, 可在 GET 请求中调用)"""
+    digest = digest or report_card_digest(data)
+    pdf_bytes = read_report_card_cache(digest)
+    if pdf_bytes is None:
+        pdf_bytes = render_report_card_pdf(data)
+        write_report_card_cache(digest, pdf_bytes)
+    return pdf_bytes, digest
+
+def generate_report_card_pdf(student_id, exam_session_id, template_id=None):
+    """生成学生成绩单PDF (单份, 经缓存)，返回 BytesIO 或 None"""
+    try:
+        data = build_report_card_data(student_id, exam_session_id, template_id)
+        if not data:
+            return None
+        pdf_bytes, digest = get_report_card_pdf(data)
+        return io.BytesIO(pdf_bytes)
+        
+    except Exception as e:
+        print(f"生成PDF错误: {e}")
+        import traceback
+        traceback.print_exc()
+        return None
+
+@app.route('/pdf/report-card/<student_id>/<exam_session_id>')
+def pdf_report_card(student_id, exam_session_id):
+    """生成并下载成绩单PDF (支持 ETag / 304)"""
+    template_id = request.args.get('template_id')
+    try:
+        data = build_report_card_data(student_id, exam_session_id, template_id)
+    except Exception as e:
+        print(f"生成PDF错误: {e}")
+        data = None
+        
+    if not data:
+        return "生成PDF失败", 500
+        
+    digest = report_card_digest(data)
+    
+    # 检查是否为下载请求
+    action = request.args.get('action', 'preview')
+    as_attachment = (action == 'download')
+    
+    # Client already holds this exact PDF
+    if digest in request.if_none_match and not as_attachment:
+        response = make_response('', 304)
+        response.set_etag(digest)
+        return response
+        
+    try:
+        pdf_bytes, digest = get_report_card_pdf(data, digest)
+    except Exception as e:
+        print(f"生成PDF错误: {e}")
+        import traceback
+        traceback.print_exc()
+        return "生成PDF失败", 500
+        
+    student = data['student']
+    filename = f"成绩单_{student['name']}_{student['student_id']}_{exam_session_id}.pdf"
+    
+    response = send_file(
+        io.BytesIO(pdf_bytes),
+        as_attachment=as_attachment,
+        download_name=filename,
+        mimetype='application/pdf',
+        etag=digest
+    )
+    response.cache_control.private = True
+    response.cache_control.no_cache = True # always revalidate via ETag
+    return response
+
+# --- Batch Report Card Rendering (Process Pool) ---
+
+def render_report_card_task(data):
+    """进程池入口: 渲染单份预取数据, 返回 (pdf_bytes, error)"""
+    try:
+        return render_report_card_pdf(data), None
+    except Exception as e:
+        return None, str(e)
+
+def render_report_card_batch(tasks, workers=None):
+    """
+    批量渲染成绩单 (数据在请求线程预取, 渲染分发至进程池)
+    tasks: list of dict {'student_id': int, 'session_id': int, 'template_id': int|None, 'filename': str}
+    Yields (task, pdf_bytes, error) in task order.
+    pdf_bytes 为 None 且 error 为 None 表示无数据 (No Data)
+    """
+    if workers is None:
+        workers = app.config['PDF_BATCH_WORKERS']
+        
+    # 1. Pre-fetch plain data in bulk (ORM objects never leave this process)
+    branding = get_report_card_branding()
+    keys = [(t['student_id'], t['session_id'], t.get('template_id')) for t in tasks]
+    try:
+        prepared = list(zip(tasks, load_report_card_batch(keys, branding), [None] * len(tasks)))
+    except Exception as e:
+        prepared = [(task, None, str(e)) for task in tasks]
             
-            # Reduced height: 90mm (approx 1/3 page)
-            comment_data = [[Paragraph(comment_text, normal_style)]]
-            comment_table = Table(comment_data, colWidths=[180*mm], rowHeights=[90*mm])
-            comment_table.setStyle(TableStyle([
-                ('FONTNAME', (0, 0), (-1, -1), font_name),
-                ('GRID', (0, 0), (-1, -1), 0.5, colors.grey),
-                ('VALIGN', (0, 0), (-1, -1), 'TOP'),
-                ('TOPPADDING', (0, 0), (-1, -1), 8),
-                ('LEFTPADDING', (0, 0), (-1, -1), 8),
-            ]))
-            story.append(comment_table)
+    # 2. Serve cache hits directly, only misses are rendered
+    # (hits are only checked here; each PDF is read just before it is yielded, so memory stays bounded)
+    entries = []
+    for task, data, error in prepared:
+        digest = report_card_digest(data) if data else None
+        entries.append((task, data, error, digest, bool(digest) and report_card_cache_exists(digest)))
+        
+    payloads = [data for task, data, error, digest, hit in entries if data and not hit]
+    
+    # 3. Render (inline for tiny batches, otherwise in the pool)
+    if workers <= 1 or len(payloads) <= 1:
+        rendered = map(render_report_card_task, payloads)
+        pool = None
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        pool = ProcessPoolExecutor(max_workers=min(workers, len(payloads)),
+                                   initializer=warm_report_card_render_context,
+                                   initargs=(branding['logo_file'],))
+        rendered = submit_in_window(pool, render_report_card_task, payloads, window=workers * 2)
+        
+    try:
+        rendered_entries = []
+        for task, data, error, digest, hit in entries:
+            if not data:
+                yield task, None, error
+                continue
+            if hit:
+                cached = read_report_card_cache(digest)
+                if cached is not None:
+                    rendered_entries.append((data, digest))
+                    yield task, cached, None
+                    continue
+                pdf_bytes, render_error = render_report_card_task(data) # evicted since the check
+            else:
+                pdf_bytes, render_error = next(rendered)
+            if pdf_bytes:
+                write_report_card_cache(digest, pdf_bytes)
+                rendered_entries.append((data, digest))
+            yield task, pdf_bytes, render_error
+        record_report_card_pdf_urls(rendered_entries)
+    finally:
+        if pool:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+def submit_in_window(pool, fn, items, window):
+    """
+    按顺序提交任务, 同时在途的任务不超过 window 个
+    (pool.map 会一次性提交全部任务, 下游读取慢时结果会全部堆积在内存中)
+    """
+    from collections import deque
+    items = iter(items)
+    pending = deque()
+    
+    def submit_next():
+        for item in items:
+            pending.append(pool.submit(fn, item))
+            return
             
-            # Footer
-            story.append(Spacer(1, 8))
-            footer_text = f"{header_left_text} | {header_middle_text}"
-            story.append(Paragraph(footer_text, small_style))
+    for _ in range(window):
+        submit_next()
+    while pending:
+        future = pending.popleft()
+        submit_next()
+        yield future.result()
+
+# --- Streaming ZIP ---
+
+class ZipStreamSink:
+    """只写、不可 seek 的缓冲区: zipfile 写入的字节由 stream_zip 随时取走"""
+    def __init__(self):
+        self.chunks = []
+        
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+        
+    def flush(self):
+        pass
+        
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+def stream_zip(entries, error_log=None):
+    """
+    流式生成ZIP: 每写完一个条目即 yield 对应字节, 内存占用与条目数量无关
+    entries: iterable of (filename, content), PDF 本身已压缩, 以 ZIP_STORED 原样存储
+    error_log: list, 遍历 entries 时追加, 最后写入 error_log.txt
+    """
+    sink = ZipStreamSink()
+    names = set()
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_STORED) as zip_file:
+        for filename, content in entries:
+            # Ensure unique filenames
+            if filename in names:
+                base, ext = os.path.splitext(filename)
+                counter = 1
+                while f"{base}_{counter}{ext}" in names:
+                    counter += 1
+                filename = f"{base}_{counter}{ext}"
+            names.add(filename)
             
-        doc.build(story)
-        buffer.seek(0)
-        return buffer
-        
-    except Exception as e:
-        print(f"生成PDF错误: {e}")
-        import traceback
-        traceback.print_exc()
-        return None
-@app.route('/pdf/report-card/<student_id>/<exam_session_id>')
-def pdf_report_card(student_id, exam_session_id):
-    """生成并下载成绩单PDF"""
-    template_id = request.args.get('template_id')
-    pdf_buffer = generate_report_card_pdf(student_id, exam_session_id, template_id)
-    
-    if pdf_buffer:
-        student = Student.query.get(student_id)
-        if not student:
-            student = Student.query.filter_by(student_id=str(student_id)).first()
+            info = zipfile.ZipInfo(filename, date_time=datetime.now().timetuple()[:6])
+            info.external_attr = 0o600 << 16
+            zip_file.writestr(info, content)
+            yield sink.drain()
             
-        if student:
-            filename = f"成绩单_{student.name}_{student.student_id}_{exam_session_id}.pdf"
+        if error_log:
+            zip_file.writestr('error_log.txt', '\n'.join(error_log), compress_type=zipfile.ZIP_DEFLATED)
+    yield sink.drain()
+
+def zip_stream_response(entries, download_name, error_log=None):
+    """以流式响应下载ZIP (边渲染边发送)"""
+    from urllib.parse import quote
+    response = Response(stream_with_context(stream_zip(entries, error_log)), mimetype='application/zip')
+    # Handle filename encoding for non-ascii
+    response.headers["Content-Disposition"] = f"attachment; filename*=UTF-8''{quote(download_name)}"
+    return response
+
+def report_card_zip_entries(tasks, error_log, progress=None):
+    """
+    批量渲染结果 -> ZIP 条目 (文件名清洗, 失败记录到 error_log)
+    tasks: list of dict {'student_id': int, 'session_id': int, 'template_id': int|None, 'filename': str}
+    progress: 可选回调 progress(done, total)
+    """
+    for index, (task, pdf_bytes, error) in enumerate(render_report_card_batch(tasks)):
+        if progress:
+            progress(index, len(tasks))
+        if error:
+            error_log.append(f"Error generating {task['filename']}: {error}")
+        elif pdf_bytes:
+            # Sanitize filename
+            safe_filename = "".join([c for c in task['filename'] if c.isalnum() or c in (' ', '.', '_', '-')]).strip()
+            if not safe_filename.endswith('.pdf'):
+                safe_filename += '.pdf'
+            yield safe_filename, pdf_bytes
         else:
-            filename = f"成绩单_{student_id}_{exam_session_id}.pdf"
-        
-        # 检查是否为下载请求
-        action = request.args.get('action', 'preview')
-        as_attachment = (action == 'download')
+            error_log.append(f"Failed to generate (No Data): {task['filename']}")
+    if progress:
+        progress(len(tasks), len(tasks))
+
+def batch_zip_response(tasks, download_name):
+    """批量成绩单ZIP: 流式下载, 或提交后台任务 (async)"""
+    if wants_background_job():
+        return submit_job_response('report_card_zip', {'tasks': tasks, 'download_name': download_name})
         
-        return send_file(
-            pdf_buffer,
-            as_attachment=as_attachment,
-            download_name=filename,
-            mimetype='application/pdf'
-        )
-    else:
-        return "生成PDF失败", 500
+    error_log = []
+    return zip_stream_response(report_card_zip_entries(tasks, error_log), download_name, error_log)
 
 def generate_batch_zip(tasks, zip_name):
     """
-    Helper to generate ZIP with PDFs.
+    Helper to generate ZIP with PDFs on disk (调用方负责 cleanup_temp_dir).
     tasks: list of dict {'student_id': int, 'session_id': int, 'template_id': int|None, 'filename': str}
     """
-    import zipfile
     import tempfile
     
     temp_dir = tempfile.mkdtemp()
     zip_path = os.path.join(temp_dir, zip_name)
     
     error_log = []
-    
-    with zipfile.ZipFile(zip_path, 'w') as zipf:
-        for task in tasks:
-            try:
-                pdf_buffer = generate_report_card_pdf(task['student_id'], task['session_id'], task.get('template_id'))
-                if pdf_buffer:
-                    # Sanitize filename
-                    safe_filename = "".join([c for c in task['filename'] if c.isalnum() or c in (' ', '.', '_', '-')]).strip()
-                    if not safe_filename.endswith('.pdf'):
-                        safe_filename += '.pdf'
-                        
-                    pdf_path = os.path.join(temp_dir, safe_filename)
-                    with open(pdf_path, 'wb') as f:
-                        f.write(pdf_buffer.getvalue())
-                    zipf.write(pdf_path, safe_filename)
-                    os.remove(pdf_path)
-                else:
-                    error_log.append(f"Failed to generate (No Data): {task['filename']}")
-            except Exception as e:
-                error_log.append(f"Error generating {task['filename']}: {str(e)}")
-                
-        if error_log:
-            error_path = os.path.join(temp_dir, "error_log.txt")
-            with open(error_path, "w") as f:
-                f.write("\n".join(error_log))
-            zipf.write(error_path, "error_log.txt")
-            os.remove(error_path)
+    with open(zip_path, 'wb') as f:
+        for chunk in stream_zip(report_card_zip_entries(tasks, error_log), error_log):
+            f.write(chunk)
             
     return zip_path
 
-import shutil
-
 def cleanup_temp_dir(path):
     try:
         # Check if it's a file, get parent dir
@@ -2444,19 +4762,7 @@ def pdf_batch_report_cards(exam_session_id):
                     'filename': f"{student.name}_{student.student_id}.pdf"
                 })
         
-        zip_path = generate_batch_zip(tasks, f'Batch_Session_{session.name}.zip')
-        
-        @flask.after_this_request
-        def remove_file(response):
-            cleanup_temp_dir(zip_path)
-            return response
-            
-        return send_file(
-            zip_path,
-            as_attachment=True,
-            download_name=f'批量成绩单_{session.name}.zip',
-            mimetype='application/zip'
-        )
+        return batch_zip_response(tasks, f'批量成绩单_{session.name}.zip')
     except Exception as e:
         return f"批量生成失败: {str(e)}", 500
 
@@ -2482,19 +4788,7 @@ def pdf_batch_report_cards_by_template(template_id):
                     'filename': f"{student.name}_{student.student_id}_{template.name}.pdf"
                 })
                 
-        zip_path = generate_batch_zip(tasks, f'Batch_Template_{template.name}.zip')
-        
-        @flask.after_this_request
-        def remove_file(response):
-            cleanup_temp_dir(zip_path)
-            return response
-
-        return send_file(
-            zip_path,
-            as_attachment=True,
-            download_name=f'批量成绩单_试卷_{template.name}.zip',
-            mimetype='application/zip'
-        )
+        return batch_zip_response(tasks, f'批量成绩单_试卷_{template.name}.zip')
     except Exception as e:
         return f"批量生成失败: {str(e)}", 500
 
@@ -2522,19 +4816,7 @@ def pdf_batch_report_cards_by_student(student_id):
                     'filename': f"{session.name}_{session.exam_date}.pdf"
                 })
                 
-        zip_path = generate_batch_zip(tasks, f'Batch_Student_{student.name}.zip')
-        
-        @flask.after_this_request
-        def remove_file(response):
-            cleanup_temp_dir(zip_path)
-            return response
-
-        return send_file(
-            zip_path,
-            as_attachment=True,
-            download_name=f'批量成绩单_{student.name}.zip',
-            mimetype='application/zip'
-        )
+        return batch_zip_response(tasks, f'批量成绩单_{student.name}.zip')
     except Exception as e:
         return f"批量生成失败: {str(e)}", 500
 
@@ -2567,14 +4849,7 @@ def api_pdf_batch_selected():
                     'filename': filename
                 })
         
-        zip_path = generate_batch_zip(tasks, f'Batch_Selected_{len(tasks)}_Items.zip')
-        
-        return send_file(
-            zip_path,
-            as_attachment=True,
-            download_name=f'批量导出_{len(tasks)}项.zip',
-            mimetype='application/zip'
-        )
+        return batch_zip_response(tasks, f'批量导出_{len(tasks)}项.zip')
     except Exception as e:
         print(f"Batch generation error: {e}")
         return jsonify({'success': False, 'message': f'生成失败: {str(e)}'}), 500
@@ -2600,8 +4875,7 @@ def api_batch_export_by_student(student_id):
             'filename': filename
             })
     
-    zip_path = generate_batch_zip(tasks, f'{student.name}_All_ReportCards.zip')
-    return send_file(zip_path, as_attachment=True, download_name=f'{student.name}_全部成绩单.zip', mimetype='application/zip')
+    return batch_zip_response(tasks, f'{student.name}_全部成绩单.zip')
 
 @app.route('/api/pdf/batch-export-by-template/<int:template_id>', methods=['GET'])
 @login_required
@@ -2625,8 +4899,7 @@ def api_batch_export_by_template(template_id):
                 'filename': filename
                 })
                 
-    zip_path = generate_batch_zip(tasks, f'{template.name}_All_ReportCards.zip')
-    return send_file(zip_path, as_attachment=True, download_name=f'{template.name}_全部成绩单.zip', mimetype='application/zip')
+    return batch_zip_response(tasks, f'{template.name}_全部成绩单.zip')
 
 @app.route('/api/pdf/batch-export-all', methods=['GET'])
 @login_required
@@ -2649,8 +4922,356 @@ def api_batch_export_all_pdfs():
                 'filename': filename
                 })
                 
-    zip_path = generate_batch_zip(tasks, f'All_ReportCards_Full_Backup.zip')
-    return send_file(zip_path, as_attachment=True, download_name=f'全量成绩单备份.zip', mimetype='application/zip')
+    return batch_zip_response(tasks, f'全量成绩单备份.zip')
+
+# --- Background Jobs ---
+# 长耗时操作 (批量PDF/邮件/LLM) 写入 background_jobs 表, 由独立的 scripts/job_worker.py 进程执行;
+# Web worker 立即返回 job_id, 前端轮询 /api/jobs/<id> 获取进度并下载结果.
+
+class JobCancelled(Exception):
+    pass
+
+JOB_HANDLERS = {}
+
+def job_handler(job_type):
+    """注册后台任务处理函数 handler(job, params) -> result dict"""
+    def decorator(f):
+        JOB_HANDLERS[job_type] = f
+        return f
+    return decorator
+
+def wants_background_job():
+    """
+    是否作为后台任务执行: 默认 JOB_ASYNC_DEFAULT;
+    请求可用 ?async=1/0 或 JSON {"async": true/false} 覆盖 (脚本直接下载时传 0)
+    """
+    flag = request.args.get('async')
+    if flag is not None:
+        return flag in ('1', 'true')
+    data = request.get_json(silent=True) if request.is_json else None
+    if isinstance(data, dict) and 'async' in data:
+        return bool(data['async'])
+    return app.config['JOB_ASYNC_DEFAULT']
+
+def submit_job(job_type, params, created_by=None):
+    """创建待执行任务"""
+    if job_type not in JOB_HANDLERS:
+        raise ValueError(f'Unknown job type: {job_type}')
+    job = BackgroundJob(job_type=job_type, params=json.dumps(params, ensure_ascii=False), created_by=created_by)
+    db.session.add(job)
+    db.session.commit()
+    return job
+
+def submit_job_response(job_type, params):
+    job = submit_job(job_type, params, session.get('user_id'))
+    return jsonify({
+        'success': True,
+        'job_id': job.id,
+        'status_url': url_for('api_job_status', job_id=job.id)
+    }), 202
+
+class JobProgress:
+    """处理函数上报进度的回调; 每次写入同时刷新心跳并检查取消标记"""
+    def __init__(self, job_id, min_interval=0.5):
+        self.job_id = job_id
+        self.min_interval = min_interval
+        self.last_report = 0
+
+    def __call__(self, current, total=None, message=None, force=False):
+        now = time.monotonic()
+        finished = total is not None and current >= total
+        if not force and not finished and now - self.last_report < self.min_interval:
+            return
+        self.last_report = now
+
+        values = {'progress_current': current, 'heartbeat_at': datetime.utcnow()}
+        if total is not None:
+            values['progress_total'] = total
+        if message is not None:
+            values['message'] = message[:255]
+        db.session.query(BackgroundJob).filter_by(id=self.job_id).update(values, synchronize_session=False)
+        db.session.commit()
+
+        cancel_requested = db.session.query(BackgroundJob.cancel_requested).filter_by(id=self.job_id).scalar()
+        if cancel_requested:
+            raise JobCancelled()
+
+def job_result_path(job_id, suffix):
+    result_dir = app.config['JOB_RESULT_DIR']
+    os.makedirs(result_dir, exist_ok=True)
+    return os.path.join(result_dir, f"job_{job_id}{suffix}")
+
+def claim_next_job(worker_id):
+    """领取一个待执行任务 (条件 UPDATE, 多个 worker 不会重复领取)"""
+    candidate_ids = [row[0] for row in db.session.query(BackgroundJob.id)
+                     .filter_by(status='pending').order_by(BackgroundJob.id).limit(5).all()]
+    for job_id in candidate_ids:
+        now = datetime.utcnow()
+        claimed = db.session.query(BackgroundJob)\
+            .filter(BackgroundJob.id == job_id, BackgroundJob.status == 'pending')\
+            .update({'status': 'running', 'worker_id': worker_id, 'started_at': now, 'heartbeat_at': now},
+                    synchronize_session=False)
+        db.session.commit()
+        if claimed:
+            return BackgroundJob.query.get(job_id)
+    return None
+
+def finish_job(job_id, status, **values):
+    values.update({'status': status, 'finished_at': datetime.utcnow()})
+    db.session.query(BackgroundJob).filter_by(id=job_id).update(values, synchronize_session=False)
+    db.session.commit()
+
+def remove_job_result(job_id):
+    job = BackgroundJob.query.get(job_id)
+    if job and job.result_path:
+        if os.path.exists(job.result_path):
+            os.remove(job.result_path)
+        job.result_path = None
+        db.session.commit()
+
+def run_job(job):
+    """执行已领取的任务并记录结果"""
+    job_id = job.id
+    handler = JOB_HANDLERS.get(job.job_type)
+    if not handler:
+        finish_job(job_id, 'failed', error=f'Unknown job type: {job.job_type}')
+        return
+
+    try:
+        params = json.loads(job.params) if job.params else {}
+        result = handler(job, params) or {}
+        finish_job(job_id, 'succeeded', result=json.dumps(result, ensure_ascii=False), message='完成')
+    except JobCancelled:
+        db.session.rollback()
+        remove_job_result(job_id)
+        finish_job(job_id, 'cancelled', message='已取消')
+    except Exception as e:
+        db.session.rollback()
+        import traceback
+        traceback.print_exc()
+        remove_job_result(job_id)
+        finish_job(job_id, 'failed', error=str(e), message='执行失败')
+
+def recover_stale_jobs():
+    """worker 异常退出后遗留的 running 任务标记为失败"""
+    deadline = datetime.utcnow() - timedelta(seconds=app.config['JOB_STALE_SECONDS'])
+    stale = BackgroundJob.query.filter(BackgroundJob.status == 'running', BackgroundJob.heartbeat_at < deadline).all()
+    for job in stale:
+        job.status = 'failed'
+        job.error = 'Worker lost (no heartbeat)'
+        job.finished_at = datetime.utcnow()
+    if stale:
+        db.session.commit()
+
+def purge_expired_job_results():
+    """删除过期任务的结果文件"""
+    deadline = datetime.utcnow() - timedelta(hours=app.config['JOB_RESULT_TTL_HOURS'])
+    expired = BackgroundJob.query.filter(BackgroundJob.finished_at < deadline, BackgroundJob.result_path != None).all()
+    for job in expired:
+        if os.path.exists(job.result_path):
+            os.remove(job.result_path)
+        job.result_path = None
+    if expired:
+        db.session.commit()
+
+def run_job_worker(poll_interval=1.0, max_jobs=None):
+    """
+    后台任务 worker 主循环 (scripts/job_worker.py 以独立进程运行)
+    max_jobs: 处理指定数量后退出; 队列为空时也立即退出 (用于测试/一次性执行)
+    """
+    import socket
+    worker_id = f"{socket.gethostname()}:{os.getpid()}"
+    processed = 0
+    last_housekeeping = 0
+
+    while max_jobs is None or processed < max_jobs:
+        with app.app_context():
+            if time.monotonic() - last_housekeeping > 60:
+                recover_stale_jobs()
+                purge_expired_job_results()
+                last_housekeeping = time.monotonic()
+
+            job = claim_next_job(worker_id)
+            if job:
+                print(f"Job {job.id} ({job.job_type}) started on {worker_id}")
+                run_job(job)
+                processed += 1
+            db.session.remove()
+
+        if not job:
+            if max_jobs is not None:
+                break
+            time.sleep(poll_interval)
+    return processed
+
+@job_handler('report_card_zip')
+def run_report_card_zip_job(job, params):
+    """批量成绩单ZIP -> 结果文件"""
+    tasks = params.get('tasks', [])
+    progress = JobProgress(job.id)
+    progress(0, len(tasks), '正在生成成绩单', force=True)
+
+    job.result_path = job_result_path(job.id, '.zip')
+    job.result_name = params.get('download_name') or f"job_{job.id}.zip"
+    db.session.commit()
+
+    error_log = []
+    with open(job.result_path, 'wb') as f:
+        for chunk in stream_zip(report_card_zip_entries(tasks, error_log, progress), error_log):
+            f.write(chunk)
+
+    return {'total': len(tasks), 'failed': len(error_log)}
+
+@job_handler('ai_comment')
+def run_ai_comment_job(job, params):
+    """
+    批量生成AI评语 {registration_ids, force, fresh, rule_fallback}
+    数据准备与保存在任务线程, 仅 LLM 请求在线程池中并发 (LLM_BATCH_CONCURRENCY), 按 provider 限速;
+    缓存命中的直接保存, 同一批次中得分向量相同的报名只请求一次;
+    rule_fallback: LLM 请求失败的报名改存规则评语草稿
+    """
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    
+    registration_ids = params.get('registration_ids', [])
+    total = len(registration_ids)
+    progress = JobProgress(job.id)
+    progress(0, total, '正在生成评语', force=True)
+    
+    details = []
+    rule_based = []
+    
+    def save(item, content, is_ai_generated=True):
+        try:
+            body, status = save_ai_comment_draft(item['registration_id'], personalize_ai_comment(content, item['student_name']),
+                                                 job.created_by, is_ai_generated)
+        except Exception as e:
+            db.session.rollback()
+            body = {'success': False, 'message': str(e)}
+        details.append({'registration_id': item['registration_id'], 'success': body.get('success', False),
+                        'message': body.get('message')})
+        
+    def save_rule_based(items):
+        template = ExamTemplate.query.get(items[0]['template_id'])
+        drafts = rule_based_comment_drafts(template, [item['registration_id'] for item in items])
+        for item in items:
+            save(item, drafts[item['registration_id']]['comment'], is_ai_generated=False)
+            rule_based.append(item['registration_id'])
+        
+    groups = {}
+    cache_hits = 0
+    for registration_id in registration_ids:
+        item, error = prepare_ai_comment(registration_id, params.get('force', False), params.get('fresh', False))
+        if error:
+            details.append({'registration_id': registration_id, 'success': False, 'message': error[0].get('message')})
+            continue
+        cached = read_ai_comment_cache(item) if item['cache_key'] not in groups else None
+        if cached is not None:
+            cache_hits += 1
+            save(item, cached)
+        else:
+            # Fresh requests each get their own call; cacheable ones share one per fingerprint
+            group_key = item['cache_key'] if item['use_cache'] else ('fresh', registration_id)
+            groups.setdefault(group_key, []).append(item)
+    progress(len(details), total, '正在生成评语')
+            
+    def generate(item):
+        limiter = get_llm_rate_limiter(item['llm'])
+        if limiter:
+            limiter.acquire()
+        answered_by = {}
+        content = request_llm_completion(item['llm'], item['messages'], answered_by=answered_by)
+        return content, answered_by['llm']
+        
+    executor = ThreadPoolExecutor(max_workers=max(1, min(app.config['LLM_BATCH_CONCURRENCY'], len(groups))))
+    try:
+        futures = {executor.submit(generate, items[0]): items for items in groups.values()}
+        for future in as_completed(futures):
+            items = futures[future]
+            try:
+                content, answered_llm = future.result()
+            except Exception as e:
+                if params.get('rule_fallback'):
+                    # Items in one group share a fingerprint, hence a template
+                    save_rule_based(items)
+                else:
+                    for item in items:
+                        details.append({'registration_id': item['registration_id'], 'success': False, 'message': str(e)})
+            else:
+                write_ai_comment_cache(items[0], content, answered_llm)
+                for item in items:
+                    save(item, content)
+            progress(len(details), total, '正在生成评语')
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        
+    progress(total, total)
+    return {
+        'generated': len([d for d in details if d['success']]),
+        'failed': len([d for d in details if not d['success']]),
+        'llm_calls': len(groups),
+        'cache_hits': cache_hits,
+        'rule_based': len(rule_based),
+        'details': sorted(details, key=lambda d: d['registration_id'])
+    }
+
+def get_visible_job(job_id):
+    """当前用户可访问的任务 (管理员可见全部)"""
+    job = BackgroundJob.query.get_or_404(job_id)
+    if session.get('role') != 'admin' and job.created_by != session.get('user_id'):
+        return None
+    return job
+
+@app.route('/api/jobs', methods=['GET'])
+@login_required
+def api_list_jobs():
+    """最近的后台任务"""
+    query = BackgroundJob.query
+    if session.get('role') != 'admin':
+        query = query.filter_by(created_by=session.get('user_id'))
+    jobs = query.order_by(BackgroundJob.id.desc()).limit(int(request.args.get('limit', 50))).all()
+    return jsonify({'success': True, 'jobs': [job.to_dict() for job in jobs]})
+
+@app.route('/api/jobs/<int:job_id>', methods=['GET'])
+@login_required
+def api_job_status(job_id):
+    """任务状态与进度"""
+    job = get_visible_job(job_id)
+    if not job:
+        return jsonify({'success': False, 'message': '权限不足'}), 403
+    return jsonify({'success': True, 'job': job.to_dict()})
+
+@app.route('/api/jobs/<int:job_id>/cancel', methods=['POST'])
+@login_required
+def api_cancel_job(job_id):
+    """取消任务 (排队中的直接取消, 运行中的在下一次进度上报时停止)"""
+    job = get_visible_job(job_id)
+    if not job:
+        return jsonify({'success': False, 'message': '权限不足'}), 403
+
+    if job.status not in ('pending', 'running'):
+        return jsonify({'success': False, 'message': '任务已结束'}), 400
+
+    # Still queued -> cancel outright; otherwise the worker stops at its next progress report
+    db.session.query(BackgroundJob)\
+        .filter(BackgroundJob.id == job_id, BackgroundJob.status == 'pending')\
+        .update({'status': 'cancelled', 'finished_at': datetime.utcnow(), 'message': '已取消'},
+                synchronize_session=False)
+    db.session.query(BackgroundJob).filter_by(id=job_id).update({'cancel_requested': True}, synchronize_session=False)
+    db.session.commit()
+
+    db.session.refresh(job)
+    return jsonify({'success': True, 'job': job.to_dict()})
+
+@app.route('/api/jobs/<int:job_id>/download', methods=['GET'])
+@login_required
+def api_job_download(job_id):
+    """下载任务结果文件"""
+    job = get_visible_job(job_id)
+    if not job:
+        return jsonify({'success': False, 'message': '权限不足'}), 403
+    if job.status != 'succeeded' or not job.result_path or not os.path.exists(job.result_path):
+        return jsonify({'success': False, 'message': '结果文件不存在或已过期'}), 404
+    return send_file(job.result_path, as_attachment=True, download_name=job.result_name)
 
 @app.route('/api/report-cards')
 def api_report_cards():
@@ -2674,7 +5295,10 @@ def api_report_cards():
         ExamSession.name.label('exam_session_name'),
         Subject.name.label('subject_name'),
         Subject.total_score.label('max_score'),
-        ExamTemplate.id.label('template_id')
+        ExamTemplate.id.label('template_id'),
+        ExamRegistration.score.label('total_score'),
+        ExamRegistration.scored_count,
+        ExamRegistration.correct_count
     ).join(School, Student.school_id == School.id)\
      .join(ExamRegistration, Student.id == ExamRegistration.student_id)\
      .join(ExamSession, ExamRegistration.exam_session_id == ExamSession.id)\
@@ -2690,6 +5314,14 @@ def api_report_cards():
         query = query.filter(Student.grade_level == grade)
     if subject:
         query = query.filter(Subject.name == subject)
+        
+    # 状态筛选 (基于报名汇总列, 在分页之前)
+    if status == 'pending':
+        query = query.filter(ExamRegistration.scored_count == 0)
+    elif status == 'completed':
+        query = query.filter(ExamRegistration.scored_count > 0, ExamRegistration.correct_count == ExamRegistration.scored_count)
+    elif status == 'partial':
+        query = query.filter(ExamRegistration.scored_count > 0, ExamRegistration.correct_count < ExamRegistration.scored_count)
     
     # 分页
     offset = (page - 1) * pageSize
@@ -2699,17 +5331,10 @@ def api_report_cards():
     report_cards = []
     
     for result in results:
-        # 获取分数统计
-        scores = db.session.query(Score, Question)\
-            .join(Question, Score.question_id == Question.id)\
-            .join(Subject, Question.subject_id == Subject.id)\
-            .filter(Score.student_id == result.student_pk)\
-            .filter(Subject.id == Subject.query.filter_by(name=result.subject_name).first().id)\
-            .all()
-        
-        total_score = sum(float(score.score) for score, question in scores)
-        correct_count = sum(1 for score, question in scores if score.is_correct)
-        total_count = len(scores)
+        # 分数统计 (报名汇总列, 由 refresh_registration_totals 维护)
+        total_score = result.total_score or 0
+        correct_count = result.correct_count or 0
+        total_count = result.scored_count or 0
         accuracy = (correct_count / total_count * 100) if total_count > 0 else 0
         
         # 确定状态
@@ -2720,10 +5345,6 @@ def api_report_cards():
         else:
             status_result = 'partial'
         
-        # 应用状态筛选
-        if status and status_result != status:
-            continue
-        
         report_cards.append({
             'studentId': result.student_pk,
             'studentName': result.student_name,
@@ -2978,24 +5599,28 @@ def api_update_student(id):
             for key in to_remove:
                 reg = current_map[key]
                 # Check for scores
-                has_scores = Score.query.join(Question).filter(
-                    Score.student_id == student.id,
-                    Question.exam_template_id == reg.exam_template_id
+                has_scores = Score.query.filter(
+                    Score.exam_template_id == reg.exam_template_id,
+                    Score.student_id == student.id
                 ).first()
                 
                 if not has_scores:
                     db.session.delete(reg)
             
             # Add
+            added = []
             for s_id, t_id in to_add:
                 new_reg = ExamRegistration(
                     student_id=student.id,
                     exam_session_id=s_id,
                     exam_template_id=t_id,
-                    attendance_status='present',
-                    status='registered'
+                    attendance_status='present'
                 )
                 db.session.add(new_reg)
+                added.append(new_reg)
+            db.session.flush()
+            # Scores already entered for the template count towards the new registration
+            refresh_registration_totals([r.id for r in added])
                 
         db.session.commit()
         return jsonify({'success': True, 'message': '学生信息更新成功'})
@@ -3193,6 +5818,8 @@ def api_student_quick_register():
                 attendance_status='pending'
             )
             db.session.add(new_reg)
+            db.session.flush()
+            refresh_registration_totals([new_reg.id])
             msg = '报名成功'
         else:
             msg = '该学生已报名此试卷'
@@ -3274,6 +5901,8 @@ def api_update_exam_template(id):
         # total_questions might be auto-calc, but allow edit
         if 'total_questions' in data:
             template.total_questions = data['total_questions']
+            db.session.flush()
+            refresh_registration_totals(template_ids=[template.id])
         
         if 'creator_id' in data:
             template.creator_id = data['creator_id']
@@ -3301,7 +5930,7 @@ def api_delete_exam_template(id):
             }), 400
             
         # Check scores
-        score_count = Score.query.join(Question).filter(Question.exam_template_id == id).count()
+        score_count = Score.query.filter(Score.exam_template_id == id).count()
         if score_count > 0:
              return jsonify({
                 'success': False, 
@@ -3343,6 +5972,8 @@ def api_add_question(id):
         # Update template total questions count
         template = ExamTemplate.query.get(id)
         template.total_questions = Question.query.filter_by(exam_template_id=id).count() + 1
+        db.session.flush()
+        refresh_registration_totals(template_ids=[id]) # completion status depends on the question count
         
         db.session.commit()
         return jsonify({'success': True, 'message': '题目添加成功'})
@@ -3356,6 +5987,8 @@ def api_delete_question(id):
     question = Question.query.get_or_404(id)
     template_id = question.exam_template_id
     try:
+        # Scores carry exam_template_id themselves, so drop the question's scores rather than leave them counted
+        Score.query.filter_by(question_id=id).delete(synchronize_session=False)
         db.session.delete(question)
         
         # Update template total questions count
@@ -3367,6 +6000,8 @@ def api_delete_question(id):
         
         template = ExamTemplate.query.get(template_id)
         template.total_questions = Question.query.filter_by(exam_template_id=template_id).count()
+        db.session.flush()
+        refresh_registration_totals(template_ids=[template_id])
         db.session.commit()
         
         return jsonify({'success': True, 'message': '题目删除成功'})
@@ -3383,7 +6018,11 @@ def api_update_question(id):
         question.question_number = data.get('question_number', question.question_number)
         question.module = data.get('module', question.module)
         question.knowledge_point = data.get('knowledge_point', question.knowledge_point)
-        question.score = data.get('score', question.score)
+        if data.get('score') is not None and float(data['score']) != question.score:
+            question.score = float(data['score'])
+            # Full marks changed: re-derive is_correct for this question, then the registrations' correct_count
+            Score.query.filter_by(question_id=id).update({'is_correct': Score.score == question.score}, synchronize_session=False)
+            refresh_registration_totals(template_ids=[question.exam_template_id])
         
         db.session.commit()
         return jsonify({'success': True, 'message': '题目更新成功'})
@@ -3435,7 +6074,7 @@ def api_register_students():
     if not template:
         return jsonify({'success': False, 'message': '试卷模板不存在'}), 404
         
-    count = 0
+    added = []
     try:
         for sid in student_ids:
             # Check if already registered
@@ -3452,10 +6091,12 @@ def api_register_students():
                     attendance_status='pending'
                 )
                 db.session.add(new_reg)
-                count += 1
+                added.append(new_reg)
         
+        db.session.flush()
+        refresh_registration_totals([r.id for r in added])
         db.session.commit()
-        return jsonify({'success': True, 'message': f'成功报名 {count} 名学生'})
+        return jsonify({'success': True, 'message': f'成功报名 {len(added)} 名学生'})
     except Exception as e:
         db.session.rollback()
         return jsonify({'success': False, 'message': str(e)}), 500
@@ -3512,48 +6153,112 @@ def api_get_available_students():
     
     return jsonify([s.to_dict() for s in students])
 
-# 初始化数据库
-@app.before_first_request
+# --- Schema Migrations ---
+# 版本化迁移: 容器启动时由 entrypoint.sh 运行 scripts/migrate_schema.py 执行一次 (早于 gunicorn),
+# 已执行的版本记录在 schema_migrations 表; Web worker 启动与请求路径不再检查表结构.
+# 新的表结构变更: 追加到 SCHEMA_MIGRATIONS 末尾 (版本号递增, 已发布的迁移不要修改), 同时更新模型定义.
+# 每个迁移在一个事务中执行并写入版本记录; 旧库可能已由原 create_tables 做过部分变更, 所以迁移需可重复执行.
+
+def table_columns(conn, table):
+    return [c['name'] for c in inspect(conn).get_columns(table)]
+
+def table_indexes(conn, table):
+    return [i['name'] for i in inspect(conn).get_indexes(table)] + \
+           [c['name'] for c in inspect(conn).get_unique_constraints(table)]
+
+def add_missing_columns(conn, table, columns):
+    """columns: [(name, DDL type)]; 只添加表中尚不存在的列"""
+    existing = table_columns(conn, table)
+    for name, ddl in columns:
+        if name not in existing:
+            print(f"Migrating: Adding {name} to {table}")
+            conn.execute(f'ALTER TABLE {table} ADD COLUMN {name} {ddl}')
+
+def migrate_template_sessions(conn):
+    """试卷-场次改为多对多: 旧的 exam_templates.exam_session_id 写入 exam_template_sessions"""
+    conn.execute('INSERT INTO exam_template_sessions (exam_template_id, exam_session_id) '
+                 'SELECT t.id, t.exam_session_id FROM exam_templates t WHERE t.exam_session_id IS NOT NULL '
+                 'AND NOT EXISTS (SELECT 1 FROM exam_template_sessions ets '
+                 'WHERE ets.exam_template_id = t.id AND ets.exam_session_id = t.exam_session_id)')
+
+def migrate_template_staff(conn):
+    add_missing_columns(conn, 'exam_templates', [('creator_id', 'INTEGER REFERENCES users(id)'),
+                                                 ('grader_id', 'INTEGER REFERENCES users(id)')])
+
+def migrate_user_names(conn):
+    add_missing_columns(conn, 'users', [('english_name', 'VARCHAR(50)'), ('real_name', 'VARCHAR(50)')])
+
+def migrate_registration_score_status(conn):
+    add_missing_columns(conn, 'exam_registrations', [('score', 'FLOAT'), ('status', 'VARCHAR(20)')])
+
+def migrate_registration_score_revision(conn):
+    add_missing_columns(conn, 'exam_registrations', [('score_revision', 'INTEGER NOT NULL DEFAULT 0')])
+
+def migrate_llm_fallback_providers(conn):
+    add_missing_columns(conn, 'system_settings', [('llm_fallback_providers', 'TEXT')])
+
+def migrate_score_unique(conn):
+    """(student_id, question_id) 唯一约束: 先清理重复行 (保留最新一条)"""
+    if 'uq_score_student_question' in table_indexes(conn, 'scores'):
+        return
+    conn.execute('DELETE FROM scores WHERE id NOT IN '
+                 '(SELECT max_id FROM (SELECT MAX(id) AS max_id FROM scores GROUP BY student_id, question_id) AS keep)')
+    conn.execute('CREATE UNIQUE INDEX uq_score_student_question ON scores (student_id, question_id)')
+
+def migrate_score_template(conn):
+    """scores.exam_template_id (冗余) + 覆盖索引, 由 questions 回填"""
+    add_missing_columns(conn, 'scores', [('exam_template_id', 'INTEGER REFERENCES exam_templates (id)')])
+    conn.execute('UPDATE scores SET exam_template_id = '
+                 '(SELECT questions.exam_template_id FROM questions WHERE questions.id = scores.question_id) '
+                 'WHERE exam_template_id IS NULL')
+    if 'ix_score_template_student' not in table_indexes(conn, 'scores'):
+        conn.execute('CREATE INDEX ix_score_template_student ON scores (exam_template_id, student_id, question_id, score)')
+
+def migrate_registration_totals(conn):
+    """报名汇总列, 由已有分数回填 (与 scripts/backfill_registration_totals.py 相同)"""
+    add_missing_columns(conn, 'exam_registrations', [('scored_count', 'INTEGER NOT NULL DEFAULT 0'),
+                                                     ('correct_count', 'INTEGER NOT NULL DEFAULT 0'),
+                                                     ('last_scored_at', 'DATETIME')])
+    conn.execute(ExamRegistration.__table__.update().values(**registration_totals_values()))
+
+# (version, name, fn) 按版本顺序执行
+SCHEMA_MIGRATIONS = [
+    (1, 'exam_template_sessions', migrate_template_sessions),
+    (2, 'exam_templates_creator_grader', migrate_template_staff),
+    (3, 'users_english_real_name', migrate_user_names),
+    (4, 'exam_registrations_score_status', migrate_registration_score_status),
+    (5, 'exam_registrations_score_revision', migrate_registration_score_revision),
+    (6, 'system_settings_llm_fallback_providers', migrate_llm_fallback_providers),
+    (7, 'scores_unique_student_question', migrate_score_unique),
+    (8, 'scores_exam_template', migrate_score_template),
+    (9, 'exam_registrations_totals', migrate_registration_totals),
+]
+
+def run_schema_migrations():
+    """
+    建表并执行未执行过的迁移, 返回本次执行的版本号列表
+    全新数据库由 create_all 直接建成最新结构, 所有版本只登记不执行
+    """
+    fresh = not inspect(db.engine).has_table('users')
+    db.create_all() # new tables only; existing tables are changed by migrations
+    with db.engine.connect() as conn:
+        applied = set(row[0] for row in conn.execute(db.select(SchemaMigration.version)))
+    
+    ran = []
+    for version, name, migrate in SCHEMA_MIGRATIONS:
+        if version in applied:
+            continue
+        with db.engine.begin() as conn:
+            if not fresh:
+                print(f"Migrating: {version} {name}")
+                migrate(conn)
+                ran.append(version)
+            conn.execute(SchemaMigration.__table__.insert().values(version=version, name=name, applied_at=datetime.utcnow()))
+    return ran
+
 def create_tables():
-    """创建数据库表"""
-    db.create_all()
-    
-    # 检查并添加缺失的列 (Migration Logic)
-    try:
-        inspector = inspect(db.engine)
-        
-        # Check exam_templates columns
-        columns_templates = [c['name'] for c in inspector.get_columns('exam_templates')]
-        with db.engine.connect() as conn:
-            if 'creator_id' not in columns_templates:
-                print("Migrating: Adding creator_id to exam_templates")
-                conn.execute('ALTER TABLE exam_templates ADD COLUMN creator_id INTEGER REFERENCES users(id)')
-            if 'grader_id' not in columns_templates:
-                print("Migrating: Adding grader_id to exam_templates")
-                conn.execute('ALTER TABLE exam_templates ADD COLUMN grader_id INTEGER REFERENCES users(id)')
-                
-        # Check users columns
-        columns_users = [c['name'] for c in inspector.get_columns('users')]
-        with db.engine.connect() as conn:
-            if 'english_name' not in columns_users:
-                print("Migrating: Adding english_name to users")
-                conn.execute('ALTER TABLE users ADD COLUMN english_name VARCHAR(50)')
-            if 'real_name' not in columns_users:
-                print("Migrating: Adding real_name to users")
-                conn.execute('ALTER TABLE users ADD COLUMN real_name VARCHAR(50)')
-
-        # Check exam_registrations columns
-        columns_regs = [c['name'] for c in inspector.get_columns('exam_registrations')]
-        with db.engine.connect() as conn:
-            if 'score' not in columns_regs:
-                print("Migrating: Adding score to exam_registrations")
-                conn.execute('ALTER TABLE exam_registrations ADD COLUMN score FLOAT')
-            if 'status' not in columns_regs:
-                print("Migrating: Adding status to exam_registrations")
-                conn.execute('ALTER TABLE exam_registrations ADD COLUMN status VARCHAR(20)')
-                
-    except Exception as e:
-        print(f"Migration check failed: {e}")
+    """建表、执行迁移并创建默认账号与初始数据 (容器启动时由 scripts/migrate_schema.py 调用, 不在请求中执行)"""
+    run_schema_migrations()
     
     # 检查并创建默认用户
     if not User.query.filter_by(username='admin').first():
@@ -3821,92 +6526,112 @@ def data_management():
 #    flash('导入功能已禁用，请联系管理员', 'danger')
 #    return redirect(url_for('data_management'))
 
+def write_all_data_export(output):
+    """全量备份工作簿 (考试场次/试卷模板/题目/考生/评分记录) 写入 output (路径或文件对象)"""
+    # 1. Exams
+    sessions = ExamSession.query.all()
+    df_exams = pd.DataFrame([{
+        '名称': s.name, 
+        '日期': s.exam_date, 
+        '状态': s.status,
+        '类型': s.session_type,
+        '开始时间': s.start_time,
+        '结束时间': s.end_time
+    } for s in sessions])
+
+    # 2. Templates
+    templates = ExamTemplate.query.all()
+    df_templates = pd.DataFrame([{
+        '模板名称': t.name, 
+        '科目': t.subject.name if t.subject else '', 
+        '年级': t.grade_level, 
+        '题目数': t.total_questions
+    } for t in templates])
+
+    # 2.1 Questions (Added)
+    questions = Question.query.all()
+    df_questions = pd.DataFrame([{
+        '试卷名称': q.exam_template.name if q.exam_template else '',
+        '题号': q.question_number,
+        '模块': q.module,
+        '知识点': q.knowledge_point,
+        '题型': getattr(q, 'question_type', ''), # Handle potential missing attribute
+        '分值': q.score
+    } for q in questions])
+
+    # 3. Students (Enhanced)
+    students = Student.query.all()
+    student_data = []
+    for s in students:
+        # Get registrations info
+        regs = ExamRegistration.query.filter_by(student_id=s.id).all()
+        reg_details = []
+        for r in regs:
+            t_name = r.exam_template.name if r.exam_template else 'Unknown'
+            s_name = r.exam_session.name if r.exam_session else 'Unknown'
+            reg_details.append(f"{s_name} ({t_name})")
+        reg_str = "; ".join(reg_details)
+
+        student_data.append({
+            '姓名': s.name, 
+            '学号': s.student_id, 
+            '年级': s.grade_level, 
+            '学校': s.school.name if s.school else '',
+            '报考详情': reg_str
+        })
+    df_students = pd.DataFrame(student_data)
+
+    # 4. Scores
+    regs = ExamRegistration.query.filter(ExamRegistration.score != None).all()
+    scores_data = []
+    for r in regs:
+        if r.student and r.exam_template:
+            scores_data.append({
+                '学号': r.student.student_id,
+                '姓名': r.student.name,
+                '试卷名称': r.exam_template.name,
+                '得分': r.score
+            })
+    df_scores = pd.DataFrame(scores_data)
+
+    with pd.ExcelWriter(output, engine='openpyxl') as writer:
+        if not df_exams.empty:
+            df_exams.to_excel(writer, sheet_name='考试场次', index=False)
+        if not df_templates.empty:
+            df_templates.to_excel(writer, sheet_name='试卷模板', index=False)
+        if not df_questions.empty:
+            df_questions.to_excel(writer, sheet_name='题目明细', index=False)
+        if not df_students.empty:
+            df_students.to_excel(writer, sheet_name='考生信息', index=False)
+        if not df_scores.empty:
+            df_scores.to_excel(writer, sheet_name='评分记录', index=False)
+
+def all_data_export_filename():
+    return f"System_Backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
+
+@job_handler('data_export')
+def run_data_export_job(job, params):
+    """全量备份 -> 结果文件"""
+    progress = JobProgress(job.id)
+    progress(0, 1, '正在导出', force=True)
+    job.result_path = job_result_path(job.id, '.xlsx')
+    job.result_name = params.get('download_name') or all_data_export_filename()
+    db.session.commit()
+    write_all_data_export(job.result_path)
+    progress(1, 1)
+    return {}
+
 @app.route('/data/export/all')
 @login_required
 def export_all_data():
-    """一键全量导出备份"""
+    """一键全量导出备份 (默认后台任务)"""
+    filename = all_data_export_filename()
+    if wants_background_job():
+        return submit_job_response('data_export', {'download_name': filename})
     try:
-        # 1. Exams
-        sessions = ExamSession.query.all()
-        df_exams = pd.DataFrame([{
-            '名称': s.name, 
-            '日期': s.exam_date, 
-            '状态': s.status,
-            '类型': s.session_type,
-            '开始时间': s.start_time,
-            '结束时间': s.end_time
-        } for s in sessions])
-        
-        # 2. Templates
-        templates = ExamTemplate.query.all()
-        df_templates = pd.DataFrame([{
-            '模板名称': t.name, 
-            '科目': t.subject.name if t.subject else '', 
-            '年级': t.grade_level, 
-            '题目数': t.total_questions
-        } for t in templates])
-
-        # 2.1 Questions (Added)
-        questions = Question.query.all()
-        df_questions = pd.DataFrame([{
-            '试卷名称': q.exam_template.name if q.exam_template else '',
-            '题号': q.question_number,
-            '模块': q.module,
-            '知识点': q.knowledge_point,
-            '题型': getattr(q, 'question_type', ''), # Handle potential missing attribute
-            '分值': q.score
-        } for q in questions])
-        
-        # 3. Students (Enhanced)
-        students = Student.query.all()
-        student_data = []
-        for s in students:
-            # Get registrations info
-            regs = ExamRegistration.query.filter_by(student_id=s.id).all()
-            reg_details = []
-            for r in regs:
-                t_name = r.exam_template.name if r.exam_template else 'Unknown'
-                s_name = r.exam_session.name if r.exam_session else 'Unknown'
-                reg_details.append(f"{s_name} ({t_name})")
-            reg_str = "; ".join(reg_details)
-
-            student_data.append({
-                '姓名': s.name, 
-                '学号': s.student_id, 
-                '年级': s.grade_level, 
-                '学校': s.school.name if s.school else '',
-                '报考详情': reg_str
-            })
-        df_students = pd.DataFrame(student_data)
-        
-        # 4. Scores
-        regs = ExamRegistration.query.filter(ExamRegistration.score != None).all()
-        scores_data = []
-        for r in regs:
-            if r.student and r.exam_template:
-                scores_data.append({
-                    '学号': r.student.student_id,
-                    '姓名': r.student.name,
-                    '试卷名称': r.exam_template.name,
-                    '得分': r.score
-                })
-        df_scores = pd.DataFrame(scores_data)
-        
         output = io.BytesIO()
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            if not df_exams.empty:
-                df_exams.to_excel(writer, sheet_name='考试场次', index=False)
-            if not df_templates.empty:
-                df_templates.to_excel(writer, sheet_name='试卷模板', index=False)
-            if not df_questions.empty:
-                df_questions.to_excel(writer, sheet_name='题目明细', index=False)
-            if not df_students.empty:
-                df_students.to_excel(writer, sheet_name='考生信息', index=False)
-            if not df_scores.empty:
-                df_scores.to_excel(writer, sheet_name='评分记录', index=False)
-            
+        write_all_data_export(output)
         output.seek(0)
-        filename = f"System_Backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
         return send_file(output, download_name=filename, as_attachment=True)
     except Exception as e:
         flash(f'备份失败: {str(e)}', 'danger')
@@ -4018,26 +6743,6 @@ def export_scores():
         flash(f'导出失败: {str(e)}', 'danger')
         return redirect(url_for('data_management'))
 
-# Helper to create zip
-def create_batch_zip(pdf_files, error_logs):
-    zip_buffer = io.BytesIO()
-    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-        for filename, content in pdf_files:
-            # Ensure unique filenames
-            if filename in zip_file.namelist():
-                base, ext = os.path.splitext(filename)
-                counter = 1
-                while f"{base}_{counter}{ext}" in zip_file.namelist():
-                    counter += 1
-                filename = f"{base}_{counter}{ext}"
-            zip_file.writestr(filename, content.getvalue())
-        
-        if error_logs:
-            zip_file.writestr('error_log.txt', '\n'.join(error_logs))
-            
-    zip_buffer.seek(0)
-    return zip_buffer
-
 @app.route('/api/export/pdf/student/<int:student_id>')
 @login_required
 def export_student_pdfs(student_id):
@@ -4047,40 +6752,38 @@ def export_student_pdfs(student_id):
     registrations = ExamRegistration.query.filter_by(student_id=student_id).all()
     session_ids = set(r.exam_session_id for r in registrations if r.exam_session_id)
     
-    pdf_files = []
-    error_logs = []
-    
+    tasks = []
     for session_id in session_ids:
         session_obj = ExamSession.query.get(session_id)
         if not session_obj:
             continue
-            
-        try:
-            pdf_buffer = generate_report_card_pdf(student_id, session_id)
-            if pdf_buffer:
-                filename = f"{student.name}_{session_obj.name}.pdf"
-                pdf_files.append((filename, pdf_buffer))
-            else:
-                error_logs.append(f"Failed to generate PDF for session: {session_obj.name}")
-        except Exception as e:
-            error_logs.append(f"Error generating PDF for session {session_obj.name}: {str(e)}")
-            
-    if not pdf_files and not error_logs:
+        tasks.append({
+            'student_id': student_id,
+            'session_id': session_id,
+            'template_id': None,
+            'filename': f"{student.name}_{session_obj.name}.pdf",
+            'session_name': session_obj.name
+        })
+        
+    if not tasks:
          return jsonify({'success': False, 'message': '没有找到该考生的考试记录'}), 404
-
-    zip_buffer = create_batch_zip(pdf_files, error_logs)
-    from urllib.parse import quote
-    filename = f"{student.name}_ReportCards.zip"
+         
+    download_name = f"{student.name}_ReportCards.zip"
+    if wants_background_job():
+        return submit_job_response('report_card_zip', {'tasks': tasks, 'download_name': download_name})
+        
+    error_logs = []
     
-    # Handle filename encoding for non-ascii
-    response = make_response(send_file(
-        zip_buffer, 
-        as_attachment=True,
-        download_name=filename,
-        mimetype='application/zip'
-    ))
-    response.headers["Content-Disposition"] = f"attachment; filename*=UTF-8''{quote(filename)}"
-    return response
+    def entries():
+        for task, pdf_bytes, error in render_report_card_batch(tasks):
+            if error:
+                error_logs.append(f"Error generating PDF for session {task['session_name']}: {error}")
+            elif pdf_bytes:
+                yield task['filename'], pdf_bytes
+            else:
+                error_logs.append(f"Failed to generate PDF for session: {task['session_name']}")
+                
+    return zip_stream_response(entries(), download_name, error_logs)
 
 @app.route('/api/export/pdf/template/<int:template_id>')
 @login_required
@@ -4090,9 +6793,7 @@ def export_template_pdfs(template_id):
     # Find all registrations for this template
     registrations = ExamRegistration.query.filter_by(exam_template_id=template_id).all()
     
-    pdf_files = []
-    error_logs = []
-    
+    tasks = []
     processed_students = set()
     
     for reg in registrations:
@@ -4104,32 +6805,34 @@ def export_template_pdfs(template_id):
         if not student:
             continue
             
-        try:
-            # We filter by template_id to get only this exam's result in the PDF
-            pdf_buffer = generate_report_card_pdf(reg.student_id, reg.exam_session_id, template_id=template_id)
-            if pdf_buffer:
-                filename = f"{student.name}_{template.name}.pdf"
-                pdf_files.append((filename, pdf_buffer))
-            else:
-                error_logs.append(f"Failed to generate PDF for student: {student.name}")
-        except Exception as e:
-            error_logs.append(f"Error generating PDF for student {student.name}: {str(e)}")
-            
-    if not pdf_files:
+        # We filter by template_id to get only this exam's result in the PDF
+        tasks.append({
+            'student_id': reg.student_id,
+            'session_id': reg.exam_session_id,
+            'template_id': template_id,
+            'filename': f"{student.name}_{template.name}.pdf",
+            'student_name': student.name
+        })
+        
+    if not tasks:
          return jsonify({'success': False, 'message': '没有可生成的成绩单'}), 404
-
-    zip_buffer = create_batch_zip(pdf_files, error_logs)
-    from urllib.parse import quote
-    filename = f"{template.name}_ReportCards.zip"
+         
+    download_name = f"{template.name}_ReportCards.zip"
+    if wants_background_job():
+        return submit_job_response('report_card_zip', {'tasks': tasks, 'download_name': download_name})
+        
+    error_logs = []
     
-    response = make_response(send_file(
-        zip_buffer, 
-        as_attachment=True,
-        download_name=filename,
-        mimetype='application/zip'
-    ))
-    response.headers["Content-Disposition"] = f"attachment; filename*=UTF-8''{quote(filename)}"
-    return response
+    def entries():
+        for task, pdf_bytes, error in render_report_card_batch(tasks):
+            if error:
+                error_logs.append(f"Error generating PDF for student {task['student_name']}: {error}")
+            elif pdf_bytes:
+                yield task['filename'], pdf_bytes
+            else:
+                error_logs.append(f"Failed to generate PDF for student: {task['student_name']}")
+                
+    return zip_stream_response(entries(), download_name, error_logs)
 
 @app.route('/api/export/pdf/all')
 @login_required
@@ -4145,9 +6848,7 @@ def export_all_pdfs():
         if reg.student_id and reg.exam_session_id:
             tasks.add((reg.student_id, reg.exam_session_id))
             
-    pdf_files = []
-    error_logs = []
-    
+    render_tasks = []
     for student_id, session_id in tasks:
         student = Student.query.get(student_id)
         session_obj = ExamSession.query.get(session_id)
@@ -4155,32 +6856,39 @@ def export_all_pdfs():
         if not student or not session_obj:
             continue
             
-        try:
-            pdf_buffer = generate_report_card_pdf(student_id, session_id)
-            if pdf_buffer:
-                filename = f"{student.name}_{session_obj.name}.pdf"
-                pdf_files.append((filename, pdf_buffer))
-            else:
-                error_logs.append(f"Failed for {student.name} in {session_obj.name}")
-        except Exception as e:
-            error_logs.append(f"Error for {student.name} in {session_obj.name}: {str(e)}")
-
-    if not pdf_files:
+        render_tasks.append({
+            'student_id': student_id,
+            'session_id': session_id,
+            'template_id': None,
+            'filename': f"{student.name}_{session_obj.name}.pdf",
+            'label': f"{student.name} in {session_obj.name}"
+        })
+        
+    if not render_tasks:
          return jsonify({'success': False, 'message': '没有可生成的成绩单'}), 404
-
-    zip_buffer = create_batch_zip(pdf_files, error_logs)
-    from urllib.parse import quote
-    filename = f"All_ReportCards_{datetime.now().strftime('%Y%m%d')}.zip"
+         
+    download_name = f"All_ReportCards_{datetime.now().strftime('%Y%m%d')}.zip"
+    if wants_background_job():
+        return submit_job_response('report_card_zip', {'tasks': render_tasks, 'download_name': download_name})
+        
+    error_logs = []
     
-    response = make_response(send_file(
-        zip_buffer, 
-        as_attachment=True,
-        download_name=filename,
-        mimetype='application/zip'
-    ))
-    response.headers["Content-Disposition"] = f"attachment; filename*=UTF-8''{quote(filename)}"
-    return response
+    def entries():
+        for task, pdf_bytes, error in render_report_card_batch(render_tasks):
+            if error:
+                error_logs.append(f"Error for {task['label']}: {error}")
+            elif pdf_bytes:
+                yield task['filename'], pdf_bytes
+            else:
+                error_logs.append(f"Failed for {task['label']}")
+                
+    return zip_stream_response(entries(), download_name, error_logs)
 
 if __name__ == '__main__':
+    # 开发环境: 启动前执行迁移 (容器内由 entrypoint.sh 执行);
+    # debug 模式下 reloader 会在子进程 (WERKZEUG_RUN_MAIN=true) 中再次执行本段, 只在父进程迁移一次
+    if os.environ.get('WERKZEUG_RUN_MAIN') != 'true':
+        with app.app_context():
+            create_tables()
     # 运行应用
     app.run(host='0.0.0.0', port=8083, debug=True)
\ No newline at end of file